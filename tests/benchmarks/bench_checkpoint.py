@@ -0,0 +1,98 @@
+"""Checkpoint overhead and restore time benchmark.
+
+Scales the snapshots in tests/mockapi_data up to about 5000 vehicles by cloning every vehicle under suffixed ids,
+reconciles them with and without a Checkpointer and then restores the store from the latest snapshot plus log. Like
+between two polls of a feed, the checkpoint writer drains before every cycle, only the reconcile itself is timed.
+
+Usage:
+    poetry run python tests/benchmarks/bench_checkpoint.py
+"""
+
+import gc
+import glob
+import logging
+import os
+import tempfile
+import time
+
+from transitfeedhub_ingestor.helpers.BatchSink import BatchSink
+from transitfeedhub_ingestor.helpers.Checkpoint import Checkpointer
+from transitfeedhub_ingestor.helpers.EntityStore import EntityStore
+from transitfeedhub_ingestor.helpers.setup_logger import logger
+from transitfeedhub_ingestor.helpers.VehiclePositionFeed import VehiclePositionFeed
+from transitfeedhub_ingestor.protobuf import gtfs_realtime_pb2
+
+MOCKAPI_DATA = os.path.join(os.path.dirname(os.path.dirname(__file__)), "mockapi_data")
+VEHICLES = 5000
+
+
+def load_scaled_snapshots() -> list[list[gtfs_realtime_pb2.VehiclePosition]]:
+    snapshots: list[list[gtfs_realtime_pb2.VehiclePosition]] = []
+    for path in sorted(glob.glob(os.path.join(MOCKAPI_DATA, "*.pb"))):
+        feed = gtfs_realtime_pb2.FeedMessage()
+        with open(path, "rb") as f:
+            feed.ParseFromString(f.read())
+        vehicles = [e.vehicle for e in feed.entity if e.HasField("vehicle")]
+        snapshot: list[gtfs_realtime_pb2.VehiclePosition] = []
+        copy = 0
+        while len(snapshot) < VEHICLES:
+            for vehicle in vehicles:
+                clone = gtfs_realtime_pb2.VehiclePosition()
+                clone.CopyFrom(vehicle)
+                clone.vehicle.id = f"{vehicle.vehicle.id}-{copy}"
+                snapshot.append(clone)
+            copy += 1
+        snapshots.append(snapshot[:VEHICLES])
+    return snapshots
+
+
+def make_feed(checkpointer: Checkpointer | None) -> VehiclePositionFeed:
+    return VehiclePositionFeed(
+        url="",
+        agency="MBTA",
+        file_path="/MBTA",
+        s3_bucket="",
+        batch_sink=BatchSink(lambda object_name, data, content_encoding: None),
+        checkpointer=checkpointer,
+    )
+
+
+def run(snapshots: list[list[gtfs_realtime_pb2.VehiclePosition]], checkpointer: Checkpointer | None) -> float:
+    feed = make_feed(checkpointer)
+    elapsed = 0.0
+    for snapshot in snapshots:
+        # collect outside of the measurement, and drain the checkpoint writer like the interval between two polls
+        if checkpointer is not None:
+            checkpointer.flush()
+        gc.collect()
+        start = time.perf_counter()
+        feed.reconcile(snapshot)
+        elapsed += time.perf_counter() - start
+    if checkpointer is not None:
+        checkpointer.close()
+    return elapsed
+
+
+if __name__ == "__main__":
+    logger.setLevel(logging.WARNING)
+    snapshots = load_scaled_snapshots()
+    cycles = len(snapshots)
+    # without, with, with and without again, so a drift of the machine weighs on both alike
+    with tempfile.TemporaryDirectory() as first, tempfile.TemporaryDirectory() as directory:
+        baseline = run(snapshots, None)
+        checkpointed = run(snapshots, Checkpointer(first))
+        checkpointed += run(snapshots, Checkpointer(directory))
+        baseline += run(snapshots, None)
+        size = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+        store = EntityStore()
+        start = time.perf_counter()
+        Checkpointer(directory).restore(store)
+        restore = time.perf_counter() - start
+
+    print(f"cycles: {cycles} | vehicles per cycle: {VEHICLES}")
+    print(f"reconcile without checkpoint: {baseline / 2 / cycles * 1e3:7.2f} ms/cycle")
+    print(f"reconcile with checkpoint:    {checkpointed / 2 / cycles * 1e3:7.2f} ms/cycle")
+    print(f"overhead:                     {(checkpointed / baseline - 1) * 100:7.1f} %")
+    print(f"checkpoint size on disk:      {size / 1e6:7.2f} MB")
+    print(f"restore of {len(store)} entities: {restore:7.3f} s")
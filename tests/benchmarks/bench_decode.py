@@ -0,0 +1,105 @@
+"""Parse time benchmark of FeedDecoder on a large feed.
+
+Scales the first snapshot in tests/mockapi_data up to about 5 MB by cloning every vehicle under suffixed ids, once as a
+vehicle positions only feed and once as a combined feed with a trip update of 20 stops per vehicle. Every payload is
+decoded the way get_entities did before (a new FeedMessage and a list of its vehicles) and through FeedDecoder with and
+without message reuse and minimal decode, once on its own and once iterating the vehicles like reconcile does.
+
+Usage:
+    poetry run python tests/benchmarks/bench_decode.py [--size BYTES] [--repeat N]
+    PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION=python poetry run python tests/benchmarks/bench_decode.py --size 1000000
+"""
+
+import argparse
+import glob
+import os
+import time
+from collections.abc import Callable
+
+from transitfeedhub_ingestor.helpers.FeedDecoder import FeedDecoder, protobuf_backend
+from transitfeedhub_ingestor.protobuf import gtfs_realtime_pb2
+
+MOCKAPI_DATA = os.path.join(os.path.dirname(os.path.dirname(__file__)), "mockapi_data")
+
+
+def scaled_payload(size: int, trip_updates: bool) -> bytes:
+    snapshot = gtfs_realtime_pb2.FeedMessage()
+    with open(sorted(glob.glob(os.path.join(MOCKAPI_DATA, "*.pb")))[0], "rb") as f:
+        snapshot.ParseFromString(f.read())
+    vehicles = [e for e in snapshot.entity if e.HasField("vehicle")]
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.CopyFrom(snapshot.header)
+    copy = 0
+    while feed.ByteSize() < size:
+        for entity in vehicles:
+            clone = feed.entity.add()
+            clone.CopyFrom(entity)
+            clone.id = f"{entity.id}-{copy}"
+            clone.vehicle.vehicle.id = f"{entity.vehicle.vehicle.id}-{copy}"
+            if trip_updates:
+                trip_update = feed.entity.add()
+                trip_update.id = f"trip-{clone.id}"
+                trip_update.trip_update.trip.CopyFrom(entity.vehicle.trip)
+                for sequence in range(20):
+                    stop_time = trip_update.trip_update.stop_time_update.add()
+                    stop_time.stop_sequence = sequence
+                    stop_time.stop_id = str(sequence)
+                    stop_time.arrival.time = entity.vehicle.timestamp + 60 * sequence
+        copy += 1
+    return feed.SerializeToString()
+
+
+def list_cycle(payload: bytes, iterate: bool):
+    # get_entities before FeedDecoder: a new message and a list of its vehicles
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.ParseFromString(payload)
+    vehicles = [e.vehicle for e in feed.entity if e.HasField("vehicle")]
+    if iterate:
+        for vehicle in vehicles:
+            vehicle.timestamp  # noqa: B018
+
+
+def decoder_cycle(decoder: FeedDecoder) -> Callable[[bytes, bool], None]:
+    def cycle(payload: bytes, iterate: bool):
+        entities = decoder.decode(payload)
+        if iterate:
+            for vehicle in entities:
+                vehicle.timestamp  # noqa: B018
+        # done by reconcile at the end of the cycle
+        decoder.release(entities)
+
+    return cycle
+
+
+def run(cycle: Callable[[bytes, bool], None], payload: bytes, iterate: bool, repeat: int) -> float:
+    cycle(payload, iterate)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        cycle(payload, iterate)
+    return (time.perf_counter() - start) / repeat
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=5_000_000, help="approximate payload size in bytes")
+    parser.add_argument("--repeat", type=int, default=20, help="decodes per measurement")
+    args = parser.parse_args()
+
+    print(f"protobuf backend: {protobuf_backend()}")
+    cycles = {
+        "new message + list": list_cycle,
+        "FeedDecoder": decoder_cycle(FeedDecoder(reuse=False)),
+        "FeedDecoder minimal": decoder_cycle(FeedDecoder(minimal=True, reuse=False)),
+    }
+    if protobuf_backend() == "python":
+        cycles["FeedDecoder reuse"] = decoder_cycle(FeedDecoder(reuse=True))
+        cycles["FeedDecoder minimal reuse"] = decoder_cycle(FeedDecoder(minimal=True, reuse=True))
+    else:
+        print("message reuse is only measured with the python backend, see FeedDecoder")
+    for name, trip_updates in (("vehicle positions", False), ("combined with trip updates", True)):
+        payload = scaled_payload(args.size, trip_updates)
+        print(f"{name}: {len(payload) / 1e6:.2f} MB{'':14}decode  decode + iterate")
+        for label, cycle in cycles.items():
+            decode = run(cycle, payload, False, args.repeat)
+            iterate = run(cycle, payload, True, args.repeat)
+            print(f"  {label:<26} {decode * 1e3:8.2f} ms {iterate * 1e3:8.2f} ms")
@@ -0,0 +1,95 @@
+"""Memory benchmark of Entity trajectory storage.
+
+Replays every snapshot in tests/mockapi_data into Entity objects and compares the traced allocation size against
+the previous list based representation (lists of boxed values, list of [lon, lat] pairs and ISO string timestamps).
+
+Usage:
+    poetry run python tests/benchmarks/bench_entity_memory.py
+"""
+
+import datetime
+import glob
+import os
+import tracemalloc
+from collections.abc import Callable
+from typing import Any
+
+from transitfeedhub_ingestor.helpers.Entity import Entity
+from transitfeedhub_ingestor.protobuf import gtfs_realtime_pb2
+
+MOCKAPI_DATA = os.path.join(os.path.dirname(os.path.dirname(__file__)), "mockapi_data")
+
+
+class ListEntity:
+    """Temporal storage as it was before the columnar Entity."""
+
+    def __init__(self, entity: gtfs_realtime_pb2.VehiclePosition):
+        self.entity_id = entity.vehicle.id
+        self.bearing = [entity.position.bearing]
+        self.current_status = [entity.current_status]
+        self.odometer = [entity.position.odometer]
+        self.speed = [entity.position.speed]
+        self.stop_id = [entity.stop_id]
+        self.updated_at = [datetime.datetime.fromtimestamp(entity.timestamp).isoformat()]
+        self.current_stop_sequence = [entity.current_stop_sequence]
+        self.coordinates = [[entity.position.longitude, entity.position.latitude]]
+        self.occupancy_status = [entity.occupancy_status]
+        self.occupancy_percentage = [entity.occupancy_percentage]
+        self.congestion_level = [entity.congestion_level]
+
+    def update(self, entity: gtfs_realtime_pb2.VehiclePosition):
+        self.bearing.append(entity.position.bearing)
+        self.current_status.append(entity.current_status)
+        self.current_stop_sequence.append(entity.current_stop_sequence)
+        self.coordinates.append([entity.position.longitude, entity.position.latitude])
+        self.occupancy_status.append(entity.occupancy_status)
+        self.occupancy_percentage.append(entity.occupancy_percentage)
+        self.speed.append(entity.position.speed)
+        self.odometer.append(entity.position.odometer)
+        self.updated_at.append(datetime.datetime.fromtimestamp(entity.timestamp).isoformat())
+        self.stop_id.append(entity.stop_id)
+        self.congestion_level.append(entity.congestion_level)
+
+
+def load_snapshots() -> list[list[gtfs_realtime_pb2.VehiclePosition]]:
+    snapshots: list[list[gtfs_realtime_pb2.VehiclePosition]] = []
+    for path in sorted(glob.glob(os.path.join(MOCKAPI_DATA, "*.pb"))):
+        feed = gtfs_realtime_pb2.FeedMessage()
+        with open(path, "rb") as f:
+            feed.ParseFromString(f.read())
+        snapshots.append([e.vehicle for e in feed.entity if e.HasField("vehicle")])
+    return snapshots
+
+
+def measure(
+    factory: Callable[[gtfs_realtime_pb2.VehiclePosition], Any],
+    snapshots: list[list[gtfs_realtime_pb2.VehiclePosition]],
+) -> tuple[int, int]:
+    tracemalloc.start()
+    entities: dict[str, Any] = {}
+    points = 0
+    last_timestamp: dict[str, int] = {}
+    for snapshot in snapshots:
+        for feed_entity in snapshot:
+            vehicle_id = feed_entity.vehicle.id
+            if vehicle_id not in entities:
+                entities[vehicle_id] = factory(feed_entity)
+            elif last_timestamp[vehicle_id] != feed_entity.timestamp:
+                entities[vehicle_id].update(feed_entity)
+            else:
+                continue
+            last_timestamp[vehicle_id] = feed_entity.timestamp
+            points += 1
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return current, points
+
+
+if __name__ == "__main__":
+    snapshots = load_snapshots()
+    list_bytes, points = measure(ListEntity, snapshots)
+    column_bytes, _ = measure(Entity, snapshots)
+    print(f"snapshots: {len(snapshots)} | points: {points}")
+    print(f"list storage:     {list_bytes / 1e6:8.2f} MB ({list_bytes / points:6.1f} B/point)")
+    print(f"columnar storage: {column_bytes / 1e6:8.2f} MB ({column_bytes / points:6.1f} B/point)")
+    print(f"reduction:        {list_bytes / column_bytes:8.2f}x")
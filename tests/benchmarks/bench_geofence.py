@@ -0,0 +1,84 @@
+"""Lookup time benchmark of the grid-indexed Geofence against a plain ray cast.
+
+Builds an irregular service area of about 1000 vertices around the vehicles of the first snapshot in
+tests/mockapi_data, then tests random positions spread over twice its bounding box, once by ray casting every edge
+and once through Geofence at several grid sizes. Also times a reconcile of the snapshot with and without an
+IngestFilter that rejects every vehicle, the cost of a filtered vehicle.
+
+Usage:
+    poetry run python tests/benchmarks/bench_geofence.py [--vertices N] [--points N]
+"""
+
+import argparse
+import glob
+import math
+import os
+import random
+import time
+
+from transitfeedhub_ingestor.helpers.FeedDecoder import FeedDecoder
+from transitfeedhub_ingestor.helpers.IngestFilter import Geofence, IngestFilter
+from transitfeedhub_ingestor.helpers.VehiclePositionFeed import VehiclePositionFeed
+
+MOCKAPI_DATA = os.path.join(os.path.dirname(os.path.dirname(__file__)), "mockapi_data")
+
+
+def service_area(vertices: int, rng: random.Random) -> list[tuple[float, float]]:
+    # a jagged ring around the MBTA service area
+    ring: list[tuple[float, float]] = []
+    for i in range(vertices):
+        angle = 2 * math.pi * i / vertices
+        radius = 0.5 * rng.uniform(0.7, 1.0)
+        ring.append((-71.2 + 1.2 * radius * math.cos(angle), 42.3 + radius * math.sin(angle)))
+    return ring
+
+
+def ray_cast(ring: list[tuple[float, float]], lon: float, lat: float) -> bool:
+    inside = False
+    for (x1, y1), (x2, y2) in zip(ring, [*ring[1:], ring[0]]):
+        if (y1 > lat) != (y2 > lat) and lon < (x2 - x1) * (lat - y1) / (y2 - y1) + x1:
+            inside = not inside
+    return inside
+
+
+def reconcile_seconds(payload: bytes, ingest_filter: IngestFilter | None, repeat: int = 20) -> float:
+    decoder = FeedDecoder()
+    total = 0.0
+    for _ in range(repeat):
+        feed = VehiclePositionFeed(url="", agency="MBTA", file_path="/MBTA", s3_bucket="", ingest_filter=ingest_filter)
+        entities = decoder.decode(payload)
+        start = time.perf_counter()
+        feed.reconcile(entities)
+        total += time.perf_counter() - start
+    return total / repeat
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--vertices", type=int, default=1000, help="vertices of the service area")
+    parser.add_argument("--points", type=int, default=100_000, help="positions tested per measurement")
+    args = parser.parse_args()
+
+    rng = random.Random(1)  # noqa: S311
+    ring = service_area(args.vertices, rng)
+    points = [(rng.uniform(-72.4, -70.0), rng.uniform(41.3, 43.3)) for _ in range(args.points)]
+
+    start = time.perf_counter()
+    expected = [ray_cast(ring, lon, lat) for lon, lat in points]
+    naive = time.perf_counter() - start
+    print(f"ray cast of {args.vertices} edges: {naive / args.points * 1e6:8.2f} us/point")
+    for cells in (16, 64, 256, 1024):
+        start = time.perf_counter()
+        geofence = Geofence([[ring]], cells=cells)
+        build = time.perf_counter() - start
+        start = time.perf_counter()
+        found = [geofence.contains(lon, lat) for lon, lat in points]
+        lookup = time.perf_counter() - start
+        assert found == expected
+        print(f"grid of {cells:>4} cells:   {lookup / args.points * 1e6:8.2f} us/point, built in {build * 1e3:7.1f} ms")
+
+    with open(sorted(glob.glob(os.path.join(MOCKAPI_DATA, "*.pb")))[0], "rb") as f:
+        payload = f.read()
+    unfiltered = reconcile_seconds(payload, None)
+    filtered = reconcile_seconds(payload, IngestFilter(routes=()))
+    print(f"first reconcile: {unfiltered * 1e3:.2f} ms, every vehicle filtered out {filtered * 1e3:.2f} ms")
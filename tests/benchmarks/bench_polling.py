@@ -0,0 +1,79 @@
+"""Simulated comparison of fixed-rate polling and AdaptivePoll.
+
+A feed publishes a new payload every --cadence seconds, each becoming available 1 to 3 s after its FeedHeader
+timestamp, and is empty for an overnight service gap. The day is replayed on a simulated clock against fixed poll
+intervals and an AdaptivePoll, counting the fetches and the staleness of the data (seconds from the FeedHeader
+timestamp until the payload was fetched).
+
+Usage:
+    poetry run python tests/benchmarks/bench_polling.py [--cadence SECONDS] [--hours N]
+"""
+
+import argparse
+import random
+from collections.abc import Callable
+
+from transitfeedhub_ingestor.helpers.FeedScheduler import AdaptivePoll
+
+# the simulated day starts at midnight, service stops from 1 am to 5 am
+MIDNIGHT = 1_746_144_000
+SERVICE_GAP = (MIDNIGHT + 1 * 3600, MIDNIGHT + 5 * 3600)
+
+
+class SimulatedFeed:
+    def __init__(self, cadence: float, rng: random.Random):
+        self.cadence = cadence
+        self.rng = rng
+        self.latency: dict[int, float] = {}
+
+    def fetch(self, now: float) -> tuple[list[int] | None, int | None]:
+        # the newest payload available at now: its vehicles (empty during the service gap) and header timestamp
+        k = int(now // self.cadence)
+        if k not in self.latency:
+            self.latency[k] = self.rng.uniform(1.0, 3.0)
+        if now < k * self.cadence + self.latency[k]:
+            k -= 1
+        header = int(k * self.cadence)
+        vehicles = [] if SERVICE_GAP[0] <= header < SERVICE_GAP[1] else [1]
+        return vehicles, header
+
+
+def simulate(feed: SimulatedFeed, seconds: float, next_delay: Callable[[list[int] | None, int | None, float], float]):
+    now = float(MIDNIGHT)
+    last_header = None
+    fetches = new = 0
+    staleness = 0.0
+    while now < MIDNIGHT + seconds:
+        fetches += 1
+        vehicles, header = feed.fetch(now)
+        if header == last_header:
+            vehicles = None
+        elif vehicles:
+            new += 1
+            staleness += now - header
+        last_header = header
+        now += next_delay(vehicles, header, now)
+    return fetches, new, staleness / max(new, 1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cadence", type=float, default=15.0, help="seconds between two publishes of the feed")
+    parser.add_argument("--hours", type=float, default=24.0, help="simulated hours")
+    args = parser.parse_args()
+
+    feed = SimulatedFeed(args.cadence, random.Random(3))  # noqa: S311
+    seconds = args.hours * 3600
+    publishes = seconds / args.cadence
+    print(f"{publishes:.0f} publishes, {SERVICE_GAP[1] - SERVICE_GAP[0]} s without service")
+    for interval in (5.0, 10.0, 30.0):
+        fetches, new, staleness = simulate(feed, seconds, lambda vehicles, header, now, i=interval: i)
+        print(f"  fixed {interval:4.0f} s: {fetches:6d} fetches, {new:5d} payloads, {staleness:5.1f} s mean staleness")
+    poll = AdaptivePoll()
+
+    def adaptive(vehicles: list[int] | None, header: int | None, now: float) -> float:
+        poll.observe(vehicles, header if vehicles is not None else poll.last_header_timestamp, now)
+        return poll.next_delay(now, 30.0)
+
+    fetches, new, staleness = simulate(feed, seconds, adaptive)
+    print(f"  adaptive:     {fetches:6d} fetches, {new:5d} payloads, {staleness:5.1f} s mean staleness")
@@ -0,0 +1,48 @@
+"""Replay throughput benchmark of VehiclePositionFeed.consume_pb.
+
+Feeds recorded snapshots (a directory of .pb captures or a FeedArchiveWriter directory) through the real fetch,
+reconcile and serialization path as fast as possible, publishing into memory instead of S3, and reports snapshots per
+second, per-stage time, peak RSS and the number of trajectories emitted.
+
+Usage:
+    poetry run python tests/benchmarks/bench_replay.py [directory] [--batch-count N] [--gzip] [--run-length METRES] [--simplify METRES]
+        [--max-points N] [--memory-budget BYTES]
+"""
+
+import argparse
+import logging
+import os
+
+from transitfeedhub_ingestor.helpers.BatchSink import BatchSink, memory_publisher
+from transitfeedhub_ingestor.helpers.Entity import RunLengthPolicy, SegmentPolicy
+from transitfeedhub_ingestor.helpers.Replay import replay, snapshot_directory
+from transitfeedhub_ingestor.helpers.setup_logger import logger
+
+MOCKAPI_DATA = os.path.join(os.path.dirname(os.path.dirname(__file__)), "mockapi_data")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("directory", nargs="?", default=MOCKAPI_DATA)
+    parser.add_argument("--batch-count", type=int, default=1, help="trajectories per published object")
+    parser.add_argument("--gzip", action="store_true", help="gzip the published objects")
+    parser.add_argument("--run-length", type=float, metavar="METRES", help="collapse unchanged observations")
+    parser.add_argument("--bearing", type=float, default=15.0, help="bearing tolerance of --run-length in degrees")
+    parser.add_argument("--simplify", type=float, metavar="METRES", help="simplify saved trajectories")
+    parser.add_argument("--max-points", type=int, help="cut trajectories into segments of at most N points")
+    parser.add_argument("--memory-budget", type=int, metavar="BYTES", help="bound the in-flight trajectories")
+    args = parser.parse_args()
+
+    logger.setLevel(logging.WARNING)
+    sink = BatchSink(memory_publisher({}), max_count=args.batch_count, gzip=args.gzip)
+    run_length = None if args.run_length is None else RunLengthPolicy(args.run_length, args.bearing)
+    segments = None
+    if args.max_points is not None or args.memory_budget is not None:
+        segments = SegmentPolicy(max_points=args.max_points, memory_budget=args.memory_budget)
+    report = replay(
+        snapshot_directory(args.directory),
+        batch_sink=sink,
+        run_length=run_length,
+        simplify=args.simplify,
+        segments=segments,
+    )
+    print(report.format())
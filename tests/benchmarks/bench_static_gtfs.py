@@ -0,0 +1,115 @@
+"""Startup and serialization cost of the static GTFS enrichment.
+
+Writes a synthetic static feed of the size of a large agency (routes, trips, stops and shapes), then times building
+the lookup cache from the CSVs against opening the memory-mapped cache on a later start, the cost of a trip and a stop
+lookup, and the serialization of the trajectories of the first snapshots in tests/mockapi_data with and without
+enrichment.
+
+Usage:
+    poetry run python tests/benchmarks/bench_static_gtfs.py [--trips N] [--stops N] [--shape-points N]
+"""
+
+import argparse
+import glob
+import os
+import random
+import tempfile
+import time
+import zipfile
+
+from transitfeedhub_ingestor.helpers.Entity import Entity
+from transitfeedhub_ingestor.helpers.FeedDecoder import FeedDecoder
+from transitfeedhub_ingestor.helpers.MFJSONWriter import MFJSONWriter
+from transitfeedhub_ingestor.helpers.StaticGTFS import StaticGTFS
+
+MOCKAPI_DATA = os.path.join(os.path.dirname(os.path.dirname(__file__)), "mockapi_data")
+
+
+def snapshot_entities(count: int = 20) -> list[Entity]:
+    decoder = FeedDecoder()
+    entities: dict[str, Entity] = {}
+    for path in sorted(glob.glob(os.path.join(MOCKAPI_DATA, "*.pb")))[:count]:
+        with open(path, "rb") as f:
+            for vehicle in decoder.decode(f.read()):
+                entity = entities.get(vehicle.vehicle.id)
+                if entity is None:
+                    entities[vehicle.vehicle.id] = Entity(vehicle)
+                elif vehicle.timestamp != entity.timestamps[-1]:
+                    entity.update(vehicle)
+    return list(entities.values())
+
+
+def write_feed(path: str, entities: list[Entity], trips: int, stops: int, shape_points: int, rng: random.Random):
+    # the ids of the snapshot vehicles plus synthetic ones up to the requested sizes
+    trip_ids = {e.trip_id: e.route_id for e in entities if e.trip_id}
+    trip_ids.update({f"trip-{i}": f"route-{i % 300}" for i in range(trips - len(trip_ids))})
+    stop_ids = {s for e in entities for s in e.stop_id if s} | {f"stop-{i}" for i in range(stops)}
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr(
+            "routes.txt",
+            "route_id,route_short_name,route_long_name,route_type\n"
+            + "".join(f"{r},{r[:4]},Long name of {r},3\n" for r in set(trip_ids.values())),
+        )
+        archive.writestr(
+            "trips.txt",
+            "route_id,service_id,trip_id,trip_headsign,shape_id\n"
+            + "".join(f"{r},weekday,{t},Headsign {rng.randrange(500)},shape-{r}\n" for t, r in trip_ids.items()),
+        )
+        archive.writestr(
+            "stops.txt",
+            "stop_id,stop_name,stop_lat,stop_lon\n" + "".join(f"{s},Stop name {s},42.3,-71.1\n" for s in stop_ids),
+        )
+        archive.writestr(
+            "shapes.txt",
+            "shape_id,shape_pt_lat,shape_pt_lon,shape_pt_sequence\n"
+            + "".join(
+                f"shape-{r},{42 + i * 1e-4},{-71 - i * 1e-4},{i}\n"
+                for r in set(trip_ids.values())
+                for i in range(shape_points)
+            ),
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--trips", type=int, default=100_000, help="trips of the static feed")
+    parser.add_argument("--stops", type=int, default=10_000, help="stops of the static feed")
+    parser.add_argument("--shape-points", type=int, default=500, help="points of every route shape")
+    args = parser.parse_args()
+
+    rng = random.Random(1)  # noqa: S311
+    entities = snapshot_entities()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "agency.zip")
+        write_feed(path, entities, args.trips, args.stops, args.shape_points, rng)
+        cache_dir = os.path.join(directory, "cache")
+
+        start = time.perf_counter()
+        StaticGTFS.load(path, cache_dir).close()
+        build = time.perf_counter() - start
+        start = time.perf_counter()
+        gtfs = StaticGTFS.load(path, cache_dir)
+        mapped = time.perf_counter() - start
+        size = os.path.getsize(gtfs.path)
+        print(f"cache built from the CSVs in {build * 1e3:8.1f} ms, mapped in {mapped * 1e3:6.2f} ms ({size} bytes)")
+
+        keys = [f"trip-{rng.randrange(args.trips)}" for _ in range(100_000)]
+        start = time.perf_counter()
+        for key in keys:
+            gtfs.trips.find(key)
+        print(f"trip lookup: {(time.perf_counter() - start) / len(keys) * 1e6:.2f} us")
+        stop_ids = [f"stop-{rng.randrange(args.stops)}" for _ in range(100_000)]
+        start = time.perf_counter()
+        for stop_id in stop_ids:
+            gtfs.stop_name(stop_id)
+        print(f"stop name lookup: {(time.perf_counter() - start) / len(stop_ids) * 1e6:.2f} us")
+
+        points = sum(len(e) for e in entities)
+        for writer, label in ((MFJSONWriter(), "plain"), (MFJSONWriter(gtfs=gtfs), "enriched")):
+            start = time.perf_counter()
+            for _ in range(5):
+                for entity in entities:
+                    writer.write(entity)
+            seconds = (time.perf_counter() - start) / 5
+            print(f"{label:>8} MF-JSON of {len(entities)} trajectories ({points} points): {seconds * 1e3:7.2f} ms")
+        gtfs.close()
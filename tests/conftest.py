@@ -0,0 +1,43 @@
+import glob
+import os
+
+import pytest
+import requests
+
+from transitfeedhub_ingestor.protobuf import gtfs_realtime_pb2
+
+MOCKAPI_DATA = os.path.join(os.path.dirname(__file__), "mockapi_data")
+
+
+def load_feed_message(path: str) -> gtfs_realtime_pb2.FeedMessage:
+    feed = gtfs_realtime_pb2.FeedMessage()
+    with open(path, "rb") as f:
+        feed.ParseFromString(f.read())
+    return feed
+
+
+def vehicle_positions(feed: gtfs_realtime_pb2.FeedMessage) -> list[gtfs_realtime_pb2.VehiclePosition]:
+    return [e.vehicle for e in feed.entity if e.HasField("vehicle")]
+
+
+class FakeSession:
+    def __init__(self, responses: list[requests.Response]):
+        self.responses = responses
+        self.sent_headers: list[dict[str, str]] = []
+
+    def get(self, url, headers, params, verify, timeout):
+        self.sent_headers.append(headers)
+        return self.responses.pop(0)
+
+
+def make_response(status_code: int, content: bytes = b"", headers: dict[str, str] | None = None) -> requests.Response:
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = content
+    response.headers.update(headers or {})
+    return response
+
+
+@pytest.fixture
+def snapshot_paths() -> list[str]:
+    return sorted(glob.glob(os.path.join(MOCKAPI_DATA, "*.pb")))
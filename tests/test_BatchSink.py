@@ -0,0 +1,143 @@
+import gzip
+import json
+import time
+
+import pytest
+from conftest import load_feed_message, vehicle_positions
+
+from transitfeedhub_ingestor.helpers.BatchSink import BatchSink, PublishError, directory_publisher, s3_publisher
+from transitfeedhub_ingestor.helpers.Entity import Entity
+
+
+def entities(snapshot_paths, count: int) -> list[Entity]:
+    return [Entity(e) for e in vehicle_positions(load_feed_message(snapshot_paths[0]))[:count]]
+
+
+class Recorder:
+    def __init__(self):
+        self.objects: list[tuple[str, bytes, str | None]] = []
+
+    def __call__(self, object_name, data, content_encoding):
+        self.objects.append((object_name, data, content_encoding))
+
+
+def test_batchsink_flushes_on_count(snapshot_paths):
+    recorder = Recorder()
+    sink = BatchSink(recorder, max_count=3)
+    batch = entities(snapshot_paths, 7)
+    for entity in batch:
+        sink.add(entity, "MBTA/20250502/1")
+
+    assert len(recorder.objects) == 2
+    assert sink.pending == 1
+    sink.flush()
+    assert sink.pending == 0
+    assert sink.published_trajectories == 7
+
+    object_name, data, content_encoding = recorder.objects[0]
+    assert object_name.startswith("MBTA/20250502/1/")
+    assert object_name.endswith(".mfjson")
+    assert content_encoding is None
+    document = json.loads(data)
+    assert document["type"] == "FeatureCollection"
+    assert document["features"] == [e.toMFJSONDict()["features"][0] for e in batch[:3]]
+
+
+def test_batchsink_ndjson_gzip_per_prefix(snapshot_paths):
+    recorder = Recorder()
+    sink = BatchSink(recorder, output_format="ndjson", gzip=True)
+    batch = entities(snapshot_paths, 4)
+    sink.add(batch[0], "MBTA/20250502/1")
+    sink.add(batch[1], "MBTA/20250502/39")
+    sink.add(batch[2], "MBTA/20250502/1")
+    sink.flush()
+
+    by_prefix = {name.rsplit("/", 1)[0]: (data, encoding) for name, data, encoding in recorder.objects}
+    data, encoding = by_prefix["MBTA/20250502/1"]
+    assert encoding == "gzip"
+    lines = gzip.decompress(data).decode("ascii").splitlines()
+    assert [json.loads(line) for line in lines] == [e.toMFJSONDict()["features"][0] for e in (batch[0], batch[2])]
+    assert len(recorder.objects) == 2
+
+
+def test_batchsink_flushes_on_size_and_age(snapshot_paths):
+    recorder = Recorder()
+    sink = BatchSink(recorder, max_bytes=1)
+    entity = entities(snapshot_paths, 1)[0]
+    sink.add(entity, "MBTA/20250502/1")
+    assert len(recorder.objects) == 1
+
+    sink = BatchSink(recorder, max_age=0)
+    sink.add(entity, "MBTA/20250502/1")
+    assert len(recorder.objects) == 2
+    sink.flush_due()
+    assert sink.pending == 0
+
+
+def test_entity_save_to_batch_sink(tmp_path, snapshot_paths):
+    sink = BatchSink(directory_publisher(), max_count=2)
+    batch = entities(snapshot_paths, 2)
+    for entity in batch:
+        entity.route_id = "1"
+        entity.save(str(tmp_path), batch_sink=sink)
+
+    files = list((tmp_path / "1").iterdir())
+    assert len(files) == 1
+    assert len(json.loads(files[0].read_text())["features"]) == 2
+
+
+def test_batchsink_flush_timeout_keeps_unpublished_batches_open(snapshot_paths):
+    recorder = Recorder()
+
+    def slow_publish(object_name, data, content_encoding):
+        time.sleep(0.1)
+        recorder(object_name, data, content_encoding)
+
+    sink = BatchSink(slow_publish)
+    batch = entities(snapshot_paths, 4)
+    for i, entity in enumerate(batch):
+        sink.add(entity, f"MBTA/20250502/{i % 3}")
+
+    assert not sink.flush(timeout=0.05)
+    assert len(recorder.objects) == 1
+    assert sink.pending == 4 - sink.published_trajectories
+    # a trajectory added meanwhile joins the batch that was put back
+    sink.add(batch[0], "MBTA/20250502/2")
+    assert sink.flush()
+    assert sink.published_trajectories == 5
+    assert len(recorder.objects) == 3
+    merged = next(data for name, data, _ in recorder.objects if name.startswith("MBTA/20250502/2/"))
+    assert len(json.loads(merged)["features"]) == 2
+
+
+def test_batchsink_keeps_batches_that_failed_to_publish(snapshot_paths):
+    recorder = Recorder()
+    failures = [RuntimeError("bucket unavailable")]
+
+    def flaky_publish(object_name, data, content_encoding):
+        if failures:
+            raise failures.pop()
+        recorder(object_name, data, content_encoding)
+
+    sink = BatchSink(flaky_publish, max_count=3, max_age=0.05)
+    batch = entities(snapshot_paths, 4)
+    for entity in batch[:3]:
+        sink.add(entity, "MBTA/20250502/1")
+
+    assert recorder.objects == []
+    assert sink.pending == 3
+    # the failed batch keeps its age, the trajectory added meanwhile joins it
+    sink.add(batch[3], "MBTA/20250502/1")
+    time.sleep(0.05)
+    sink.flush_due()
+    assert sink.pending == 0
+    assert sink.published_trajectories == 4
+    assert len(recorder.objects) == 1
+    assert len(json.loads(recorder.objects[0][1])["features"]) == 4
+
+
+def test_s3_publisher_raises_when_the_upload_fails(monkeypatch):
+    monkeypatch.setattr("transitfeedhub_ingestor.helpers.BatchSink.upload_file", lambda *args, **kwargs: False)
+    publish = s3_publisher("TestBucket")
+    with pytest.raises(PublishError):
+        publish("MBTA/20250502/1/batch.mfjson", b"{}", None)
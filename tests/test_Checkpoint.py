@@ -0,0 +1,138 @@
+import glob
+import os
+import threading
+
+import pytest
+from conftest import load_feed_message, vehicle_positions
+
+from transitfeedhub_ingestor.helpers.Checkpoint import Checkpointer
+from transitfeedhub_ingestor.helpers.Entity import Entity, RunLengthPolicy
+from transitfeedhub_ingestor.helpers.EntityStore import EntityStore
+from transitfeedhub_ingestor.helpers.VehiclePositionFeed import VehiclePositionFeed
+
+
+def run_feed(feed: VehiclePositionFeed, snapshots):
+    for feed_entities in snapshots:
+        feed.reconcile(feed_entities)
+
+
+def make_feed(
+    checkpointer: Checkpointer, run_length: RunLengthPolicy | None = None, simplify: float | None = None
+) -> VehiclePositionFeed:
+    return VehiclePositionFeed(
+        url="",
+        agency="MBTA",
+        file_path="/MBTA",
+        s3_bucket="TestBucket",
+        checkpointer=checkpointer,
+        run_length=run_length,
+        simplify=simplify,
+    )
+
+
+def state(store: EntityStore) -> dict:
+    # created is rebuilt from the log time for entities created after the last snapshot
+    return {
+        entity.entity_id: (
+            {name: getattr(entity, name) for name in Entity.STATIC_FIELDS},
+            {name: list(getattr(entity, name)) for name in Entity.COLUMNS if name != "_stop_id_codes"},
+            entity.stop_id,
+            [(c.label, c.carriage_sequence, list(c.occupancy_status)) for c in entity.carriages],
+        )
+        for entity in store
+    }
+
+
+@pytest.mark.parametrize("run_length", [None, RunLengthPolicy()])
+def test_checkpoint_restore(monkeypatch, tmp_path, snapshot_paths, run_length):
+    monkeypatch.setattr(Entity, "savetos3", lambda self, bucket, file_path, uploader=None, writer=None: None)
+    snapshots = [vehicle_positions(load_feed_message(path)) for path in snapshot_paths[:25]]
+
+    checkpointer = Checkpointer(str(tmp_path), snapshot_interval=10, fsync=False)
+    feed = make_feed(checkpointer, run_length)
+    run_feed(feed, snapshots[:25])
+    checkpointer.flush()
+
+    # the log covered by the snapshot of cycle 20 has been compacted away
+    assert [os.path.basename(p) for p in glob.glob(str(tmp_path / "snapshot-*.bin"))] == ["snapshot-000000000020.bin"]
+    assert all(int(os.path.basename(p)[4:-4]) > 20 for p in glob.glob(str(tmp_path / "wal-*.log")))
+
+    restored = make_feed(Checkpointer(str(tmp_path), snapshot_interval=10, fsync=False), run_length)
+    assert restored.restore() == len(feed.entities)
+    assert restored.checkpointer is not None
+    assert restored.checkpointer.cycle == 25
+    assert state(restored.entities) == state(feed.entities)
+    checkpointer.close()
+
+
+def test_checkpoint_logs_evicted_entities_before_simplify(monkeypatch, tmp_path, snapshot_paths):
+    monkeypatch.setattr(Entity, "savetos3", lambda self, bucket, file_path, uploader=None, writer=None: None)
+    snapshots = [vehicle_positions(load_feed_message(path)) for path in snapshot_paths[:25]]
+    # the writer only starts once every cycle was reconciled, after simplify replaced the columns of the evicted
+    released = threading.Event()
+    write = Checkpointer._write
+    monkeypatch.setattr(Checkpointer, "_write", lambda self, item: released.wait() and write(self, item))
+
+    checkpointer = Checkpointer(str(tmp_path), snapshot_interval=100, fsync=False)
+    feed = make_feed(checkpointer, simplify=5)
+    run_feed(feed, snapshots)
+    assert feed.evictions > 0
+    assert feed.simplified_rows > 0
+    released.set()
+    checkpointer.close()
+
+    restored = make_feed(Checkpointer(str(tmp_path), fsync=False))
+    restored.restore()
+    assert state(restored.entities) == state(feed.entities)
+
+
+def test_checkpoint_restore_continues_journal(monkeypatch, tmp_path, snapshot_paths):
+    monkeypatch.setattr(Entity, "savetos3", lambda self, bucket, file_path, uploader=None, writer=None: None)
+    snapshots = [vehicle_positions(load_feed_message(path)) for path in snapshot_paths[:12]]
+
+    first = Checkpointer(str(tmp_path), snapshot_interval=5, fsync=False)
+    run_feed(make_feed(first), snapshots[:7])
+    first.close()
+
+    second = Checkpointer(str(tmp_path), snapshot_interval=5, fsync=False)
+    feed = make_feed(second)
+    feed.restore()
+    run_feed(feed, snapshots[7:])
+    second.close()
+
+    expected = make_feed(Checkpointer(str(tmp_path / "expected"), fsync=False))
+    run_feed(expected, snapshots)
+    restored = make_feed(Checkpointer(str(tmp_path), fsync=False))
+    restored.restore()
+    assert state(restored.entities) == state(expected.entities)
+
+
+def test_checkpoint_ignores_torn_tail(monkeypatch, tmp_path, snapshot_paths):
+    monkeypatch.setattr(Entity, "savetos3", lambda self, bucket, file_path, uploader=None, writer=None: None)
+    snapshots = [vehicle_positions(load_feed_message(path)) for path in snapshot_paths[:3]]
+
+    checkpointer = Checkpointer(str(tmp_path), fsync=False)
+    feed = make_feed(checkpointer)
+    run_feed(feed, snapshots[:2])
+    checkpointer.flush()
+    expected = state(feed.entities)
+    run_feed(feed, snapshots[2:])
+    checkpointer.close()
+
+    # a crash in the middle of the third record leaves a partial record behind
+    (wal,) = glob.glob(str(tmp_path / "wal-*.log"))
+    with open(wal, "r+b") as f:
+        f.truncate(os.path.getsize(wal) - 10)
+
+    restored = make_feed(Checkpointer(str(tmp_path), fsync=False))
+    restored.restore()
+    assert restored.checkpointer is not None
+    assert restored.checkpointer.cycle == 2
+    assert state(restored.entities) == expected
+
+
+def test_checkpoint_falls_back_to_older_snapshot(tmp_path):
+    (tmp_path / "snapshot-000000000009.bin").write_bytes(b"TFHCKPT1 truncated")
+    store = EntityStore()
+    assert Checkpointer(str(tmp_path), fsync=False).restore(store) == 0
+    assert len(store) == 0
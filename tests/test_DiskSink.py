@@ -0,0 +1,151 @@
+import json
+import os
+import time
+
+from conftest import load_feed_message, vehicle_positions
+
+from transitfeedhub_ingestor.helpers.DiskSink import DiskSink
+from transitfeedhub_ingestor.helpers.Entity import Entity
+
+
+def entities(snapshot_paths, count: int) -> list[Entity]:
+    return [Entity(e) for e in vehicle_positions(load_feed_message(snapshot_paths[0]))[:count]]
+
+
+def test_disksink_appends_per_route_and_publishes_on_flush(tmp_path, snapshot_paths):
+    sink = DiskSink(str(tmp_path))
+    batch = entities(snapshot_paths, 3)
+    for entity in batch:
+        entity.route_id = "1"
+        entity.save("MBTA/20250502", batch_sink=sink)
+    other = entities(snapshot_paths, 1)[0]
+    sink.add(other, "MBTA/20250502/39")
+    sink.flush()
+
+    (segment,) = (tmp_path / "MBTA" / "20250502" / "1").iterdir()
+    assert segment.suffix == ".mfjson"
+    document = json.loads(segment.read_text())
+    assert document["features"] == [e.toMFJSONDict()["features"][0] for e in batch]
+    assert len(list((tmp_path / "MBTA" / "20250502" / "39").iterdir())) == 1
+    assert sink.published_objects == 2
+    assert sink.published_trajectories == 4
+    sink.close()
+
+
+def test_disksink_never_exposes_partial_segments(tmp_path, snapshot_paths):
+    sink = DiskSink(str(tmp_path), output_format="ndjson", fsync_interval=0)
+    batch = entities(snapshot_paths, 2)
+    sink.add(batch[0], "MBTA/20250502/1")
+    deadline = time.monotonic() + 5
+    while sink.fsyncs == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    # written and synced, but only as a hidden part file until the segment rotates
+    (part,) = (tmp_path / "MBTA" / "20250502" / "1").iterdir()
+    assert part.name.startswith(".")
+    assert part.name.endswith(".ndjson.part")
+    sink.add(batch[1], "MBTA/20250502/1")
+    sink.close()
+
+    (segment,) = (tmp_path / "MBTA" / "20250502" / "1").iterdir()
+    assert segment.suffix == ".ndjson"
+    lines = segment.read_text().splitlines()
+    assert [json.loads(line) for line in lines] == [e.toMFJSONDict()["features"][0] for e in batch]
+
+
+def test_disksink_rotates_on_size_and_age(tmp_path, snapshot_paths):
+    sink = DiskSink(str(tmp_path / "size"), max_bytes=1)
+    for entity in entities(snapshot_paths, 3):
+        sink.add(entity, "1")
+    sink.flush()
+    assert len(list((tmp_path / "size" / "1").iterdir())) == 3
+    sink.close()
+
+    sink = DiskSink(str(tmp_path / "age"), max_age=0.05)
+    sink.add(entities(snapshot_paths, 1)[0], "1")
+    deadline = time.monotonic() + 5
+    while sink.published_objects == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert sink.published_objects == 1
+    (segment,) = (tmp_path / "age" / "1").iterdir()
+    assert not segment.name.startswith(".")
+    sink.close()
+
+
+def test_disksink_recovers_part_files_of_a_crashed_writer(tmp_path, snapshot_paths):
+    batch = entities(snapshot_paths, 3)
+    features = [e.toMFJSONDict()["features"][0] for e in batch]
+    serialized = [json.dumps(feature, separators=(",", ":")).encode("ascii") for feature in features]
+    directory = tmp_path / "MBTA" / "20250502" / "1"
+    directory.mkdir(parents=True)
+    # torn in the middle of the third feature, and in the middle of the third line
+    collection = b'{"type":"FeatureCollection","features":[' + b",".join(serialized)
+    (directory / ".a.mfjson.part").write_bytes(collection[:-20])
+    (directory / ".b.ndjson.part").write_bytes(b"\n".join(serialized)[:-20])
+    # torn before the first feature was complete
+    (directory / ".c.mfjson.part").write_bytes(collection[:30])
+
+    # a writer still running on the same root keeps its open segment
+    running = DiskSink(str(tmp_path), output_format="ndjson", fsync_interval=0)
+    running.add(batch[0], "MBTA/20250502/2")
+    deadline = time.monotonic() + 5
+    while running.fsyncs == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    sink = DiskSink(str(tmp_path))
+    sink.flush()
+    assert sorted(p.name for p in directory.iterdir()) == ["a.mfjson", "b.ndjson"]
+    assert json.loads((directory / "a.mfjson").read_text())["features"] == features[:2]
+    assert [json.loads(line) for line in (directory / "b.ndjson").read_text().splitlines()] == features[:2]
+    (part,) = (tmp_path / "MBTA" / "20250502" / "2").iterdir()
+    assert part.name.endswith(".ndjson.part")
+    sink.close()
+    running.close()
+    (segment,) = (tmp_path / "MBTA" / "20250502" / "2").iterdir()
+    assert [json.loads(line) for line in segment.read_text().splitlines()] == features[:1]
+
+
+def test_disksink_writer_survives_fsync_errors(tmp_path, snapshot_paths, monkeypatch):
+    fsync = os.fsync
+    failures = []
+
+    def failing_fsync(fd: int):
+        # the first sync of the open segment fails, e.g. on a full disk
+        if not failures:
+            failures.append(fd)
+            raise OSError(28, "No space left on device")
+        fsync(fd)
+
+    monkeypatch.setattr(os, "fsync", failing_fsync)
+    sink = DiskSink(str(tmp_path), fsync_interval=0)
+    batch = entities(snapshot_paths, 2)
+    sink.add(batch[0], "1")
+    deadline = time.monotonic() + 5
+    while not failures and time.monotonic() < deadline:
+        time.sleep(0.01)
+    sink.add(batch[1], "1")
+    sink.flush()
+
+    assert failures
+    (segment,) = (tmp_path / "1").iterdir()
+    assert json.loads(segment.read_text())["features"] == [e.toMFJSONDict()["features"][0] for e in batch]
+    sink.close()
+
+
+def test_disksink_flush_timeout(tmp_path, snapshot_paths, monkeypatch):
+    sink = DiskSink(str(tmp_path))
+    rotate_all = DiskSink._rotate_all
+
+    def slow_rotate_all(self: DiskSink):
+        # e.g. a disk that stopped responding
+        time.sleep(0.5)
+        rotate_all(self)
+
+    monkeypatch.setattr(DiskSink, "_rotate_all", slow_rotate_all)
+    sink.add(entities(snapshot_paths, 1)[0], "1")
+    start = time.monotonic()
+    assert not sink.flush(timeout=0.05)
+    assert time.monotonic() - start < 0.4
+    assert sink.flush()
+    assert sink.published_objects == 1
+    sink.close()
@@ -1,8 +1,10 @@
 import datetime
+import json
 
 import requests
+from conftest import load_feed_message, vehicle_positions
 
-from transitfeedhub_ingestor.helpers.Entity import Entity
+from transitfeedhub_ingestor.helpers.Entity import STOP_IDS, Entity, RunLengthPolicy, SegmentPolicy
 from transitfeedhub_ingestor.protobuf import gtfs_realtime_pb2
 
 
@@ -26,20 +28,126 @@ def test_entity():
     assert feed_entity.vehicle.vehicle.label == entity.vehicle_label
     assert feed_entity.vehicle.vehicle.license_plate == entity.license_plate
 
-    assert [feed_entity.vehicle.position.bearing] == entity.bearing
-    assert [feed_entity.vehicle.current_status] == entity.current_status
-    assert [feed_entity.vehicle.position.odometer] == entity.odometer
-    assert [feed_entity.vehicle.position.speed] == entity.speed
+    assert [feed_entity.vehicle.position.bearing] == list(entity.bearing)
+    assert [feed_entity.vehicle.current_status] == list(entity.current_status)
+    assert [feed_entity.vehicle.position.odometer] == list(entity.odometer)
+    assert [feed_entity.vehicle.position.speed] == list(entity.speed)
 
     assert [feed_entity.vehicle.stop_id] == entity.stop_id
     assert [datetime.datetime.fromtimestamp(feed_entity.vehicle.timestamp).isoformat()] == entity.updated_at
-    assert [feed_entity.vehicle.current_stop_sequence] == entity.current_stop_sequence
+    assert [feed_entity.vehicle.current_stop_sequence] == list(entity.current_stop_sequence)
     assert [[feed_entity.vehicle.position.longitude, feed_entity.vehicle.position.latitude]] == entity.coordinates
 
-    assert [feed_entity.vehicle.occupancy_status] == entity.occupancy_status
-    assert [feed_entity.vehicle.occupancy_percentage] == entity.occupancy_percentage
-    assert [feed_entity.vehicle.congestion_level] == entity.congestion_level
+    assert [feed_entity.vehicle.occupancy_status] == list(entity.occupancy_status)
+    assert [feed_entity.vehicle.occupancy_percentage] == list(entity.occupancy_percentage)
+    assert [feed_entity.vehicle.congestion_level] == list(entity.congestion_level)
 
     feed = gtfs_realtime_pb2.FeedMessage()
     response = requests.get("https://cdn.mbta.com/realtime/VehiclePositions.pb", timeout=30)
     feed.ParseFromString(response.content)
+
+
+def test_entity_columns_from_snapshots(snapshot_paths):
+    first = vehicle_positions(load_feed_message(snapshot_paths[0]))[0]
+    entity = Entity(first)
+    observed = [first]
+    for path in snapshot_paths[1:4]:
+        match = next(e for e in vehicle_positions(load_feed_message(path)) if e.vehicle.id == first.vehicle.id)
+        entity.update(match)
+        observed.append(match)
+
+    assert len(entity) == len(observed)
+    assert list(entity.timestamps) == [e.timestamp for e in observed]
+    assert entity.updated_at == [datetime.datetime.fromtimestamp(e.timestamp).isoformat() for e in observed]
+    assert entity.coordinates == [[e.position.longitude, e.position.latitude] for e in observed]
+    assert list(entity.bearing) == [e.position.bearing for e in observed]
+    assert entity.stop_id == [e.stop_id for e in observed]
+    assert STOP_IDS.decode(STOP_IDS.encode(first.stop_id)) is entity.stop_id[0]
+
+
+def test_entity_tomfjson_from_columns(snapshot_paths):
+    feed_entity = vehicle_positions(load_feed_message(snapshot_paths[0]))[0]
+    entity = Entity(feed_entity)
+    document = json.loads(entity.toMFJSON())
+    feature = document["features"][0]
+
+    assert feature["temporalGeometry"]["coordinates"] == entity.coordinates
+    assert feature["temporalGeometry"]["datetimes"] == entity.updated_at
+    temporal_properties = feature["temporalProperties"][0]
+    assert temporal_properties["bearing"]["values"] == [feed_entity.position.bearing]
+    assert temporal_properties["stop_id"]["values"] == [feed_entity.stop_id]
+    assert json.loads(entity.toJSON())["entity_id"] == entity.entity_id
+
+
+def make_vehicle_position(
+    timestamp: int,
+    longitude: float = -71.06,
+    latitude: float = 42.36,
+    bearing: float = 90,
+    stop_id: str = "place-pktrm",
+) -> gtfs_realtime_pb2.VehiclePosition:
+    vp = gtfs_realtime_pb2.VehiclePosition()
+    vp.vehicle.id = "y1234"
+    vp.timestamp = timestamp
+    vp.position.longitude = longitude
+    vp.position.latitude = latitude
+    vp.position.bearing = bearing
+    vp.stop_id = stop_id
+    return vp
+
+
+def test_entity_run_length_collapses_unchanged_observations():
+    policy = RunLengthPolicy(distance=10, bearing=15)
+    entity = Entity(make_vehicle_position(100))
+    # GPS jitter of a few metres and degrees while held at the stop
+    assert entity.update(make_vehicle_position(130, longitude=-71.06003, bearing=95), policy) is True
+    assert entity.update(make_vehicle_position(160, latitude=42.36004, bearing=85), policy) is False
+    assert entity.update(make_vehicle_position(190), policy) is False
+
+    # the run keeps its first and last timestamp, both at the position it started at
+    assert list(entity.timestamps) == [100, 190]
+    assert entity.coordinates[0] == entity.coordinates[1]
+    assert list(entity.bearing) == [90, 90]
+
+    # a discrete change is never collapsed and starts a new run
+    assert entity.update(make_vehicle_position(220, stop_id="place-dwnxg"), policy) is True
+    assert entity.update(make_vehicle_position(250, stop_id="place-dwnxg"), policy) is True
+    assert entity.update(make_vehicle_position(280, longitude=-71.07, stop_id="place-dwnxg"), policy) is True
+    assert list(entity.timestamps) == [100, 190, 220, 250, 280]
+    assert entity.stop_id == ["place-pktrm", "place-pktrm", "place-dwnxg", "place-dwnxg", "place-dwnxg"]
+
+
+def test_entity_run_length_disabled_keeps_every_observation():
+    entity = Entity(make_vehicle_position(100))
+    for timestamp in (130, 160, 190):
+        assert entity.update(make_vehicle_position(timestamp)) is True
+    assert list(entity.timestamps) == [100, 130, 160, 190]
+
+
+def test_entity_simplify_keeps_columns_aligned_and_transitions():
+    entity = Entity(make_vehicle_position(0))
+    for i in range(1, 12):
+        stop_id = "place-pktrm" if i < 6 else "place-dwnxg"
+        entity.update(make_vehicle_position(i * 30, longitude=-71.06 + i * 0.001, bearing=90 + i, stop_id=stop_id))
+
+    assert entity.simplify(5) == 8
+    assert list(entity.timestamps) == [0, 150, 180, 330]
+    assert entity.stop_id == ["place-pktrm", "place-pktrm", "place-dwnxg", "place-dwnxg"]
+    assert [len(getattr(entity, name)) for name in Entity.COLUMNS] == [4] * len(Entity.COLUMNS)
+    assert list(entity.bearing) == [90, 95, 96, 101]
+    assert entity.simplify(5) == 0
+
+
+def test_entity_nbytes_and_segment_policy():
+    entity = Entity(make_vehicle_position(100))
+    assert sum(getattr(entity, name).itemsize for name in Entity.COLUMNS) == Entity.ROW_BYTES
+    for timestamp in (130, 160):
+        entity.update(make_vehicle_position(timestamp))
+    assert entity.nbytes == 3 * Entity.ROW_BYTES
+
+    assert not SegmentPolicy().due(entity)
+    assert SegmentPolicy(max_points=3).due(entity)
+    assert not SegmentPolicy(max_points=4).due(entity)
+    assert SegmentPolicy(max_age=60).due(entity)
+    assert not SegmentPolicy(max_age=61).due(entity)
+    assert SegmentPolicy(max_bytes=3 * Entity.ROW_BYTES).due(entity)
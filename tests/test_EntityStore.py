@@ -0,0 +1,81 @@
+from conftest import load_feed_message, vehicle_positions
+
+from transitfeedhub_ingestor.helpers.Entity import Entity
+from transitfeedhub_ingestor.helpers.EntityStore import EntityStore
+from transitfeedhub_ingestor.protobuf import gtfs_realtime_pb2
+
+
+def test_entitystore_add_get_evict(snapshot_paths):
+    feed_entities = vehicle_positions(load_feed_message(snapshot_paths[0]))
+    store = EntityStore()
+    for feed_entity in feed_entities:
+        store.add(Entity(feed_entity))
+
+    vehicle_id = feed_entities[0].vehicle.id
+    assert len(store) == len({e.vehicle.id for e in feed_entities})
+    assert vehicle_id in store
+    entity = store.get(vehicle_id)
+    assert entity is not None
+    assert entity.entity_id == vehicle_id
+
+    assert store.evict(vehicle_id) is entity
+    assert vehicle_id not in store
+    assert store.get(vehicle_id) is None
+    assert store.evict(vehicle_id) is None
+
+
+def test_entitystore_iter_allows_eviction(snapshot_paths):
+    store = EntityStore()
+    for feed_entity in vehicle_positions(load_feed_message(snapshot_paths[0])):
+        store.add(Entity(feed_entity))
+
+    for entity in store:
+        store.evict(entity.entity_id)
+    assert len(store) == 0
+
+
+def test_entitystore_index_changes_keeps_first_duplicate(snapshot_paths):
+    feed_entities = vehicle_positions(load_feed_message(snapshot_paths[0]))
+    duplicated = [*feed_entities, feed_entities[0]]
+    index, unchanged = EntityStore().index_changes(duplicated)
+
+    assert set(index) == {e.vehicle.id for e in feed_entities}
+    assert index[feed_entities[0].vehicle.id] is duplicated[0]
+    assert unchanged == set()
+
+
+def test_entitystore_index_changes_rejects_every_duplicate_of_a_rejected_vehicle(snapshot_paths):
+    feed_entities = vehicle_positions(load_feed_message(snapshot_paths[0]))
+    first = feed_entities[0]
+    later = gtfs_realtime_pb2.VehiclePosition()
+    later.CopyFrom(first)
+    later.timestamp += 30
+    index, _ = EntityStore().index_changes([*feed_entities, later], accept=lambda e: e is not first)
+
+    assert first.vehicle.id not in index
+    assert set(index) == {e.vehicle.id for e in feed_entities[1:]}
+
+
+def test_entitystore_index_changes_skips_unchanged_timestamps(snapshot_paths):
+    feed_entities = vehicle_positions(load_feed_message(snapshot_paths[0]))
+    store = EntityStore()
+    index, unchanged = store.index_changes(feed_entities)
+    assert set(index) == {e.vehicle.id for e in feed_entities}
+    assert unchanged == set()
+
+    for feed_entity in feed_entities:
+        store.add(Entity(feed_entity))
+    moved = gtfs_realtime_pb2.VehiclePosition()
+    moved.CopyFrom(feed_entities[0])
+    moved.timestamp += 30
+    _, unchanged = store.index_changes([moved, *feed_entities[1:]])
+    assert unchanged == {e.vehicle.id for e in feed_entities[1:]}
+
+    # the recorded timestamp follows updates and is forgotten on evict
+    entity = store.get(moved.vehicle.id)
+    assert entity is not None
+    entity.update(moved)
+    store.record(entity)
+    store.evict(feed_entities[1].vehicle.id)
+    _, unchanged = store.index_changes([moved, *feed_entities[1:]])
+    assert unchanged == {e.vehicle.id for e in [moved, *feed_entities[2:]]}
@@ -0,0 +1,65 @@
+import glob
+import os
+
+import pytest
+from conftest import FakeSession, load_feed_message, make_response
+
+from transitfeedhub_ingestor.helpers.FeedArchive import FeedArchiveReader, FeedArchiveWriter
+from transitfeedhub_ingestor.helpers.VehiclePositionFeed import VehiclePositionFeed
+
+
+def read_payloads(paths: list[str]) -> list[tuple[int, bytes]]:
+    payloads: list[tuple[int, bytes]] = []
+    for path in paths:
+        with open(path, "rb") as f:
+            payloads.append((load_feed_message(path).header.timestamp, f.read()))
+    return payloads
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_feed_archive_window(tmp_path, snapshot_paths, compress):
+    payloads = read_payloads(snapshot_paths[:20])
+    writer = FeedArchiveWriter(str(tmp_path), max_segment_bytes=300_000, compress=compress)
+    for timestamp, payload in payloads:
+        writer.append(payload, timestamp)
+    writer.close()
+
+    reader = FeedArchiveReader(str(tmp_path))
+    assert len(reader.segments()) > 1
+    assert list(reader.iter_window()) == payloads
+    start, end = payloads[5][0], payloads[12][0]
+    assert list(reader.iter_window(start, end)) == payloads[5:13]
+    assert list(reader.iter_window(payloads[-1][0] + 1)) == []
+
+
+def test_feed_archive_ignores_torn_tail(tmp_path, snapshot_paths):
+    payloads = read_payloads(snapshot_paths[:3])
+    writer = FeedArchiveWriter(str(tmp_path))
+    for timestamp, payload in payloads:
+        writer.append(payload, timestamp)
+    writer.close()
+
+    (segment,) = glob.glob(str(tmp_path / "segment-*.seg"))
+    with open(segment, "r+b") as f:
+        f.truncate(os.path.getsize(segment) - 100)
+    os.remove(segment[: -len(".seg")] + ".idx")
+
+    assert list(FeedArchiveReader(str(tmp_path)).iter_window()) == payloads[:2]
+
+
+def test_vehiclepositionfeed_archives_new_payloads(tmp_path, snapshot_paths):
+    payloads = read_payloads(snapshot_paths[:2])
+    writer = FeedArchiveWriter(str(tmp_path), compress=True)
+    VPFeed = VehiclePositionFeed(url="", agency="MBTA", file_path="/MBTA", s3_bucket="TestBucket", archive=writer)
+    VPFeed.session = FakeSession([
+        make_response(200, payloads[0][1]),
+        make_response(304),
+        make_response(200, payloads[0][1]),
+        make_response(200, payloads[1][1]),
+    ])
+    for _ in range(4):
+        VPFeed.get_entities()
+    writer.close()
+
+    assert writer.archived == 2
+    assert list(FeedArchiveReader(str(tmp_path)).iter_window()) == payloads
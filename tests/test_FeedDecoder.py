@@ -0,0 +1,73 @@
+import pytest
+from conftest import load_feed_message, vehicle_positions
+from google.protobuf.message import DecodeError
+
+from transitfeedhub_ingestor.helpers.Entity import Entity
+from transitfeedhub_ingestor.helpers.FeedDecoder import FeedDecoder, protobuf_backend, report_protobuf_backend
+from transitfeedhub_ingestor.protobuf import gtfs_realtime_pb2
+
+
+def combined_payload(snapshot_paths) -> bytes:
+    # the vehicle positions of a snapshot interleaved with a trip update per vehicle
+    feed = load_feed_message(snapshot_paths[0])
+    combined = gtfs_realtime_pb2.FeedMessage()
+    combined.header.CopyFrom(feed.header)
+    for entity in feed.entity:
+        combined.entity.add().CopyFrom(entity)
+        trip_update = combined.entity.add()
+        trip_update.id = f"trip-{entity.id}"
+        trip_update.trip_update.trip.CopyFrom(entity.vehicle.trip)
+        trip_update.trip_update.stop_time_update.add().stop_id = entity.vehicle.stop_id
+    return combined.SerializeToString()
+
+
+def test_feeddecoder_lazy_vehicle_view(snapshot_paths):
+    payload = combined_payload(snapshot_paths)
+    expected = vehicle_positions(load_feed_message(snapshot_paths[0]))
+    entities = FeedDecoder().decode(payload)
+
+    assert len(entities) == len(expected)
+    assert list(entities) == expected
+    assert expected[0] in entities
+    assert entities.header_timestamp == load_feed_message(snapshot_paths[0]).header.timestamp
+
+
+def test_feeddecoder_minimal_decode_keeps_what_entities_read(snapshot_paths):
+    payload = combined_payload(snapshot_paths)
+    full = list(FeedDecoder().decode(payload))
+    minimal = list(FeedDecoder(minimal=True).decode(payload))
+
+    assert len(minimal) == len(full)
+    assert not hasattr(minimal[0].trip, "modified_trip")
+    for vehicle, expected in zip(minimal, full):
+        entity = Entity(vehicle)
+        assert entity.toMFJSONDict()["features"] == Entity(expected).toMFJSONDict()["features"]
+        # the wire format is unchanged, checkpoints parse minimal vehicles as full ones
+        assert gtfs_realtime_pb2.VehiclePosition.FromString(vehicle.SerializeToString()) == expected
+
+
+def test_feeddecoder_reuses_released_messages(snapshot_paths):
+    with open(snapshot_paths[0], "rb") as f:
+        first = f.read()
+    with open(snapshot_paths[1], "rb") as f:
+        second = f.read()
+    decoder = FeedDecoder(reuse=True)
+    entities = decoder.decode(first)
+    message = entities.message
+    decoder.release(entities)
+
+    reused = decoder.decode(second)
+    assert reused.message is message
+    assert list(reused) == vehicle_positions(load_feed_message(snapshot_paths[1]))
+    # a failed parse hands the message back too
+    decoder.release(reused)
+    with pytest.raises(DecodeError):
+        decoder.decode(b"\xff\xff\xff")
+    assert decoder.decode(first).message is message
+
+
+def test_report_protobuf_backend():
+    assert report_protobuf_backend() == protobuf_backend()
+    assert protobuf_backend() in ("upb", "cpp", "python")
+    # upb never shrinks the arena of a cleared message, reuse is only on by default for the python backend
+    assert FeedDecoder().reuse == (protobuf_backend() == "python")
@@ -0,0 +1,264 @@
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+
+from transitfeedhub_ingestor.helpers.FeedScheduler import AdaptivePoll, FeedSchedule, FeedScheduler, load_feed_schedules
+from transitfeedhub_ingestor.helpers.TripUpdates import TripUpdateAccumulator
+from transitfeedhub_ingestor.helpers.VehiclePositionFeed import VehiclePositionFeed
+
+
+class SlowFeed(VehiclePositionFeed):
+    def __init__(self, latency: float, fail: bool = False, reconcile_latency: float = 0.0):
+        super().__init__(url="", agency="MBTA", file_path="/MBTA", s3_bucket="TestBucket")
+        self.latency = latency
+        self.fail = fail
+        self.reconcile_latency = reconcile_latency
+        self.fetches = 0
+        self.reconciled: list[int] = []
+        self.lock = threading.Lock()
+        # fetches in flight at once, at most, and fetches that ran while a cycle reconciled
+        self.fetching = 0
+        self.max_fetching = 0
+        self.reconciling = False
+        self.pipelined = 0
+
+    def get_entities(self):
+        with self.lock:
+            self.fetches += 1
+            fetch = self.fetches
+            self.fetching += 1
+            self.max_fetching = max(self.max_fetching, self.fetching)
+        try:
+            if self.fail:
+                raise SystemExit("catastrophic")
+            time.sleep(self.latency / 2)
+            if self.reconciling:
+                self.pipelined += 1
+            time.sleep(self.latency / 2)
+            return fetch
+        finally:
+            with self.lock:
+                self.fetching -= 1
+
+    def reconcile(self, feed_entities):
+        self.reconciling = True
+        time.sleep(self.reconcile_latency)
+        self.reconciled.append(feed_entities)
+        self.reconciling = False
+
+
+def run_for(scheduler: FeedScheduler, seconds: float):
+    async def main():
+        task = asyncio.create_task(scheduler.run())
+        await asyncio.sleep(seconds)
+        scheduler.stop()
+        await task
+
+    asyncio.run(main())
+
+
+def test_feedscheduler_fixed_rate_does_not_drift():
+    # a cycle takes 30 ms of a 50 ms period, sleep-after-cycle scheduling would only fit ~6 cycles in 0.5 s
+    schedule = FeedSchedule(SlowFeed(latency=0.03), interval=0.05)
+    run_for(FeedScheduler([schedule]), 0.5)
+
+    assert schedule.cycles >= 9
+    assert schedule.skipped_ticks == 0
+
+
+def test_feedscheduler_skips_ticks_over_concurrency_limit():
+    feed = SlowFeed(latency=0.12)
+    schedule = FeedSchedule(feed, interval=0.05, max_concurrency=1)
+    run_for(FeedScheduler([schedule]), 0.5)
+
+    assert schedule.skipped_ticks > 0
+    assert feed.reconciled == sorted(feed.reconciled)
+
+
+def test_feedscheduler_overlapping_cycles_reconcile_in_order():
+    # every fetch runs over the next tick, the queued cycles wait for it instead of fetching alongside
+    feed = SlowFeed(latency=0.12)
+    schedule = FeedSchedule(feed, interval=0.05, max_concurrency=3)
+    run_for(FeedScheduler([schedule]), 0.5)
+
+    assert schedule.cycles >= 4
+    assert feed.max_fetching == 1
+    assert feed.reconciled == list(range(1, feed.fetches + 1))
+
+
+def test_feedscheduler_overlapping_cycles_fetch_while_the_previous_reconciles():
+    feed = SlowFeed(latency=0.1, reconcile_latency=0.1)
+    schedule = FeedSchedule(feed, interval=0.05, max_concurrency=2)
+    run_for(FeedScheduler([schedule]), 0.5)
+
+    assert feed.pipelined > 0
+    assert feed.max_fetching == 1
+    assert feed.reconciled == sorted(feed.reconciled)
+
+
+def test_feedscheduler_isolates_failing_feed():
+    healthy = FeedSchedule(SlowFeed(latency=0.0), interval=0.05)
+    failing = FeedSchedule(SlowFeed(latency=0.0, fail=True), interval=0.05)
+    run_for(FeedScheduler([healthy, failing]), 0.3)
+
+    assert failing.errors > 0
+    assert failing.cycles == 0
+    assert healthy.cycles >= 5
+
+
+def test_feedscheduler_hung_feeds_do_not_starve_healthy_feed():
+    # more hung feeds than the default ThreadPoolExecutor has threads
+    hung = [FeedSchedule(SlowFeed(latency=1.0), interval=0.05) for _ in range(40)]
+    healthy = FeedSchedule(SlowFeed(latency=0.0), interval=0.05)
+    scheduler = FeedScheduler([*hung, healthy])
+    assert scheduler.max_workers == 41
+    run_for(scheduler, 0.5)
+
+    assert healthy.cycles >= 5
+
+
+def test_feedscheduler_stop_abandons_hung_fetches_at_until():
+    hung_feed = SlowFeed(latency=3.0)
+    hung = FeedSchedule(hung_feed, interval=0.05)
+    healthy = FeedSchedule(SlowFeed(latency=0.0), interval=0.05)
+    scheduler = FeedScheduler([hung, healthy])
+
+    async def main():
+        task = asyncio.create_task(scheduler.run())
+        await asyncio.sleep(0.2)
+        scheduler.stop(until=time.monotonic() + 0.2)
+        await task
+
+    start = time.monotonic()
+    asyncio.run(main())
+    # stopped waiting for the hung fetch without reconciling it
+    assert time.monotonic() - start < 1.5
+    assert hung.cycles == 0
+    assert hung_feed.reconciled == []
+    assert healthy.cycles >= 3
+
+
+def test_load_feed_schedules(tmp_path):
+    config = [
+        {"url": "https://cdn.mbta.com/realtime/VehiclePositions.pb", "agency": "MBTA", "s3_bucket": "TestBucket"},
+        {"url": "https://example.com/vp.pb", "agency": "X", "s3_bucket": "B", "timeout": 15, "jitter": 2},
+        {"url": "https://example.com/all.pb", "agency": "Y", "s3_bucket": "B", "trip_updates": True},
+        {"url": "https://example.com/all.pb", "agency": "Z", "s3_bucket": "B", "trip_updates": {}},
+        {"url": "https://example.com/vp.pb", "agency": "C", "s3_bucket": "B", "checkpoint_dir": str(tmp_path / "c")},
+        {
+            "url": "https://example.com/vp.pb",
+            "agency": "D",
+            "s3_bucket": "B",
+            "checkpoint_dir": str(tmp_path / "d"),
+            "snapshot_interval": 50,
+        },
+    ]
+    path = tmp_path / "feeds.json"
+    path.write_text(json.dumps(config))
+
+    schedules = load_feed_schedules(str(path))
+    assert [s.feed.agency for s in schedules] == ["MBTA", "X", "Y", "Z", "C", "D"]
+    assert schedules[0].feed.file_path == "./data/MBTA"
+    assert schedules[0].interval == 30
+    assert schedules[1].interval == 15
+    assert schedules[1].jitter == 2
+    assert schedules[0].feed.accumulators == []
+    assert [type(a) for a in schedules[2].feed.accumulators] == [TripUpdateAccumulator]
+    assert [type(a) for a in schedules[3].feed.accumulators] == [TripUpdateAccumulator]
+    # the snapshot interval is the Checkpointer default unless configured
+    assert schedules[0].feed.checkpointer is None
+    assert schedules[4].feed.checkpointer is not None
+    assert schedules[4].feed.checkpointer.snapshot_interval == 10
+    assert schedules[5].feed.checkpointer is not None
+    assert schedules[5].feed.checkpointer.snapshot_interval == 50
+
+
+def test_feedscheduler_fail_fast_stops_on_system_exit():
+    healthy = FeedSchedule(SlowFeed(latency=0.0), interval=0.05)
+    failing = FeedSchedule(SlowFeed(latency=0.0, fail=True), interval=0.05)
+    scheduler = FeedScheduler([healthy, failing], fail_fast=True)
+    with pytest.raises(SystemExit):
+        run_for(scheduler, 0.3)
+    assert failing.errors == 1
+
+
+def test_adaptive_poll_aligns_to_publish_cadence():
+    poll = AdaptivePoll(margin=1.0, retry=2.0)
+    # published every 20 s and available 3 s later, found by probing every retry seconds
+    assert poll.next_delay(1000, 30) == 2
+    poll.observe(None, None, 1000)
+    poll.observe([1], 1000, 1004)
+    poll.observe(None, 1000, 1020)
+    poll.observe([1], 1020, 1023)
+    assert poll.cadence == 20
+    assert poll.lag == 3
+    # next publish at 1040, available 3 s later
+    assert poll.next_delay(1023, 30) == 1044 - 1023
+
+    # hits at the aimed time keep the lag where it is
+    poll.observe([1], 1040, 1044)
+    assert poll.lag == 3
+
+    # an early poll finds the feed unchanged and is retried shortly after, backing off up to the cadence
+    poll.observe(None, 1040, 1064)
+    assert poll.next_delay(1064, 30) == poll.retry
+    for _ in range(10):
+        poll.observe(None, 1040, 1064)
+    assert poll.next_delay(1064, 30) == 20
+
+    # polls that fell behind aim at the next publish
+    poll.observe([1], 1060, 1070)
+    assert poll.next_delay(1200, 30) == 1204 - 1200
+
+
+def test_adaptive_poll_backs_off_and_recovers():
+    poll = AdaptivePoll(max_backoff=300)
+    for header in (1000, 1010, 1020):
+        poll.observe(None, None, header)
+        poll.observe([1], header, header + 2)
+
+    delays: list[float] = []
+    for _ in range(8):
+        poll.observe([], None, 2000)
+        delays.append(poll.next_delay(2000, 30))
+    assert delays[:3] == [20, 40, 80]
+    assert delays[-1] == 300
+
+    # service resumes after an overnight gap, the gap does not skew the cadence
+    poll.observe([1], 30000, 30002)
+    assert poll.failures == 0
+    assert poll.cadence == 10
+    assert poll.next_delay(30002, 30) == 30012 - 30002
+
+
+class PublishingFeed(SlowFeed):
+    # publishes a new header timestamp every period seconds of wall clock time
+    def __init__(self, period: int):
+        super().__init__(latency=0.0)
+        self.period = period
+        self.last_header_timestamp = None
+
+    def get_entities(self):
+        self.fetches += 1
+        header = int(time.time()) // self.period * self.period
+        if header == self.last_header_timestamp:
+            return None
+        self.last_header_timestamp = header
+        return [header]
+
+
+def test_feedscheduler_adaptive_poll():
+    adaptive = AdaptivePoll(min_interval=1, margin=0.05, retry=0.05)
+    feed = PublishingFeed(period=1)
+    schedule = FeedSchedule(feed, interval=0.2, adaptive=adaptive)
+    run_for(FeedScheduler([schedule]), 3.5)
+
+    assert adaptive.cadence == 1
+    # every publish is picked up, and probing every retry seconds stops once the cadence is learned
+    assert sum(entities is not None for entities in feed.reconciled) >= 3
+    assert feed.fetches < 3.5 / adaptive.retry / 2
+    headers = [entities[0] for entities in feed.reconciled if entities is not None]
+    assert headers == sorted(set(headers))
@@ -0,0 +1,93 @@
+import json
+import math
+import random
+
+from transitfeedhub_ingestor.helpers.IngestFilter import Geofence, IngestFilter
+from transitfeedhub_ingestor.protobuf import gtfs_realtime_pb2
+
+
+def ray_cast(polygons, lon: float, lat: float) -> bool:
+    # plain even-odd test of every ring, inside if inside any polygon
+    for polygon in polygons:
+        inside = False
+        for ring in polygon:
+            for (x1, y1), (x2, y2) in zip(ring, [*ring[1:], ring[0]]):
+                if (y1 > lat) != (y2 > lat) and lon < (x2 - x1) * (lat - y1) / (y2 - y1) + x1:
+                    inside = not inside
+        if inside:
+            return True
+    return False
+
+
+def vehicle(route_id: str, lon: float, lat: float) -> gtfs_realtime_pb2.VehiclePosition:
+    position = gtfs_realtime_pb2.VehiclePosition()
+    position.trip.route_id = route_id
+    position.position.longitude = lon
+    position.position.latitude = lat
+    return position
+
+
+SQUARE_WITH_HOLE = [[(0, 0), (10, 0), (10, 10), (0, 10)], [(4, 4), (6, 4), (6, 6), (4, 6)]]
+
+
+def test_geofence_holes_and_union():
+    geofence = Geofence([SQUARE_WITH_HOLE, [[(8, 8), (14, 8), (14, 14), (8, 14)]]], cells=16)
+    assert geofence.contains(1, 1)
+    assert not geofence.contains(5, 5)
+    # overlapping polygons are combined, not cancelled out
+    assert geofence.contains(9, 9)
+    assert geofence.contains(13, 13)
+    assert not geofence.contains(12, 2)
+    assert not geofence.contains(-1, 5)
+
+
+def test_geofence_matches_ray_casting():
+    rng = random.Random(7)  # noqa: S311
+    # an irregular star shaped service area and an overlapping square with a hole
+    star: list[tuple[float, float]] = []
+    for i in range(63):
+        radius = (40 if i % 2 else 15) * rng.uniform(0.6, 1.0)
+        star.append((50 + radius * math.cos(i * 0.1), 50 + radius * math.sin(i * 0.1)))
+    polygons = [[star], SQUARE_WITH_HOLE]
+    for cells in (1, 7, 64):
+        geofence = Geofence(polygons, cells=cells)
+        for _ in range(2000):
+            lon, lat = rng.uniform(-5, 100), rng.uniform(-5, 100)
+            assert geofence.contains(lon, lat) == ray_cast(polygons, lon, lat)
+
+
+def test_geofence_from_geojson(tmp_path):
+    path = tmp_path / "area.geojson"
+    path.write_text(
+        json.dumps({
+            "type": "FeatureCollection",
+            "features": [
+                {"type": "Feature", "geometry": {"type": "Polygon", "coordinates": [SQUARE_WITH_HOLE[0]]}},
+                {
+                    "type": "Feature",
+                    "geometry": {"type": "MultiPolygon", "coordinates": [[[(20, 0), (30, 0), (30, 10)]]]},
+                },
+                {"type": "Feature", "geometry": None},
+            ],
+        })
+    )
+    geofence = Geofence.from_geojson(str(path))
+    assert geofence.contains(5, 5)
+    assert geofence.contains(29, 1)
+    assert not geofence.contains(15, 5)
+
+
+def test_ingest_filter_counts_rejections():
+    ingest_filter = IngestFilter(
+        agencies={"SF"}, geofence=Geofence([[[(-123, 37), (-122, 37), (-122, 38), (-123, 38)]]], cells=8)
+    )
+    assert ingest_filter(vehicle("SF:14", -122.4, 37.7))
+    assert not ingest_filter(vehicle("AC:51B", -122.4, 37.7))
+    assert not ingest_filter(vehicle("SF:14", -121.9, 37.3))
+    assert ingest_filter.rejected_routes == 1
+    assert ingest_filter.rejected_geofence == 1
+    assert ingest_filter.rejected == 2
+
+    routes = IngestFilter(routes=["Red"])
+    assert routes(vehicle("Red", 0, 0))
+    assert not routes(vehicle("Orange", 0, 0))
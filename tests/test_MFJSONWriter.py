@@ -0,0 +1,61 @@
+import gzip
+import json
+
+from conftest import load_feed_message, vehicle_positions
+
+from transitfeedhub_ingestor.helpers.Entity import Entity
+from transitfeedhub_ingestor.helpers.MFJSONWriter import MFJSONWriter
+from transitfeedhub_ingestor.helpers.types import MFJSONDict
+
+
+def build_entity(snapshot_paths, with_carriages: bool) -> Entity:
+    snapshots = [vehicle_positions(load_feed_message(path)) for path in snapshot_paths[:10]]
+    first = next(e for e in snapshots[0] if bool(e.multi_carriage_details) == with_carriages)
+    entity = Entity(first)
+    for snapshot in snapshots[1:]:
+        match = next((e for e in snapshot if e.vehicle.id == first.vehicle.id), None)
+        if match and match.timestamp != entity.timestamps[-1]:
+            entity.update(match)
+    return entity
+
+
+def test_mfjsonwriter_compact_matches_dict(snapshot_paths):
+    for with_carriages in (False, True):
+        entity = build_entity(snapshot_paths, with_carriages)
+        data = MFJSONWriter().write(entity)
+        expected: MFJSONDict = entity.toMFJSONDict()
+
+        assert json.loads(data) == expected
+        assert data == json.dumps(expected, separators=(",", ":")).encode("ascii")
+        assert len(data) < len(entity.toMFJSON().encode("utf-8"))
+
+
+def test_mfjsonwriter_gzip(snapshot_paths):
+    entity = build_entity(snapshot_paths, with_carriages=True)
+    writer = MFJSONWriter(gzip=True)
+
+    assert writer.content_encoding == "gzip"
+    assert MFJSONWriter().content_encoding is None
+    assert json.loads(gzip.decompress(writer.write(entity))) == entity.toMFJSONDict()
+
+
+def test_mfjsonwriter_indented(snapshot_paths):
+    entity = build_entity(snapshot_paths, with_carriages=False)
+    assert MFJSONWriter(compact=False).write(entity) == entity.toMFJSON().encode("utf-8")
+
+
+def test_entity_savetos3_sends_content_encoding(snapshot_paths):
+    submitted = []
+
+    class RecordingUploader:
+        def submit(self, data, bucket, object_name, content_encoding=None):
+            submitted.append((data, bucket, object_name, content_encoding))
+
+    entity = build_entity(snapshot_paths, with_carriages=False)
+    entity.savetos3("TestBucket", "MBTA/20250502/1", RecordingUploader(), MFJSONWriter(gzip=True))
+
+    data, bucket, object_name, content_encoding = submitted[0]
+    assert bucket == "TestBucket"
+    assert object_name.startswith("MBTA/20250502/1/")
+    assert content_encoding == "gzip"
+    assert json.loads(gzip.decompress(data)) == entity.toMFJSONDict()
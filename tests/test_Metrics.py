@@ -0,0 +1,81 @@
+import json
+import logging
+import urllib.request
+
+from conftest import FakeSession, make_response
+
+from transitfeedhub_ingestor.helpers.Metrics import MetricsRegistry, MetricsServer
+from transitfeedhub_ingestor.helpers.s3Uploader import set_upload_observer, upload_file
+from transitfeedhub_ingestor.helpers.setup_logger import logger
+from transitfeedhub_ingestor.helpers.VehiclePositionFeed import VehiclePositionFeed
+
+
+class MemoryS3Client:
+    def __init__(self):
+        self.objects: dict[str, bytes] = {}
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[Key] = Body.read()
+
+
+def sample(text: str, line: str) -> float:
+    (value,) = (row.rsplit(" ", 1)[1] for row in text.splitlines() if row.rsplit(" ", 1)[0] == line)
+    return float(value)
+
+
+def test_feed_metrics(monkeypatch, snapshot_paths, caplog):
+    payloads = []
+    for path in snapshot_paths[:3]:
+        with open(path, "rb") as f:
+            payloads.append(f.read())
+    registry = MetricsRegistry()
+    VPFeed = VehiclePositionFeed(
+        url="", agency="MBTA", file_path="/MBTA", s3_bucket="TestBucket", metrics=registry.feed("MBTA")
+    )
+    monkeypatch.setattr(VPFeed, "save_entity_to_s3", lambda entity: VPFeed.entities.evict(entity.entity_id))
+    VPFeed.session = FakeSession([*(make_response(200, payload) for payload in payloads), make_response(304)])
+    with caplog.at_level(logging.INFO, logger=logger.name):
+        for _ in range(4):
+            VPFeed.consume_pb()
+
+    text = registry.render()
+    assert "# TYPE transitfeedhub_fetch_seconds histogram" in text
+    assert sample(text, 'transitfeedhub_fetch_seconds_count{feed="MBTA"}') == 4
+    assert sample(text, 'transitfeedhub_parse_seconds_count{feed="MBTA"}') == 3
+    assert sample(text, 'transitfeedhub_payload_bytes_sum{feed="MBTA"}') == sum(len(p) for p in payloads)
+    assert sample(text, 'transitfeedhub_payload_bytes_bucket{feed="MBTA",le="+Inf"}') == 3
+    assert sample(text, 'transitfeedhub_update_seconds_count{feed="MBTA"}') == 4
+    assert sample(text, 'transitfeedhub_entities{feed="MBTA"}') == len(VPFeed.entities)
+    assert sample(text, 'transitfeedhub_resident_points{feed="MBTA"}') == sum(len(e) for e in VPFeed.entities)
+    assert sample(text, 'transitfeedhub_creates_total{feed="MBTA"}') == VPFeed.creates > 0
+    assert sample(text, 'transitfeedhub_updates_total{feed="MBTA"}') == VPFeed.updates > 0
+    assert sample(text, 'transitfeedhub_skipped_cycles_total{feed="MBTA"}') == 1
+
+    # one structured line per cycle
+    cycles = [json.loads(r.message) for r in caplog.records if r.message.startswith('{"event": "cycle"')]
+    assert [line["cycle"] for line in cycles] == [1, 2, 3, 4]
+    assert cycles[-1]["entities"] == len(VPFeed.entities)
+    assert {"fetch_seconds", "diff_seconds", "update_seconds", "serialize_seconds"} <= set(cycles[-1])
+
+
+def test_metrics_upload_observer_and_server():
+    registry = MetricsRegistry()
+    registry.feed("MBTA")
+    registry.feed("CTA")
+    set_upload_observer(registry.observe_upload)
+    try:
+        assert upload_file("data", "TestBucket", "MBTA/20250502/Red/a.mfjson", s3_client=MemoryS3Client())
+        assert upload_file("data", "TestBucket", "other/a.mfjson", s3_client=MemoryS3Client())
+    finally:
+        set_upload_observer(None)
+
+    server = MetricsServer(registry, port=0)
+    server.start()
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{server.port}/metrics") as response:
+            assert response.headers["Content-Type"].startswith("text/plain")
+            text = response.read().decode()
+    finally:
+        server.close()
+    assert sample(text, 'transitfeedhub_upload_seconds_count{feed="MBTA"}') == 1
+    assert sample(text, 'transitfeedhub_upload_seconds_count{feed="CTA"}') == 0
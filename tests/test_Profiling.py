@@ -0,0 +1,116 @@
+import glob
+import json
+import tracemalloc
+import urllib.error
+import urllib.request
+
+import pytest
+from conftest import load_feed_message, vehicle_positions
+
+from transitfeedhub_ingestor.helpers.Entity import Entity
+from transitfeedhub_ingestor.helpers.Metrics import MetricsRegistry, MetricsServer
+from transitfeedhub_ingestor.helpers.Profiling import Profiler
+from transitfeedhub_ingestor.helpers.VehiclePositionFeed import VehiclePositionFeed
+
+
+@pytest.fixture
+def feed(monkeypatch, snapshot_paths) -> VehiclePositionFeed:
+    monkeypatch.setattr(Entity, "savetos3", lambda self, bucket, file_path, uploader=None, writer=None: None)
+    snapshots = iter([vehicle_positions(load_feed_message(path)) for path in snapshot_paths[:6]])
+    VPFeed = VehiclePositionFeed(url="", agency="MBTA", file_path="/MBTA", s3_bucket="TestBucket")
+    monkeypatch.setattr(VPFeed, "_fetch", lambda: None)
+    monkeypatch.setattr(VehiclePositionFeed, "get_entities", lambda self: next(snapshots))
+    return VPFeed
+
+
+def test_profiler_profiles_the_next_cycles(tmp_path, feed):
+    profiler = Profiler([feed], directory=str(tmp_path))
+    feed.consume_pb()
+    assert "reconcile" not in vars(feed)
+
+    assert profiler.request_profile(2) is True
+    assert profiler.request_profile(2) is False
+    for _ in range(3):
+        feed.consume_pb()
+
+    # the hooks are removed once the capture is written
+    assert not profiler.active
+    assert "reconcile" not in vars(feed)
+    (prof,) = glob.glob(str(tmp_path / "profile-*.prof"))
+    with open(prof[: -len(".prof")] + ".txt") as f:
+        summary = f.read()
+    assert "reconcile" in summary
+
+
+def test_profiler_only_counts_the_cycles_it_profiled(tmp_path, feed, monkeypatch):
+    profiler = Profiler([feed], directory=str(tmp_path))
+    reconcile = VehiclePositionFeed.reconcile
+    requested: list[bool] = []
+
+    def request_while_reconciling(self, feed_entities):
+        # the profile is requested while the reconcile of a cycle is already running
+        if not requested:
+            requested.append(profiler.request_profile(1))
+        reconcile(self, feed_entities)
+
+    monkeypatch.setattr(VehiclePositionFeed, "reconcile", request_while_reconciling)
+    assert profiler.request_top_entities() is True
+    feed.consume_pb()
+    assert requested == [True]
+    assert profiler.active
+    assert glob.glob(str(tmp_path / "profile-*.prof")) == []
+
+    feed.consume_pb()
+    assert not profiler.active
+    assert len(glob.glob(str(tmp_path / "profile-*.prof"))) == 1
+
+
+def test_profiler_tracemalloc_and_largest_entities(tmp_path, feed):
+    profiler = Profiler([feed], directory=str(tmp_path), top_k=5)
+    feed.consume_pb()
+    assert profiler.request_tracemalloc(2) is True
+    assert profiler.request_top_entities() is True
+    feed.consume_pb()
+    assert profiler.active
+    feed.consume_pb()
+
+    assert not profiler.active
+    assert not tracemalloc.is_tracing()
+    traces = sorted(glob.glob(str(tmp_path / "tracemalloc-*.txt")))
+    assert len(traces) == 2
+    with open(traces[0]) as f:
+        assert "Entity.py" in f.read()
+
+    (dump,) = glob.glob(str(tmp_path / "entities-MBTA-*.json"))
+    with open(dump) as f:
+        entities = json.load(f)
+    assert entities["entities"] == len(feed.entities)
+    sizes = [row["nbytes"] for row in entities["largest"]]
+    assert len(sizes) == 5
+    assert sizes == sorted(sizes, reverse=True)
+    # taken at the end of the first traced cycle, every entity grew by at most one row since
+    assert max(entity.nbytes for entity in feed.entities) - sizes[0] <= 2 * Entity.ROW_BYTES
+
+
+def test_profiler_control_endpoints(tmp_path, feed):
+    profiler = Profiler([feed], directory=str(tmp_path))
+    server = MetricsServer(MetricsRegistry(), port=0, controls=profiler.controls())
+    server.start()
+
+    def post(path: str) -> int:
+        request = urllib.request.Request(f"http://127.0.0.1:{server.port}{path}", method="POST")
+        try:
+            with urllib.request.urlopen(request) as response:  # noqa: S310
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    try:
+        assert post("/debug/profile?cycles=1") == 202
+        assert post("/debug/profile?cycles=1") == 409
+        assert post("/debug/tracemalloc?cycles=x") == 400
+        assert post("/debug/unknown") == 404
+    finally:
+        server.close()
+    feed.consume_pb()
+    assert len(glob.glob(str(tmp_path / "profile-*.prof"))) == 1
@@ -0,0 +1,36 @@
+import json
+
+from transitfeedhub_ingestor.helpers.BatchSink import BatchSink, memory_publisher
+from transitfeedhub_ingestor.helpers.FeedArchive import FeedArchiveWriter
+from transitfeedhub_ingestor.helpers.Replay import replay, snapshot_directory, snapshot_files
+from transitfeedhub_ingestor.helpers.VehiclePositionFeed import STAGES, read_header_timestamp
+
+
+def test_replay(snapshot_paths):
+    objects: dict[str, bytes] = {}
+    sink = BatchSink(memory_publisher(objects), max_count=50)
+    report = replay(snapshot_files(snapshot_paths[:20]), agency="MBTA", batch_sink=sink)
+
+    assert report.snapshots == 20
+    assert report.snapshots_per_second > 0
+    assert set(report.stage_seconds) == set(STAGES)
+    assert all(seconds > 0 for seconds in report.stage_seconds.values())
+    assert report.objects == len(objects)
+    assert report.published_bytes == sum(len(data) for data in objects.values())
+    features = [feature for data in objects.values() for feature in json.loads(data)["features"]]
+    assert report.trajectories == len(features)
+    assert all(name.startswith("MBTA/") for name in objects)
+    assert "snapshots/s" in report.format()
+
+
+def test_replay_from_archive(tmp_path, snapshot_paths):
+    writer = FeedArchiveWriter(str(tmp_path), compress=True)
+    for payload in snapshot_files(snapshot_paths[:10]):
+        writer.append(payload, read_header_timestamp(payload))
+    writer.close()
+
+    from_archive = replay(snapshot_directory(str(tmp_path)))
+    from_files = replay(snapshot_files(snapshot_paths[:10]))
+    assert from_archive.snapshots == from_files.snapshots == 10
+    assert from_archive.trajectories == from_files.trajectories
+    assert from_archive.published_bytes == from_files.published_bytes
@@ -0,0 +1,114 @@
+import threading
+import time
+
+from conftest import load_feed_message, vehicle_positions
+
+from transitfeedhub_ingestor.helpers.BatchSink import BatchSink, s3_publisher
+from transitfeedhub_ingestor.helpers.s3Uploader import BackgroundUploader
+from transitfeedhub_ingestor.helpers.Shutdown import drain, restore_spill, save_until
+from transitfeedhub_ingestor.helpers.VehiclePositionFeed import VehiclePositionFeed
+
+
+class SlowS3Client:
+    """In-memory stand-in for an S3 client taking latency seconds per put."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.objects: dict[tuple[str, str], bytes] = {}
+        self.lock = threading.Lock()
+
+    def put_object(self, Bucket, Key, Body):
+        time.sleep(self.latency)
+        with self.lock:
+            self.objects[(Bucket, Key)] = Body.read()
+
+
+def running_feed(snapshot_paths, uploader: BackgroundUploader) -> VehiclePositionFeed:
+    feed = VehiclePositionFeed(url="", agency="MBTA", file_path="/MBTA", s3_bucket="TestBucket", uploader=uploader)
+    for path in snapshot_paths[:2]:
+        feed.reconcile(vehicle_positions(load_feed_message(path)))
+    return feed
+
+
+def test_drain_saves_open_trajectories(tmp_path, snapshot_paths):
+    client = SlowS3Client()
+    uploader = BackgroundUploader(str(tmp_path / "spool"), s3_client=client)
+    feed = running_feed(snapshot_paths, uploader)
+    trajectories = sum(len(entity) > 1 for entity in feed.entities)
+    open_entities = len(feed.entities)
+
+    report = drain([feed], uploader, deadline=10, spill_dir=str(tmp_path / "spill"), spill_reserve=1)
+    assert report.saved == trajectories
+    assert report.dropped == open_entities - trajectories > 0
+    assert report.spilled == 0
+    assert report.uploaded == len(client.objects) == trajectories > 0
+    assert report.spooled == 0
+    assert len(feed.entities) == 0
+    assert not (tmp_path / "spill").exists()
+    uploader.close()
+
+
+def test_drain_spills_what_is_left_at_the_deadline(tmp_path, snapshot_paths):
+    # no time to save anything, every open trajectory is spilled and restored on the next start
+    uploader = BackgroundUploader(str(tmp_path / "spool"), s3_client=SlowS3Client())
+    feed = running_feed(snapshot_paths, uploader)
+    lengths = {entity.entity_id: len(entity) for entity in feed.entities}
+
+    report = drain([feed], uploader, deadline=0, spill_dir=str(tmp_path / "spill"))
+    assert report.saved == 0
+    assert report.spilled == len(lengths)
+    uploader.close()
+
+    restarted = VehiclePositionFeed(url="", agency="MBTA", file_path="/MBTA", s3_bucket="TestBucket")
+    assert restore_spill([restarted], str(tmp_path / "spill")) == len(lengths)
+    assert {entity.entity_id: len(entity) for entity in restarted.entities} == lengths
+    # the spill is consumed by the restore
+    assert restore_spill([restarted], str(tmp_path / "spill")) == 0
+
+
+def test_drain_spools_uploads_left_at_the_deadline(tmp_path, snapshot_paths):
+    client = SlowS3Client(latency=0.05)
+    uploader = BackgroundUploader(str(tmp_path / "spool"), workers=2, s3_client=client)
+    feed = running_feed(snapshot_paths, uploader)
+    trajectories = sum(len(entity) > 1 for entity in feed.entities)
+
+    report = drain([feed], uploader, deadline=0.5, spill_dir=str(tmp_path / "spill"), spill_reserve=0.2)
+    assert report.spilled == 0
+    assert report.spooled > 0
+    # objects still uploading when time was up are spooled too, every trajectory is on S3 or on disk
+    assert report.uploaded + report.spooled >= trajectories
+    uploader.close(timeout=0)
+
+    client.latency = 0.0
+    replayed = BackgroundUploader(str(tmp_path / "spool"), s3_client=client)
+    assert replayed.replay_spool() == report.spooled
+    assert replayed.close(timeout=30)
+    assert len(client.objects) == trajectories
+
+
+def test_drain_deadline_runs_from_the_signal(tmp_path, snapshot_paths):
+    # the grace period was used up before the drain started, e.g. waiting for in-flight cycles
+    uploader = BackgroundUploader(str(tmp_path / "spool"), s3_client=SlowS3Client())
+    feed = running_feed(snapshot_paths, uploader)
+    open_entities = len(feed.entities)
+
+    started = time.monotonic() - 10
+    assert save_until(started, 10, spill_reserve=1) == started + 9
+    report = drain([feed], uploader, deadline=10, spill_dir=str(tmp_path / "spill"), spill_reserve=1, started=started)
+    assert report.saved == 0
+    assert report.spilled == open_entities
+    assert report.seconds >= 10
+    uploader.close(timeout=0)
+
+
+def test_drain_bounds_batch_submits(tmp_path, snapshot_paths):
+    # no upload worker and a full queue, every submit would wait its whole submit_timeout
+    uploader = BackgroundUploader(str(tmp_path / "spool"), workers=0, max_queue=1, submit_timeout=30)
+    feed = running_feed(snapshot_paths, uploader)
+    feed.batch_sink = BatchSink(s3_publisher("TestBucket", uploader), max_count=1)
+
+    start = time.monotonic()
+    report = drain([feed], uploader, deadline=1, spill_dir=str(tmp_path / "spill"), spill_reserve=0.5)
+    assert time.monotonic() - start < 5
+    assert report.spooled > 0
+    uploader.close(timeout=0)
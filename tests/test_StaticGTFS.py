@@ -0,0 +1,118 @@
+import json
+import os
+import zipfile
+
+from conftest import load_feed_message, vehicle_positions
+
+from transitfeedhub_ingestor.helpers.Entity import Entity
+from transitfeedhub_ingestor.helpers.MFJSONWriter import MFJSONWriter
+from transitfeedhub_ingestor.helpers.StaticGTFS import StaticGTFS
+
+
+def write_gtfs(path: str, trips: list[tuple[str, str]], stops: list[str]):
+    # a static feed zipped with its enclosing directory, one route per (trip_id, route_id) and one shape per trip
+    routes = sorted({route_id for _, route_id in trips})
+    with zipfile.ZipFile(path, "w") as archive:
+        archive.writestr(
+            "gtfs/routes.txt",
+            "route_id,agency_id,route_short_name,route_long_name,route_type\n"
+            + "".join(f"{r},1,{r}S,Route {r},3\n" for r in routes),
+        )
+        archive.writestr(
+            "gtfs/trips.txt",
+            "route_id,service_id,trip_id,trip_headsign,shape_id\n"
+            + "".join(f"{r},weekday,{t},To {t},shape-{t}\n" for t, r in trips),
+        )
+        # with a byte order mark, like many published feeds
+        archive.writestr(
+            "gtfs/stops.txt",
+            "﻿stop_id,stop_name,stop_lat,stop_lon\n" + "".join(f'{s},"Stop {s}, Café",42,-71\n' for s in stops),
+        )
+        archive.writestr(
+            "gtfs/shapes.txt",
+            "shape_id,shape_pt_lat,shape_pt_lon,shape_pt_sequence\n"
+            + "".join(f"shape-{t},42.{i},-71.{i},{2 - i}\n" for t, _ in trips for i in range(2)),
+        )
+
+
+def test_static_gtfs_lookups_and_cache(tmp_path, monkeypatch):
+    path = str(tmp_path / "agency.zip")
+    write_gtfs(path, [("t1", "Red"), ("t2", "1"), ("t1", "dup")], ["70061", "place-alfcl"])
+    gtfs = StaticGTFS.load(path, str(tmp_path / "cache"))
+
+    assert len(gtfs.routes) == 3
+    # a repeated trip id keeps its first row
+    assert len(gtfs.trips) == 2
+    properties = {"route_id": "", "trip_id": "t1"}
+    gtfs.enrich(properties)  # pyright: ignore[reportArgumentType]
+    assert properties == {
+        "route_id": "",
+        "trip_id": "t1",
+        "trip_headsign": "To t1",
+        "shape_id": "shape-t1",
+        "route_short_name": "RedS",
+        "route_long_name": "Route Red",
+    }
+    assert gtfs.stop_name("place-alfcl") == "Stop place-alfcl, Café"
+    assert gtfs.stop_name("70061") is gtfs.stop_name("70061")
+    assert gtfs.stop_name("missing") == ""
+    assert gtfs.shapes.find("missing") == -1
+    shape = gtfs.shape("shape-t2")
+    assert shape is not None
+    assert shape.tolist() == [-71.1, 42.1, -71.0, 42.0]
+    del shape
+    gtfs.close()
+
+    # later starts map the cache instead of parsing the zip
+    def fail_build(gtfs_path: str, cache_path: str):
+        raise AssertionError(gtfs_path)
+
+    with monkeypatch.context() as patch:
+        patch.setattr(StaticGTFS, "build", fail_build)
+        gtfs = StaticGTFS.load(path, str(tmp_path / "cache"))
+        assert gtfs.stop_name("70061") == "Stop 70061, Café"
+        gtfs.close()
+
+    # a new version of the feed or a corrupt cache is rebuilt
+    write_gtfs(path, [("t3", "Blue")], ["70038"])
+    gtfs = StaticGTFS.load(path, str(tmp_path / "cache"))
+    assert gtfs.trips.find("t1") == -1
+    assert gtfs.stop_name("70038") == "Stop 70038, Café"
+    gtfs.close()
+    with open(gtfs.path, "r+b") as f:
+        f.write(b"garbage!")
+    gtfs = StaticGTFS.load(path, str(tmp_path / "cache"))
+    assert gtfs.trips.find("t3") == 0
+    gtfs.close()
+
+
+def test_mfjsonwriter_enriches_from_static_gtfs(tmp_path, snapshot_paths):
+    snapshots = [vehicle_positions(load_feed_message(path)) for path in snapshot_paths[:10]]
+    first = next(e for e in snapshots[0] if e.trip.trip_id and e.stop_id)
+    entity = Entity(first)
+    for snapshot in snapshots[1:]:
+        match = next((e for e in snapshot if e.vehicle.id == first.vehicle.id), None)
+        if match and match.timestamp != entity.timestamps[-1]:
+            entity.update(match)
+    path = str(tmp_path / "agency.zip")
+    write_gtfs(path, [(first.trip.trip_id, first.trip.route_id)], [first.stop_id])
+    gtfs = StaticGTFS.load(path, str(tmp_path / "cache"))
+
+    writer = MFJSONWriter(gtfs=gtfs)
+    data = writer.write(entity)
+    expected = entity.toMFJSONDict(gtfs)
+    assert json.loads(data) == expected
+    assert data == json.dumps(expected, separators=(",", ":")).encode("ascii")
+    assert MFJSONWriter(compact=False, gtfs=gtfs).write(entity) == entity.toMFJSON(gtfs).encode("utf-8")
+
+    (feature,) = json.loads(data)["features"]
+    assert feature["properties"]["route_long_name"] == f"Route {first.trip.route_id}"
+    assert feature["properties"]["trip_headsign"] == f"To {first.trip.trip_id}"
+    stop_names = feature["temporalProperties"][0]["stop_name"]["values"]
+    assert len(stop_names) == len(entity)
+    assert stop_names[0] == f"Stop {first.stop_id}, Café"
+    # stops missing from the static feed are left blank
+    assert all(name == "" for name, stop_id in zip(stop_names, entity.stop_id) if stop_id != first.stop_id)
+    # the entity itself carries nothing of the static feed
+    assert "trip_headsign" not in entity.properties()
+    assert os.listdir(tmp_path / "cache") == ["agency.gtfscache"]
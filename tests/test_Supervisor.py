@@ -0,0 +1,128 @@
+import http.server
+import threading
+import time
+
+from transitfeedhub_ingestor.helpers.Metrics import MetricsRegistry
+from transitfeedhub_ingestor.helpers.Supervisor import Supervisor, WorkerReport, shard
+
+
+def test_shard_balances_costs():
+    assert shard([1.0] * 5, 2) == [[0, 2, 4], [1, 3]]
+    assert shard([5.0, 1.0, 1.0, 1.0, 1.0, 1.0], 2) == [[0], [1, 2, 3, 4, 5]]
+    assert shard([3.0, 3.0, 2.0, 2.0, 2.0], 2) == [[0, 2, 4], [1, 3]]
+
+
+def test_supervisor_rebalances_by_cost(monkeypatch):
+    config = [{"url": "", "agency": f"A{i}", "s3_bucket": "B"} for i in range(4)]
+    supervisor = Supervisor(config, workers=2)
+    started: list[tuple[int, list[int]]] = []
+    stopped: list[int] = []
+    monkeypatch.setattr(supervisor, "_start", lambda worker: started.append((worker.index, list(worker.feeds))))
+    monkeypatch.setattr(supervisor, "_stop_workers", lambda workers: stopped.extend(w.index for w in workers))
+    assert [worker.feeds for worker in supervisor.workers] == [[0, 2], [1, 3]]
+
+    # no costs observed yet
+    assert supervisor.rebalance() is False
+    supervisor.costs = {0: 0.4, 1: 0.1, 2: 0.4, 3: 0.1}
+    assert supervisor.rebalance() is True
+    assert sorted(worker.feeds for worker in supervisor.workers) == [[0, 1], [2, 3]]
+    # every moved worker is stopped before any is started
+    assert stopped == [0, 1]
+    assert [index for index, _ in started] == [0, 1]
+
+    # already balanced
+    assert supervisor.rebalance() is False
+    assert supervisor.rebalances == 1
+
+
+def test_supervisor_backs_off_a_crash_looping_worker(monkeypatch):
+    class CrashedProcess:
+        pid = 1
+        exitcode = 1
+
+        def is_alive(self):
+            return False
+
+    def start(worker):
+        worker.process = CrashedProcess()
+        worker.started = time.monotonic()
+        worker.restart_at = None
+
+    supervisor = Supervisor([{"url": "", "agency": "A", "s3_bucket": "B"}], restart_backoff=1.0, min_uptime=30.0)
+    monkeypatch.setattr(supervisor, "_start", start)
+    worker = supervisor.workers[0]
+    delays: list[float] = []
+    for _ in range(4):
+        start(worker)
+        # reports from the short lived worker do not reset the backoff
+        supervisor._record(WorkerReport(0, 1, {}, {}))
+        supervisor._check_workers()
+        assert worker.restart_at is not None
+        delays.append(round(worker.restart_at - worker.started))
+    assert delays == [1, 2, 4, 8]
+
+    # a worker that ran for min_uptime starts over
+    start(worker)
+    worker.started -= 30.0
+    supervisor._check_workers()
+    assert worker.failures == 1
+    assert worker.restart_at is not None
+    assert round(worker.restart_at - worker.started - 30.0) == 1
+
+
+def test_supervisor_restarts_crashed_worker(tmp_path, snapshot_paths):
+    with open(snapshot_paths[0], "rb") as f:
+        payload = f.read()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):  # noqa: A002
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    config = [
+        {"url": f"http://127.0.0.1:{server.server_address[1]}/vp.pb", "agency": "MBTA", "s3_bucket": "B", "timeout": 1},
+        # nothing listens on port 1, the request error raises SystemExit in its worker
+        {"url": "http://127.0.0.1:1/vp.pb", "agency": "DOWN", "s3_bucket": "B", "timeout": 1},
+    ]
+    metrics = MetricsRegistry()
+    supervisor = Supervisor(
+        config,
+        workers=2,
+        metrics=metrics,
+        report_interval=0.2,
+        restart_backoff=0.1,
+        spool_dir=str(tmp_path / "spool"),
+        drain_deadline=1.0,
+        spill_dir=str(tmp_path / "spill"),
+    )
+    thread = threading.Thread(target=supervisor.run)
+    thread.start()
+    try:
+        deadline = time.monotonic() + 60
+        while time.monotonic() < deadline:
+            health = supervisor.health()
+            if health["workers"][1]["restarts"] >= 1 and health["feeds"].get("0", {}).get("cycles", 0) >= 2:
+                break
+            time.sleep(0.2)
+    finally:
+        supervisor.stop()
+        thread.join()
+        server.shutdown()
+
+    health = supervisor.health()
+    assert health["workers"][1]["restarts"] >= 1
+    # the healthy feed kept running in its own worker
+    assert health["workers"][0]["restarts"] == 0
+    assert health["feeds"]["0"]["agency"] == "MBTA"
+    assert health["feeds"]["0"]["entities"] > 0
+    assert 'transitfeedhub_entities{feed="MBTA"}' in metrics.render()
+    assert not any(worker["alive"] for worker in health["workers"])
+    # the open trajectories of the healthy feed were spilled by its worker within the drain deadline
+    assert (tmp_path / "spill" / "MBTA").is_dir()
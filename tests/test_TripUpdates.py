@@ -0,0 +1,91 @@
+import json
+
+from conftest import FakeSession, load_feed_message, make_response
+
+from transitfeedhub_ingestor.helpers.BatchSink import BatchSink, memory_publisher
+from transitfeedhub_ingestor.helpers.FeedDecoder import FeedDecoder
+from transitfeedhub_ingestor.helpers.TripUpdates import TripUpdateAccumulator
+from transitfeedhub_ingestor.helpers.VehiclePositionFeed import VehiclePositionFeed
+from transitfeedhub_ingestor.protobuf import gtfs_realtime_pb2
+
+
+def combined_payload(path: str, trips: dict[str, int]) -> bytes:
+    # a vehicle positions snapshot plus a trip update predicting the given delay for every trip
+    feed = load_feed_message(path)
+    for index, (trip_id, delay) in enumerate(trips.items()):
+        entity = feed.entity.add()
+        entity.id = f"trip-{trip_id}"
+        trip_update = entity.trip_update
+        trip_update.trip.trip_id = trip_id
+        trip_update.trip.route_id = "Red"
+        trip_update.trip.start_date = "20250502"
+        stop_time = trip_update.stop_time_update.add()
+        stop_time.stop_sequence = index + 1
+        stop_time.stop_id = f"stop-{index}"
+        stop_time.arrival.delay = delay
+        stop_time.arrival.time = feed.header.timestamp + delay
+    return feed.SerializeToString()
+
+
+def test_combined_feed_dispatches_trip_updates(snapshot_paths):
+    payloads = [
+        combined_payload(snapshot_paths[0], {"a": 0, "b": 30}),
+        combined_payload(snapshot_paths[1], {"a": 60, "b": 30}),
+        combined_payload(snapshot_paths[2], {"b": 90}),
+    ]
+    objects: dict[str, bytes] = {}
+    accumulator = TripUpdateAccumulator()
+    sink = BatchSink(memory_publisher(objects), max_count=1)
+    VPFeed = VehiclePositionFeed(
+        url="",
+        agency="MBTA",
+        file_path="/MBTA",
+        s3_bucket="TestBucket",
+        batch_sink=sink,
+        decoder=FeedDecoder(minimal=True, keep=(accumulator.field,)),
+        accumulators=[accumulator],
+    )
+    VPFeed.session = FakeSession([make_response(200, payload) for payload in payloads])
+    for _ in payloads:
+        VPFeed.consume_pb()
+
+    # vehicles are still reconciled from the same payloads
+    assert VPFeed.creates > 0
+    assert VPFeed.updates > 0
+    # trip a left the feed with the third payload
+    (name,) = (name for name in objects if "/trip_update/" in name)
+    assert name.startswith("MBTA/trip_update/")
+    assert name.split("/")[3] == "Red"
+    (feature,) = json.loads(objects[name])["features"]
+    assert feature["geometry"] is None
+    properties = feature["properties"]
+    assert properties["trip_id"] == "a"
+    assert properties["delay"] == [0, 60]
+    assert properties["stop_id"] == ["stop-0", "stop-0"]
+    assert len(properties["datetimes"]) == 2
+    assert set(accumulator.series) == {("b", "20250502")}
+
+    VPFeed.drain_accumulators()
+    sink.flush()
+    series = [json.loads(objects[name])["features"][0]["properties"] for name in objects if "/trip_update/" in name]
+    assert sorted(p["trip_id"] for p in series) == ["a", "b"]
+    assert next(p for p in series if p["trip_id"] == "b")["delay"] == [30, 30, 90]
+    assert accumulator.published == 2
+
+
+def test_trip_update_accumulator_skips_repeated_predictions():
+    trip_update = gtfs_realtime_pb2.TripUpdate()
+    trip_update.trip.trip_id = "a"
+    trip_update.timestamp = 100
+    trip_update.delay = 45
+    published: list[tuple[bytes, str]] = []
+    accumulator = TripUpdateAccumulator()
+    accumulator.accumulate([trip_update], 1, lambda feature, route_id: published.append((feature, route_id)))
+    accumulator.accumulate([trip_update], 2, lambda feature, route_id: published.append((feature, route_id)))
+    assert accumulator.observations == 1
+    assert accumulator.unchanged == 1
+
+    # a series of a single prediction is dropped like a single point trajectory
+    accumulator.accumulate([], 3, lambda feature, route_id: published.append((feature, route_id)))
+    assert published == []
+    assert accumulator.series == {}
@@ -1,4 +1,11 @@
-from transitfeedhub_ingestor.helpers.VehiclePositionFeed import VehiclePositionFeed
+import datetime
+
+from conftest import FakeSession, load_feed_message, make_response, vehicle_positions
+
+from transitfeedhub_ingestor.helpers.Entity import Entity, SegmentPolicy
+from transitfeedhub_ingestor.helpers.IngestFilter import IngestFilter
+from transitfeedhub_ingestor.helpers.VehiclePositionFeed import VehiclePositionFeed, read_header_timestamp
+from transitfeedhub_ingestor.protobuf import gtfs_realtime_pb2
 
 
 def test_vehiclepositionfeed():
@@ -11,7 +18,7 @@ def test_vehiclepositionfeed():
     assert VPFeed.url == feed_url
     assert VPFeed.agency == agency_name
     assert VPFeed.file_path == file_path
-    assert VPFeed.entities == []
+    assert len(VPFeed.entities) == 0
     assert VPFeed.headers is None
     assert VPFeed.query_params is None
     assert VPFeed.s3_bucket == s3_bucketname
@@ -37,3 +44,141 @@ def test_vehiclepositionfeed_updatetimeout():
 
     VPFeed.updatetimeout(45)
     assert VPFeed.timeout == 45
+
+
+def test_vehiclepositionfeed_consume_pb_reconcile(monkeypatch, snapshot_paths):
+    VPFeed = VehiclePositionFeed(url="", agency="MBTA", file_path="/MBTA", s3_bucket="TestBucket")
+    saved: list[str] = []
+    monkeypatch.setattr(
+        Entity, "savetos3", lambda self, bucket, file_path, uploader=None, writer=None: saved.append(self.entity_id)
+    )
+
+    snapshots = [vehicle_positions(load_feed_message(path)) for path in snapshot_paths[:3]]
+    for feed_entities in snapshots:
+        monkeypatch.setattr(VPFeed, "get_entities", lambda feed_entities=feed_entities: feed_entities)
+        VPFeed.consume_pb()
+
+    last_ids = {e.vehicle.id for e in snapshots[-1]}
+    assert VPFeed.entities.ids() == last_ids
+    for feed_entity in snapshots[-1]:
+        entity = VPFeed.find_entity(feed_entity.vehicle.id)
+        assert entity is not None
+        assert entity.updated_at[-1] == datetime.datetime.fromtimestamp(feed_entity.timestamp).isoformat()
+    # only vehicles that were tracked can be saved out
+    seen_ids = {e.vehicle.id for feed_entities in snapshots for e in feed_entities}
+    assert saved
+    assert set(saved) <= seen_ids
+
+
+def test_read_header_timestamp(snapshot_paths):
+    with open(snapshot_paths[0], "rb") as f:
+        content = f.read()
+    assert read_header_timestamp(content) == load_feed_message(snapshot_paths[0]).header.timestamp
+    assert read_header_timestamp(b"") is None
+
+
+def test_vehiclepositionfeed_conditional_fetch(snapshot_paths):
+    with open(snapshot_paths[0], "rb") as f:
+        first = f.read()
+    with open(snapshot_paths[1], "rb") as f:
+        second = f.read()
+    VPFeed = VehiclePositionFeed(url="", agency="MBTA", file_path="/MBTA", s3_bucket="TestBucket")
+    session = FakeSession([
+        make_response(200, first, {"ETag": '"v1"', "Last-Modified": "Fri, 02 May 2025 01:10:04 GMT"}),
+        make_response(304),
+        make_response(200, first, {"ETag": '"v1b"'}),
+        make_response(200, second, {"ETag": '"v2"'}),
+    ])
+    VPFeed.session = session
+
+    assert list(VPFeed.get_entities() or []) == vehicle_positions(load_feed_message(snapshot_paths[0]))
+    # 304 Not Modified
+    assert VPFeed.get_entities() is None
+    assert session.sent_headers[1]["If-None-Match"] == '"v1"'
+    assert session.sent_headers[1]["If-Modified-Since"] == "Fri, 02 May 2025 01:10:04 GMT"
+    # same FeedHeader timestamp served again
+    assert VPFeed.get_entities() is None
+    assert list(VPFeed.get_entities() or []) == vehicle_positions(load_feed_message(snapshot_paths[1]))
+    assert session.sent_headers[3]["If-None-Match"] == '"v1b"'
+
+    assert VPFeed.skipped_not_modified == 1
+    assert VPFeed.skipped_unchanged == 1
+    assert VPFeed.skipped_cycles == 2
+
+
+def test_vehiclepositionfeed_rolling_segments(monkeypatch):
+    saved: list[Entity] = []
+    monkeypatch.setattr(
+        Entity, "savetos3", lambda self, bucket, file_path, uploader=None, writer=None: saved.append(self)
+    )
+    VPFeed = VehiclePositionFeed(
+        url="", agency="MBTA", file_path="/MBTA", s3_bucket="TestBucket", segments=SegmentPolicy(max_points=5)
+    )
+    for i in range(13):
+        vp = gtfs_realtime_pb2.VehiclePosition()
+        vp.vehicle.id = "y1234"
+        vp.timestamp = 1000 + 30 * i
+        vp.position.longitude = -71.06 + 0.001 * i
+        vp.position.latitude = 42.36
+        VPFeed.reconcile([vp])
+
+    assert VPFeed.segments_cut == 3
+    assert [list(entity.timestamps) for entity in saved] == [
+        [1000, 1030, 1060, 1090, 1120],
+        [1120, 1150, 1180, 1210, 1240],
+        [1240, 1270, 1300, 1330, 1360],
+    ]
+    # the vehicle continues from the last point of the saved segment
+    entity = VPFeed.find_entity("y1234")
+    assert entity is not None
+    assert entity.coordinates[0] == saved[-1].coordinates[-1]
+    assert list(entity.timestamps) == [1360]
+
+
+def test_vehiclepositionfeed_memory_budget_cuts_oldest_segments(monkeypatch, snapshot_paths):
+    monkeypatch.setattr(Entity, "savetos3", lambda self, bucket, file_path, uploader=None, writer=None: None)
+    snapshots = [vehicle_positions(load_feed_message(path)) for path in snapshot_paths[:30]]
+    budget = 2 * len(snapshots[0]) * Entity.ROW_BYTES
+
+    VPFeed = VehiclePositionFeed(
+        url="", agency="MBTA", file_path="/MBTA", s3_bucket="TestBucket", segments=SegmentPolicy(memory_budget=budget)
+    )
+    for feed_entities in snapshots:
+        VPFeed.reconcile(feed_entities)
+        assert sum(entity.nbytes for entity in VPFeed.entities) <= budget
+
+    assert VPFeed.budget_cuts == VPFeed.segments_cut > 0
+
+
+def test_vehiclepositionfeed_skips_unchanged_vehicles(monkeypatch, snapshot_paths):
+    monkeypatch.setattr(Entity, "savetos3", lambda self, bucket, file_path, uploader=None, writer=None: None)
+    VPFeed = VehiclePositionFeed(url="", agency="MBTA", file_path="/MBTA", s3_bucket="TestBucket")
+    feed_entities = vehicle_positions(load_feed_message(snapshot_paths[0]))
+    VPFeed.reconcile(feed_entities)
+    VPFeed.reconcile(feed_entities)
+
+    assert VPFeed.updates == 0
+    assert VPFeed.unchanged_vehicles == len(VPFeed.entities) > 0
+
+    # every vehicle updated by the next snapshot is recognised as unchanged when it is repeated
+    second = vehicle_positions(load_feed_message(snapshot_paths[1]))
+    VPFeed.reconcile(second)
+    assert VPFeed.updates > 0
+    skipped = VPFeed.unchanged_vehicles
+    VPFeed.reconcile(second)
+    assert VPFeed.unchanged_vehicles - skipped == len(VPFeed.entities)
+
+
+def test_vehiclepositionfeed_ingest_filter(monkeypatch, snapshot_paths):
+    monkeypatch.setattr(Entity, "savetos3", lambda self, bucket, file_path, uploader=None, writer=None: None)
+    ingest_filter = IngestFilter(routes={"Red", "Orange"})
+    VPFeed = VehiclePositionFeed(
+        url="", agency="MBTA", file_path="/MBTA", s3_bucket="TestBucket", ingest_filter=ingest_filter
+    )
+    for path in snapshot_paths[:3]:
+        VPFeed.reconcile(vehicle_positions(load_feed_message(path)))
+
+    # filtered vehicles never become entities and are counted on every snapshot they are seen in
+    assert len(VPFeed.entities) > 0
+    assert all(entity.route_id in {"Red", "Orange"} for entity in VPFeed.entities)
+    assert VPFeed.filtered_vehicles == ingest_filter.rejected_routes > 2 * len(VPFeed.entities)
@@ -1,6 +1,7 @@
 import requests
+from conftest import load_feed_message, vehicle_positions
 
-from transitfeedhub_ingestor.helpers.Entity import Carriage
+from transitfeedhub_ingestor.helpers.Entity import CARRIAGE_NO_DATA, Carriage, Entity
 from transitfeedhub_ingestor.protobuf import gtfs_realtime_pb2
 
 
@@ -24,8 +25,57 @@ def test_carriage():
     carriage = Carriage(carriage_details)
     assert carriage.label == carriage_details.label
     assert carriage.carriage_sequence == carriage_details.carriage_sequence
-    assert carriage.occupancy_status == [carriage_details.occupancy_status]
+    assert list(carriage.occupancy_status) == [carriage_details.occupancy_status]
     new_carriage_details: object = green_line[1][1]
     carriage.Update(new_carriage_details)
-    assert carriage.occupancy_status != [carriage_details.occupancy_status]
-    assert carriage.occupancy_status == [carriage_details.occupancy_status, new_carriage_details.occupancy_status]
+    assert list(carriage.occupancy_status) != [carriage_details.occupancy_status]
+    assert list(carriage.occupancy_status) == [carriage_details.occupancy_status, new_carriage_details.occupancy_status]
+
+
+def make_train(timestamp: int, cars: list[tuple[str, int]]) -> gtfs_realtime_pb2.VehiclePosition:
+    vp = gtfs_realtime_pb2.VehiclePosition()
+    vp.vehicle.id = "G-10001"
+    vp.timestamp = timestamp
+    for sequence, (label, occupancy) in enumerate(cars, start=1):
+        details = vp.multi_carriage_details.add()
+        details.label = label
+        details.carriage_sequence = sequence
+        details.occupancy_status = occupancy
+    return vp
+
+
+def test_carriage_series_follow_consist_changes():
+    entity = Entity(make_train(0, [("3800", 1), ("3801", 2)]))
+    # 3801 missing from one observation
+    entity.update(make_train(30, [("3800", 1)]))
+    # 3900 coupled mid-trip, 3800 reported twice
+    entity.update(make_train(60, [("3800", 2), ("3801", 2), ("3900", 0), ("3800", 5)]))
+    # 3800 uncoupled
+    entity.update(make_train(90, [("3801", 3), ("3900", 1)]))
+
+    no_data = CARRIAGE_NO_DATA
+    assert [c.label for c in entity.carriages] == ["3800", "3801", "3900"]
+    assert [list(c.occupancy_status) for c in entity.carriages] == [
+        [1, 1, 2, no_data],
+        [2, no_data, 2, 3],
+        [no_data, no_data, 0, 1],
+    ]
+    assert all(len(c.occupancy_status) == len(entity) for c in entity.carriages)
+
+    temporal_properties = entity.toMFJSONDict()["features"][0]["temporalProperties"][0]
+    assert temporal_properties["carriage_3_3900"]["values"] == [no_data, no_data, 0, 1]
+
+
+def test_carriage_series_stay_aligned_over_snapshots(snapshot_paths):
+    entities: dict[str, Entity] = {}
+    for path in snapshot_paths[:40]:
+        for vp in vehicle_positions(load_feed_message(path)):
+            entity = entities.get(vp.vehicle.id)
+            if entity is None:
+                entities[vp.vehicle.id] = Entity(vp)
+            elif entity.timestamps[-1] != vp.timestamp:
+                entity.update(vp)
+    with_carriages = [e for e in entities.values() if e.carriages]
+    assert with_carriages
+    for entity in with_carriages:
+        assert all(len(c.occupancy_status) == len(entity) for c in entity.carriages)
@@ -0,0 +1,36 @@
+import pytest
+
+from transitfeedhub_ingestor.helpers.geometry import bearing_delta, distance_m, simplify_mask
+
+
+def test_distance_m():
+    # one thousandth of a degree of latitude is about 111 m
+    assert distance_m(-71.06, 42.36, -71.06, 42.361) == pytest.approx(111.2, abs=0.1)
+    assert distance_m(-71.06, 42.36, -71.06, 42.36) == 0
+
+
+def test_bearing_delta():
+    assert bearing_delta(350, 10) == 20
+    assert bearing_delta(10, 350) == 20
+    assert bearing_delta(90, 270) == 180
+
+
+def test_simplify_mask_constant_speed_line():
+    longitude = [-71.06 + i * 0.001 for i in range(10)]
+    latitude = [42.36] * 10
+    timestamps = [i * 30 for i in range(10)]
+    assert simplify_mask(longitude, latitude, timestamps, 5) == [True] + [False] * 8 + [True]
+
+
+def test_simplify_mask_keeps_stops_and_anchors():
+    # on a straight line, but held at the fifth point for two minutes
+    longitude = [-71.06 + min(i, 4) * 0.001 + max(i - 8, 0) * 0.001 for i in range(13)]
+    latitude = [42.36] * 13
+    timestamps = [i * 30 for i in range(13)]
+    keep = simplify_mask(longitude, latitude, timestamps, 5)
+    assert keep[4] and keep[8]
+    assert sum(keep) == 4
+
+    keep = simplify_mask(longitude, latitude, timestamps, 5, anchors=[2])
+    assert keep[2]
+    assert sum(keep) == 5
@@ -0,0 +1,126 @@
+import threading
+
+import pytest
+from botocore.exceptions import ClientError
+
+from transitfeedhub_ingestor.helpers.s3Uploader import BackgroundUploader, upload_file
+
+
+class FlakyS3Client:
+    """In-memory stand-in for an S3 client that fails the first put of every key."""
+
+    def __init__(self, failures_per_key: int = 0):
+        self.failures_per_key = failures_per_key
+        self.attempts: dict[str, int] = {}
+        self.objects: dict[tuple[str, str], bytes] = {}
+        self.lock = threading.Lock()
+
+    def put_object(self, Bucket, Key, Body):
+        with self.lock:
+            self.attempts[Key] = self.attempts.get(Key, 0) + 1
+            if self.attempts[Key] <= self.failures_per_key:
+                raise ClientError({"Error": {"Code": "SlowDown", "Message": "Slow Down"}}, "PutObject")
+            self.objects[(Bucket, Key)] = Body.read()
+
+
+def test_upload_file_with_client():
+    client = FlakyS3Client()
+    assert upload_file("data", "TestBucket", "MBTA/a.mfjson", s3_client=client) is True
+    assert client.objects[("TestBucket", "MBTA/a.mfjson")] == b"data"
+    assert upload_file("data", "TestBucket", "MBTA/b.mfjson", s3_client=FlakyS3Client(1)) is False
+
+
+def test_backgrounduploader_retries(tmp_path):
+    client = FlakyS3Client(failures_per_key=2)
+    uploader = BackgroundUploader(str(tmp_path), workers=2, backoff=0.001, s3_client=client)
+    for i in range(10):
+        assert uploader.submit(f"trajectory {i}", "TestBucket", f"MBTA/20250502/1/{i}.mfjson")
+    assert uploader.close(timeout=10)
+
+    assert len(client.objects) == 10
+    assert uploader.uploaded == 10
+    assert uploader.retries == 20
+    assert uploader.spooled == 0
+
+
+def test_backgrounduploader_spools_and_replays(tmp_path):
+    client = FlakyS3Client(failures_per_key=4)
+    uploader = BackgroundUploader(str(tmp_path), workers=1, max_attempts=2, backoff=0.001, s3_client=client)
+    uploader.submit(b"trajectory", "TestBucket", "MBTA/20250502/1/a.mfjson")
+    assert uploader.flush(timeout=10)
+
+    assert uploader.spooled == 1
+    spooled = tmp_path / "TestBucket" / "MBTA" / "20250502" / "1" / "a.mfjson"
+    assert spooled.read_bytes() == b"trajectory"
+
+    # the first replay fails again and keeps the spool file, the second uploads it and removes it
+    assert uploader.replay_spool() == 1
+    assert uploader.flush(timeout=10)
+    assert uploader.replay_spool() == 1
+    assert uploader.close(timeout=10)
+    assert client.objects[("TestBucket", "MBTA/20250502/1/a.mfjson")] == b"trajectory"
+    assert not spooled.exists()
+
+
+def test_backgrounduploader_backpressure_spools_when_full(tmp_path):
+    release = threading.Event()
+
+    class BlockedClient(FlakyS3Client):
+        def put_object(self, Bucket, Key, Body):
+            release.wait()
+            super().put_object(Bucket, Key, Body)
+
+    client = BlockedClient()
+    uploader = BackgroundUploader(str(tmp_path), workers=1, max_queue=1, submit_timeout=0.01, s3_client=client)
+    results = [uploader.submit("x", "TestBucket", f"MBTA/{i}.mfjson") for i in range(4)]
+    release.set()
+    assert uploader.close(timeout=10)
+
+    assert results.count(False) == uploader.spooled
+    assert uploader.spooled >= 1
+    assert uploader.uploaded + uploader.spooled == 4
+
+
+def test_backgrounduploader_moto(tmp_path, monkeypatch):
+    moto = pytest.importorskip("moto")
+    boto3 = pytest.importorskip("boto3")
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+
+    with moto.mock_aws():
+        client = boto3.client("s3")
+        client.create_bucket(Bucket="TestBucket")
+        uploader = BackgroundUploader(str(tmp_path), s3_client=client)
+        uploader.submit("trajectory", "TestBucket", "MBTA/20250502/1/a.mfjson")
+        assert uploader.close(timeout=10)
+
+        body = client.get_object(Bucket="TestBucket", Key="MBTA/20250502/1/a.mfjson")["Body"].read()
+        assert body == b"trajectory"
+
+
+def test_backgrounduploader_worker_survives_unexpected_errors(tmp_path):
+    class BrokenS3Client(FlakyS3Client):
+        def put_object(self, Bucket, Key, Body):
+            if Key.endswith("broken.mfjson"):
+                raise RuntimeError(Key)
+            super().put_object(Bucket, Key, Body)
+
+    client = BrokenS3Client()
+    uploader = BackgroundUploader(str(tmp_path), workers=1, s3_client=client)
+    uploader.submit(b"trajectory", "TestBucket", "MBTA/broken.mfjson")
+    uploader.submit(b"trajectory", "TestBucket", "MBTA/a.mfjson")
+    assert uploader.close(timeout=10)
+
+    assert client.objects == {("TestBucket", "MBTA/a.mfjson"): b"trajectory"}
+
+
+def test_backgrounduploader_replay_leaves_overflow_spooled(tmp_path):
+    for i in range(3):
+        (tmp_path / "TestBucket" / "MBTA").mkdir(parents=True, exist_ok=True)
+        (tmp_path / "TestBucket" / "MBTA" / f"{i}.mfjson").write_bytes(b"trajectory")
+    # no workers, the queue of two objects stays full
+    uploader = BackgroundUploader(str(tmp_path), workers=0, max_queue=2, submit_timeout=0.01, s3_client=FlakyS3Client())
+
+    assert uploader.replay_spool() == 2
+    assert len(list((tmp_path / "TestBucket" / "MBTA").iterdir())) == 3
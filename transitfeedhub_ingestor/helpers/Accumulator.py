@@ -0,0 +1,26 @@
+from collections.abc import Callable, Iterable
+from typing import Any, Protocol
+
+# publish(feature, route_id): hands a serialized GeoJSON Feature to the sink of the feed, see
+# VehiclePositionFeed.publish_feature
+FeaturePublisher = Callable[[bytes, str], None]
+
+
+class Accumulator(Protocol):
+    """Collects one type of FeedEntity of a combined feed next to the Vehicle Positions.
+
+    VehiclePositionFeed parses every payload once, reconciles the vehicles into Entity trajectories itself and hands
+    the entities carrying field to each of its accumulators in the same cycle. Finished series are published as GeoJSON
+    Features through the batch sink or uploader of the feed, so accumulators share its scheduling, flushing and uploads.
+    """
+
+    # FeedEntity field dispatched to the accumulator, e.g. "trip_update" or "alert"
+    field: str
+
+    def accumulate(self, entities: Iterable[Any], header_timestamp: int, publish: FeaturePublisher) -> None:
+        """Applies the entities of one payload, publishing the series that ended."""
+        ...
+
+    def drain(self, publish: FeaturePublisher) -> None:
+        """Publishes every series still in flight."""
+        ...
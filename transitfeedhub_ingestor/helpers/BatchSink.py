@@ -0,0 +1,232 @@
+import gzip
+import io
+import os
+import threading
+import time
+import uuid
+from collections.abc import Callable
+from typing import Literal, Protocol
+
+from .Entity import Entity
+from .MFJSONWriter import MFJSONWriter
+from .s3Uploader import BackgroundUploader, upload_file
+from .setup_logger import logger
+from .StaticGTFS import StaticGTFS
+
+# publish(object_name, data, content_encoding)
+Publisher = Callable[[str, bytes, str | None], object]
+
+
+class PublishError(RuntimeError):
+    """Raised by a publisher when a batch could not be published, with the bucket and object name."""
+
+
+class TrajectorySink(Protocol):
+    """Receives the saved trajectories of a feed, see BatchSink and DiskSink."""
+
+    published_objects: int
+    published_trajectories: int
+    published_bytes: int
+
+    def add(self, entity: Entity, prefix: str) -> None: ...
+
+    def add_feature(self, feature: bytes, prefix: str) -> None: ...
+
+    def flush_due(self) -> None: ...
+
+    def flush(self, timeout: float | None = None) -> bool: ...
+
+
+def s3_publisher(bucket: str, uploader: BackgroundUploader | None = None) -> Publisher:
+    """Publishes batches to an S3 bucket, through the upload pool when one is given.
+
+    Without an upload pool a failed upload raises PublishError, with one a batch the pool cannot take is spooled by it.
+    """
+
+    def publish(object_name: str, data: bytes, content_encoding: str | None):
+        if uploader is not None:
+            uploader.submit(data, bucket, object_name, content_encoding)
+        elif not upload_file(data, bucket, object_name, content_encoding=content_encoding):
+            raise PublishError(bucket, object_name)
+
+    return publish
+
+
+def directory_publisher(root: str = "") -> Publisher:
+    """Publishes batches as files below root, object names are used as relative paths."""
+
+    def publish(object_name: str, data: bytes, content_encoding: str | None):
+        path = os.path.join(root, f"{object_name}.gz" if content_encoding == "gzip" else object_name)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+
+    return publish
+
+
+def memory_publisher(objects: dict[str, bytes]) -> Publisher:
+    """Publishes batches into a dict of object name to data, for replays and tests."""
+
+    def publish(object_name: str, data: bytes, content_encoding: str | None):
+        objects[object_name] = data
+
+    return publish
+
+
+class _Batch:
+    __slots__ = ("buffer", "count", "opened")
+
+    def __init__(self):
+        self.buffer = io.BytesIO()
+        self.count = 0
+        self.opened = time.monotonic()
+
+
+class BatchSink:
+    """Buffers finished trajectories per output prefix and publishes them as one object per batch.
+
+    Instead of one small object per Entity, trajectories sharing a prefix (for S3 {agency}/{YYYYMMDD}/{route_id}) are
+    appended to an in-memory batch which is published as a single multi-feature FeatureCollection or as NDJSON (one
+    Feature per line) once it reaches max_bytes, max_count or max_age seconds. A batch whose publish raises is kept
+    open, with its original age, and retried by the next flush_due or flush.
+
+    Args:
+        publish: called with (object_name, data, content_encoding) for every flushed batch
+        output_format: "featurecollection" or "ndjson"
+        max_bytes: flush a batch once its uncompressed size reaches this many bytes
+        max_count: flush a batch once it holds this many trajectories
+        max_age: flush a batch once it has been open this many seconds, checked on add and flush_due
+        gzip: gzip the published objects
+        gtfs: optional static GTFS lookup tables the trajectories are enriched from, see MFJSONWriter
+    """
+
+    def __init__(
+        self,
+        publish: Publisher,
+        output_format: Literal["featurecollection", "ndjson"] = "featurecollection",
+        max_bytes: int = 8 * 1024 * 1024,
+        max_count: int = 1000,
+        max_age: float = 300,
+        gzip: bool = False,
+        gtfs: StaticGTFS | None = None,
+    ):
+        self.publish: Publisher = publish
+        self.output_format: Literal["featurecollection", "ndjson"] = output_format
+        self.max_bytes: int = max_bytes
+        self.max_count: int = max_count
+        self.max_age: float = max_age
+        self.gzip: bool = gzip
+        self.published_objects: int = 0
+        self.published_trajectories: int = 0
+        self.published_bytes: int = 0
+        self._writer = MFJSONWriter(gtfs=gtfs)
+        self._batches: dict[str, _Batch] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def extension(self) -> str:
+        return "ndjson" if self.output_format == "ndjson" else "mfjson"
+
+    @property
+    def pending(self) -> int:
+        with self._lock:
+            return sum(batch.count for batch in self._batches.values())
+
+    def add(self, entity: Entity, prefix: str):
+        """Appends the trajectory of an entity to the batch for prefix, publishing the batch if it is full."""
+        self._add(prefix, lambda buffer: self._writer.stream_feature(entity, buffer))
+
+    def add_feature(self, feature: bytes, prefix: str):
+        """Appends an already serialized GeoJSON Feature, e.g. a trip update delay series, to the batch for prefix."""
+        self._add(prefix, lambda buffer: buffer.write(feature))
+
+    def _add(self, prefix: str, write: Callable[[io.BytesIO], object]):
+        ready: list[tuple[str, _Batch]] = []
+        with self._lock:
+            batch = self._batches.get(prefix)
+            if batch is None:
+                batch = self._batches[prefix] = _Batch()
+            elif self.output_format == "ndjson":
+                batch.buffer.write(b"\n")
+            else:
+                batch.buffer.write(b",")
+            write(batch.buffer)
+            batch.count += 1
+            if batch.count >= self.max_count or batch.buffer.tell() >= self.max_bytes:
+                ready.append((prefix, self._batches.pop(prefix)))
+            ready.extend(self._pop_expired())
+        self._publish(ready)
+
+    def flush_due(self):
+        """Publishes every batch that has been open for max_age seconds."""
+        with self._lock:
+            ready = self._pop_expired()
+        self._publish(ready)
+
+    def flush(self, timeout: float | None = None) -> bool:
+        """Publishes every open batch.
+
+        Args:
+            timeout: optional seconds publishing may take, the batches not published by then stay open
+
+        Returns:
+            True if every batch was published before the timeout, the failed ones stay open.
+        """
+        with self._lock:
+            ready = list(self._batches.items())
+            self._batches.clear()
+        if timeout is None:
+            return self._publish(ready)
+        until = time.monotonic() + timeout
+        published = True
+        for i, item in enumerate(ready):
+            if time.monotonic() >= until:
+                self._reopen(ready[i:])
+                return False
+            published = self._publish([item]) and published
+        return published
+
+    def _reopen(self, batches: list[tuple[str, _Batch]]):
+        # merges batches taken out for publishing back into the open ones
+        separator = b"\n" if self.output_format == "ndjson" else b","
+        with self._lock:
+            for prefix, batch in batches:
+                current = self._batches.get(prefix)
+                if current is not None:
+                    batch.buffer.write(separator)
+                    batch.buffer.write(current.buffer.getvalue())
+                    batch.count += current.count
+                self._batches[prefix] = batch
+
+    def _pop_expired(self) -> list[tuple[str, _Batch]]:
+        now = time.monotonic()
+        expired = [prefix for prefix, batch in self._batches.items() if now - batch.opened >= self.max_age]
+        return [(prefix, self._batches.pop(prefix)) for prefix in expired]
+
+    def _publish(self, ready: list[tuple[str, _Batch]]) -> bool:
+        # returns False if a batch failed, failed batches are reopened to be retried
+        failed: list[tuple[str, _Batch]] = []
+        for prefix, batch in ready:
+            if self.output_format == "ndjson":
+                data = batch.buffer.getvalue() + b"\n"
+            else:
+                data = b'{"type":"FeatureCollection","features":[' + batch.buffer.getvalue() + b"]}"
+            content_encoding = None
+            if self.gzip:
+                data = gzip.compress(data, mtime=0)
+                content_encoding = "gzip"
+            object_name = f"{prefix}/{uuid.uuid4()}.{self.extension}"
+            try:
+                self.publish(object_name, data, content_encoding)
+            except Exception:
+                logger.exception(f"Failed to publish batch {object_name} of {batch.count} trajectories, keeping it")
+                failed.append((prefix, batch))
+                continue
+            with self._lock:
+                self.published_objects += 1
+                self.published_trajectories += batch.count
+                self.published_bytes += len(data)
+            logger.debug(f"Published batch {object_name} of {batch.count} trajectories")
+        if failed:
+            self._reopen(failed)
+        return not failed
@@ -0,0 +1,435 @@
+import datetime
+import glob
+import json
+import operator
+import os
+import queue
+import struct
+import threading
+import time
+from array import array
+from typing import Any, BinaryIO, NamedTuple
+
+from .Entity import STOP_IDS, Carriage, Entity, RunLengthPolicy
+from .EntityStore import EntityStore
+from .setup_logger import logger
+
+OP_CREATE = 1
+OP_UPDATE = 2
+OP_EVICT = 3
+
+# payload length, cycle, wall clock time of the cycle
+_RECORD = struct.Struct("<IQd")
+_SNAPSHOT_MAGIC = b"TFHCKPT1"
+_HEADER_LENGTH = struct.Struct("<Q")
+# every column of an entity at once, in the order of Entity.COLUMNS
+_columns_of = operator.attrgetter(*Entity.COLUMNS)
+_STOP_ID_COLUMN = Entity.COLUMNS.index("_stop_id_codes")
+
+
+class CorruptSnapshotError(ValueError):
+    """Raised while loading a snapshot that is not a checkpoint snapshot or was cut short."""
+
+
+# (OP_CREATE, OP_UPDATE or OP_EVICT, entity, observations right after the op, which wrote row observations - 1)
+_Op = tuple[int, Entity, int]
+# the column arrays of an entity, in the order of Entity.COLUMNS, and (label, carriage_sequence, occupancy column)
+# of every carriage
+_Columns = tuple["tuple[array[Any], ...]", "tuple[tuple[str, int, array[int]], ...]"]
+
+
+class _Capture(NamedTuple):
+    # every entity of the store and its observations at the end of the cycle
+    entities: list[tuple[Entity, int]]
+    stop_ids: int
+
+
+class _Cycle(NamedTuple):
+    cycle: int
+    wall_time: float
+    # ops in the order they were recorded
+    ops: list[_Op]
+    capture: _Capture | None
+    # size of STOP_IDS at the end of the cycle
+    stop_ids: int
+
+
+def _read_records(path: str):
+    """Yields (cycle, wall_time, payload) for every complete record of a WAL segment, a torn tail is ignored."""
+    with open(path, "rb") as f:
+        data = f.read()
+    pos = 0
+    while pos + _RECORD.size <= len(data):
+        length, cycle, wall_time = _RECORD.unpack_from(data, pos)
+        start = pos + _RECORD.size
+        if start + length > len(data):
+            logger.warning(f"Ignoring torn checkpoint record for cycle {cycle} in {path}")
+            return
+        yield cycle, wall_time, data[start : start + length]
+        pos = start + length
+
+
+def _extend_stop_codes(stop_codes: list[int], base: int, values: list[str]):
+    # maps the logged codes base, base + 1, ... of values onto this process' STOP_IDS
+    if base > len(stop_codes):
+        raise CorruptSnapshotError()
+    for code, value in enumerate(values, base):
+        if code < len(stop_codes):
+            stop_codes[code] = STOP_IDS.encode(value)
+        else:
+            stop_codes.append(STOP_IDS.encode(value))
+
+
+def _columns(entity: Entity) -> _Columns:
+    carriages = tuple((c.label, c.carriage_sequence, c.occupancy_status) for c in entity.carriages)
+    return _columns_of(entity), carriages
+
+
+class Checkpointer:
+    """Crash-safe checkpoint of the in-flight entities of one feed.
+
+    Every reconcile cycle appends its deltas to a write-ahead log: the row each created or updated entity wrote, as
+    one typed array per column for the whole cycle, and the evicted ids. Every snapshot_interval cycles, or once
+    max_log_bytes were logged since the last snapshot, the whole EntityStore is written to a compacted snapshot and
+    the log segments it covers are deleted. restore rebuilds the store from the latest snapshot plus the log written
+    after it, writing the logged rows straight into the columns (see Entity.restore_row).
+
+    Recording a delta only keeps the entity and its number of observations, the rows are read from the columns,
+    encoded, written and fsynced on a background thread so checkpointing stays off the consume_pb path. Snapshots
+    capture the entities the same way at the end of the cycle; because columns only ever grow, the background thread
+    can read them later without locking. Entity.simplify replaces the columns of an evicted entity, so record_evict
+    keeps the columns it had until the eviction is logged. The only value rewritten in place, the closing timestamp
+    of a run (see Entity.update), is rewritten again by replaying the log after the snapshot. Stop ids are logged as
+    codes along with the STOP_IDS values added since the previous record.
+
+    Args:
+        directory: directory holding the log segments and snapshots
+        snapshot_interval: number of cycles between two snapshots
+        max_log_bytes: snapshot early once this many bytes were logged, bounds the log replayed by restore
+        fsync: fsync every log record and snapshot
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        snapshot_interval: int = 10,
+        max_log_bytes: int = 4 * 1024 * 1024,
+        fsync: bool = True,
+    ):
+        os.makedirs(directory, exist_ok=True)
+        self.directory: str = directory
+        self.snapshot_interval: int = max(snapshot_interval, 1)
+        self.max_log_bytes: int = max_log_bytes
+        self.fsync: bool = fsync
+        self.cycle: int = 0
+        self._ops: list[_Op] = []
+        # set by the writer thread once max_log_bytes were logged since the last snapshot
+        self._log_full: bool = False
+        # snapshot on the next commit after a restore, so the log of this process never continues the log of the
+        # previous one, whose stop id codes differ
+        self._snapshot_due: bool = False
+        # columns of the evicted entities as they were before Entity.simplify, until the writer logged the eviction
+        self._evicted: dict[Entity, _Columns] = {}
+        # writer thread state: bytes logged since the last snapshot, STOP_IDS values already logged
+        self._logged_bytes: int = 0
+        self._logged_stop_ids: int = 0
+        self._wal: BinaryIO | None = None
+        self._queue: queue.Queue[_Cycle | None] = queue.Queue()
+        self._thread = threading.Thread(target=self._work, name="checkpoint", daemon=True)
+        self._thread.start()
+
+    def record_create(self, entity: Entity):
+        self._record(OP_CREATE, entity)
+
+    def record_update(self, entity: Entity):
+        self._record(OP_UPDATE, entity)
+
+    def record_evict(self, entity: Entity):
+        """Records the eviction of an entity, before Entity.simplify replaces its columns."""
+        self._evicted[entity] = _columns(entity)
+        self._ops.append((OP_EVICT, entity, 0))
+
+    def _record(self, op: int, entity: Entity):
+        self._ops.append((op, entity, len(entity)))
+
+    def commit(self, store: EntityStore, snapshot: bool = False):
+        """Ends the current cycle, handing its deltas (and a snapshot capture when due) to the writer thread.
+
+        Args:
+            store: the in-flight entities
+            snapshot: capture a snapshot even if none is due, e.g. when spilling the entities on shutdown
+        """
+        self.cycle += 1
+        ops, self._ops = self._ops, []
+        capture = None
+        if snapshot or self._snapshot_due or self._log_full or self.cycle % self.snapshot_interval == 0:
+            self._snapshot_due = False
+            self._log_full = False
+            capture = _Capture([(entity, len(entity)) for entity in store], len(STOP_IDS))
+        if ops or capture:
+            self._queue.put(_Cycle(self.cycle, time.time(), ops, capture, len(STOP_IDS)))
+
+    def flush(self):
+        """Blocks until every committed cycle is on disk."""
+        self._queue.join()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def restore(self, store: EntityStore, run_length: RunLengthPolicy | None = None) -> int:
+        """Rebuilds the store from the latest snapshot and the log written after it.
+
+        Args:
+            store: store to restore into
+            run_length: unused, logged rows already hold the runs collapsed by the run length policy of the feed
+
+        Returns:
+            Number of entities restored.
+        """
+        base = 0
+        # this process' STOP_IDS code of every logged stop id code
+        stop_codes: list[int] = []
+        for path in sorted(glob.glob(os.path.join(self.directory, "snapshot-*.bin")), reverse=True):
+            try:
+                base, stop_codes = self._load_snapshot(path, store)
+                break
+            except (OSError, ValueError, KeyError, struct.error) as e:
+                logger.warning(f"Skipping unreadable checkpoint snapshot {path}, {e}")
+                store.clear()
+        self.cycle = base
+        self._snapshot_due = True
+
+        for path in sorted(glob.glob(os.path.join(self.directory, "wal-*.log"))):
+            for cycle, _, payload in _read_records(path):
+                if cycle <= base:
+                    continue
+                try:
+                    self._replay(payload, store, stop_codes)
+                except (ValueError, KeyError, IndexError, struct.error) as e:
+                    logger.warning(f"Stopping checkpoint replay at unreadable record for cycle {cycle} in {path}, {e}")
+                    break
+                self.cycle = max(self.cycle, cycle)
+        logger.info(f"Restored {len(store)} entities from checkpoint {self.directory} at cycle {self.cycle}")
+        return len(store)
+
+    def _replay(self, payload: bytes, store: EntityStore, stop_codes: list[int]):
+        (header_length,) = _HEADER_LENGTH.unpack_from(payload)
+        pos = _HEADER_LENGTH.size
+        header: dict[str, Any] = json.loads(payload[pos : pos + header_length])
+        pos += header_length
+        _extend_stop_codes(stop_codes, header["stop_base"], header["stop_ids"])
+
+        def read_column(typecode: str, length: int) -> "array[Any]":
+            nonlocal pos
+            column: array[Any] = array(typecode)
+            size = column.itemsize * length
+            if pos + size > len(payload):
+                raise CorruptSnapshotError()
+            column.frombytes(payload[pos : pos + size])
+            pos += size
+            return column
+
+        ids: list[str] = header["ids"]
+        ops = read_column("B", len(ids))
+        row_count = len(ids) - ops.count(OP_EVICT)
+        indices = read_column("I", row_count)
+        columns = [read_column(typecode, row_count) for typecode in header["typecodes"]]
+        if columns:
+            logged_codes: array[int] = columns[_STOP_ID_COLUMN]
+            columns[_STOP_ID_COLUMN] = array("I", [stop_codes[code] for code in logged_codes])
+        rows = zip(indices, zip(*columns))
+        created = iter(header["created"])
+        carriages: dict[int, list[list[Any]]] = dict(header["carriages"])
+
+        row = 0
+        for op, entity_id in zip(ops, ids):
+            if op == OP_EVICT:
+                store.evict(entity_id)
+                continue
+            index, values = next(rows)
+            if op == OP_CREATE:
+                static, created_at = next(created)
+                entity = Entity.from_columns(
+                    static,
+                    datetime.datetime.fromtimestamp(created_at),
+                    {name: array(column.typecode) for name, column in zip(Entity.COLUMNS, columns)},
+                    [],
+                )
+                entity.restore_row(index, values, carriages.get(row, ()))
+                store.add(entity)
+            else:
+                entity = store.get(entity_id)
+                if entity is not None:
+                    entity.restore_row(index, values, carriages.get(row, ()))
+                    store.record(entity)
+            row += 1
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    if self._wal is not None:
+                        self._wal.close()
+                    return
+                self._write(item)
+            except Exception:
+                logger.exception(f"Failed to write checkpoint for cycle {item.cycle if item else None}")
+            finally:
+                self._queue.task_done()
+
+    def _columns(self, entity: Entity) -> _Columns:
+        # read before looking up the eviction: once record_evict was called the captured columns win, before it
+        # Entity.simplify has not replaced any column yet
+        columns = _columns(entity)
+        return self._evicted.get(entity, columns)
+
+    def _encode(self, item: _Cycle) -> bytes:
+        # the rows of the cycle as one array per column, the sparse parts (ids, static fields, carriages) as JSON
+        indices: array[int] = array("I")
+        typecodes: list[str] = []
+        rows: list[tuple[Any, ...]] = []
+        created: list[list[Any]] = []
+        carriages: list[list[Any]] = []
+        for op, entity, length in item.ops:
+            if op == OP_EVICT:
+                continue
+            columns, entity_carriages = self._columns(entity)
+            typecodes = typecodes or [column.typecode for column in columns]
+            if op == OP_CREATE:
+                created.append([
+                    {name: getattr(entity, name) for name in Entity.STATIC_FIELDS},
+                    entity.created.timestamp(),
+                ])
+            if entity_carriages:
+                carriages.append([
+                    len(rows),
+                    [[label, seq, column[length - 1]] for label, seq, column in entity_carriages],
+                ])
+            indices.append(length - 1)
+            rows.append(tuple(map(operator.itemgetter(length - 1), columns)))
+        for op, entity, _ in item.ops:
+            if op == OP_EVICT:
+                self._evicted.pop(entity, None)
+        header = json.dumps({
+            "stop_base": self._logged_stop_ids,
+            "stop_ids": [STOP_IDS.decode(code) for code in range(self._logged_stop_ids, item.stop_ids)],
+            "ids": [entity.entity_id for _, entity, _ in item.ops],
+            "typecodes": typecodes,
+            "created": created,
+            "carriages": carriages,
+        }).encode("utf-8")
+        self._logged_stop_ids = item.stop_ids
+        parts = [
+            _HEADER_LENGTH.pack(len(header)),
+            header,
+            array("B", [op for op, _, _ in item.ops]).tobytes(),
+            indices.tobytes(),
+        ]
+        parts.extend(array(typecode, values).tobytes() for typecode, values in zip(typecodes, zip(*rows)))
+        return b"".join(parts)
+
+    def _write(self, item: _Cycle):
+        if item.ops:
+            payload = self._encode(item)
+            if self._wal is None:
+                self._wal = open(os.path.join(self.directory, f"wal-{item.cycle:012d}.log"), "ab")  # noqa: SIM115
+            self._wal.write(_RECORD.pack(len(payload), item.cycle, item.wall_time))
+            self._wal.write(payload)
+            self._wal.flush()
+            if self.fsync:
+                os.fsync(self._wal.fileno())
+            self._logged_bytes += _RECORD.size + len(payload)
+            if self._logged_bytes >= self.max_log_bytes:
+                self._log_full = True
+        if item.capture is not None:
+            self._logged_bytes = 0
+            # the next record starts a new segment, so every segment up to here is covered by the snapshot
+            if self._wal is not None:
+                self._wal.close()
+                self._wal = None
+            self._write_snapshot(item.cycle, item.capture)
+            self._compact(item.cycle)
+
+    def _write_snapshot(self, cycle: int, capture: _Capture):
+        entities: list[dict[str, Any]] = []
+        columns: list[bytes] = []
+        for entity, length in capture.entities:
+            entity_columns, carriages = self._columns(entity)
+            entities.append({
+                "static": {name: getattr(entity, name) for name in Entity.STATIC_FIELDS},
+                "created": entity.created.timestamp(),
+                "length": length,
+                "columns": [[name, column.typecode] for name, column in zip(Entity.COLUMNS, entity_columns)],
+                "carriages": [[label, seq, column.typecode, length] for label, seq, column in carriages],
+            })
+            columns.extend(column[:length].tobytes() for column in entity_columns)
+            columns.extend(column[:length].tobytes() for _, _, column in carriages)
+        header = json.dumps({
+            "cycle": cycle,
+            "stop_ids": STOP_IDS.values(capture.stop_ids),
+            "entities": entities,
+        }).encode("utf-8")
+
+        path = os.path.join(self.directory, f"snapshot-{cycle:012d}.bin")
+        with open(f"{path}.tmp", "wb") as f:
+            f.write(_SNAPSHOT_MAGIC)
+            f.write(_HEADER_LENGTH.pack(len(header)))
+            f.write(header)
+            for column in columns:
+                f.write(column)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.replace(f"{path}.tmp", path)
+
+    def _compact(self, cycle: int):
+        for path in glob.glob(os.path.join(self.directory, "wal-*.log")):
+            if int(os.path.basename(path)[4:-4]) <= cycle:
+                os.remove(path)
+        for path in glob.glob(os.path.join(self.directory, "snapshot-*.bin")):
+            if int(os.path.basename(path)[9:-4]) < cycle:
+                os.remove(path)
+
+    def _load_snapshot(self, path: str, store: EntityStore) -> tuple[int, list[int]]:
+        with open(path, "rb") as f:
+            data = f.read()
+        if data[: len(_SNAPSHOT_MAGIC)] != _SNAPSHOT_MAGIC:
+            raise CorruptSnapshotError(path)
+        (header_length,) = _HEADER_LENGTH.unpack_from(data, len(_SNAPSHOT_MAGIC))
+        pos = len(_SNAPSHOT_MAGIC) + _HEADER_LENGTH.size
+        header: dict[str, Any] = json.loads(data[pos : pos + header_length])
+        pos += header_length
+        view = memoryview(data)
+
+        # stop id codes are process specific, map the captured codes onto this process' dictionary
+        stop_codes = [STOP_IDS.encode(value) for value in header["stop_ids"]]
+        remap = stop_codes != list(range(len(stop_codes)))
+
+        def read_column(typecode: str, length: int) -> "array[Any]":
+            nonlocal pos
+            column: array[Any] = array(typecode)
+            size = column.itemsize * length
+            if pos + size > len(data):
+                raise CorruptSnapshotError(path)
+            column.frombytes(view[pos : pos + size])
+            pos += size
+            return column
+
+        for state in header["entities"]:
+            columns = {name: read_column(typecode, state["length"]) for name, typecode in state["columns"]}
+            if remap:
+                columns["_stop_id_codes"] = array(
+                    columns["_stop_id_codes"].typecode, [stop_codes[code] for code in columns["_stop_id_codes"]]
+                )
+            carriages = [
+                Carriage.from_columns(label, sequence, read_column(typecode, length))
+                for label, sequence, typecode, length in state["carriages"]
+            ]
+            store.add(
+                Entity.from_columns(
+                    state["static"], datetime.datetime.fromtimestamp(state["created"]), columns, carriages
+                )
+            )
+        return header["cycle"], stop_codes
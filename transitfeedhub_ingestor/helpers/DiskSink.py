@@ -0,0 +1,348 @@
+import io
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+from typing import Literal
+
+from .Entity import Entity
+from .MFJSONWriter import MFJSONWriter
+from .setup_logger import logger
+from .StaticGTFS import StaticGTFS
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover, not available on Windows, where open files cannot be renamed anyway
+    fcntl = None
+
+_HEADER = b'{"type":"FeatureCollection","features":['
+_FOOTER = b"]}"
+
+
+def _fsync_directory(directory: str):
+    # makes a rename durable, directories cannot be opened on every platform
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _complete_length(data: bytes, ndjson: bool) -> tuple[int, int]:
+    """Returns the length of the part of a segment made of complete features and the number of those features.
+
+    A crash can tear a segment anywhere, e.g. in the middle of a feature or of a multibyte character. Features are
+    decoded one after the other and the segment is cut after the last one that decodes, before its separator.
+    """
+    text = data.decode("utf-8", errors="replace")
+    decoder = json.JSONDecoder()
+    if ndjson:
+        end = count = 0
+        while (newline := text.find("\n", end)) != -1:
+            try:
+                json.loads(text[end:newline])
+            except ValueError:
+                break
+            end = newline + 1
+            count += 1
+        return len(text[:end].encode("utf-8")), count
+
+    header = _HEADER.decode("ascii")
+    if not text.startswith(header):
+        return 0, 0
+    end = pos = len(header)
+    count = 0
+    while True:
+        try:
+            _, pos = decoder.raw_decode(text, pos)
+        except ValueError:
+            break
+        end = pos
+        count += 1
+        if not text.startswith(",", pos):
+            break
+        pos += 1
+    return len(text[:end].encode("utf-8")), count
+
+
+class _Segment:
+    __slots__ = ("count", "dirty", "file", "opened", "part_path", "path", "size")
+
+    def __init__(self, directory: str, extension: str):
+        name = f"{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4()}.{extension}"
+        self.path: str = os.path.join(directory, name)
+        # hidden until published, readers only list the final names
+        self.part_path: str = os.path.join(directory, f".{name}.part")
+        self.file = open(self.part_path, "wb")  # noqa: SIM115
+        # tells a sink recovering the part files of a crashed writer that this one is still being written
+        if fcntl is not None:
+            fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self.opened: float = time.monotonic()
+        self.size: int = 0
+        self.count: int = 0
+        self.dirty: bool = False
+
+
+class DiskSink:
+    """Appends finished trajectories to per-prefix segment files on local disk, for offline and edge deployments.
+
+    add serializes the trajectory and queues it, a background writer thread appends it to the open segment of its
+    prefix ({root}/{prefix}, e.g. {agency}/{YYYYMMDD}/{route_id}). Directories are created once and remembered.
+    Segments are written as hidden .part files, fsynced in batches at most every fsync_interval seconds, and rotate
+    once they reach max_bytes or have been open max_age seconds: the part file is completed, fsynced and atomically
+    renamed to its final name, so readers never see a partial file. A published segment is a FeatureCollection or
+    NDJSON (one Feature per line), like the objects of BatchSink. On start, the writer thread publishes the part files
+    a crashed writer left below root, cut after their last complete feature; the open segments of a running writer
+    sharing root are locked and left alone.
+
+    Args:
+        root: directory the prefixes are relative to
+        output_format: "featurecollection" or "ndjson"
+        max_bytes: rotate a segment once it holds this many bytes
+        max_age: rotate a segment once it has been open this many seconds
+        fsync_interval: seconds between fsyncs of the open segments, 0 syncs after every batch of writes
+        max_queue: trajectories waiting for the writer before add blocks
+        gtfs: optional static GTFS lookup tables the trajectories are enriched from, see MFJSONWriter
+    """
+
+    def __init__(
+        self,
+        root: str,
+        output_format: Literal["featurecollection", "ndjson"] = "featurecollection",
+        max_bytes: int = 64 * 1024 * 1024,
+        max_age: float = 300,
+        fsync_interval: float = 1.0,
+        max_queue: int = 10000,
+        gtfs: StaticGTFS | None = None,
+    ):
+        self.root: str = root
+        self.output_format: Literal["featurecollection", "ndjson"] = output_format
+        self.max_bytes: int = max_bytes
+        self.max_age: float = max_age
+        self.fsync_interval: float = fsync_interval
+        self.published_objects: int = 0
+        self.published_trajectories: int = 0
+        self.published_bytes: int = 0
+        self.fsyncs: int = 0
+        self._writer = MFJSONWriter(gtfs=gtfs)
+        self._segments: dict[str, _Segment] = {}
+        self._directories: set[str] = set()
+        self._last_sync: float = time.monotonic()
+        # (prefix, serialized feature), an Event to rotate every segment, or None to stop
+        self._queue: queue.Queue[tuple[str, bytes] | threading.Event | None] = queue.Queue(maxsize=max_queue)
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="disk-sink", daemon=True)
+        self._thread.start()
+
+    @property
+    def extension(self) -> str:
+        return "ndjson" if self.output_format == "ndjson" else "mfjson"
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def add(self, entity: Entity, prefix: str):
+        """Queues the trajectory of an entity for the segment of prefix."""
+        buffer = io.BytesIO()
+        self._writer.stream_feature(entity, buffer)
+        self._queue.put((prefix, buffer.getvalue()))
+
+    def add_feature(self, feature: bytes, prefix: str):
+        """Queues an already serialized GeoJSON Feature, e.g. a trip update delay series, for the segment of prefix."""
+        self._queue.put((prefix, feature))
+
+    def flush_due(self):
+        """Rotation by age runs on the writer thread, nothing to do here."""
+
+    def flush(self, timeout: float | None = None) -> bool:
+        """Writes every queued trajectory and publishes every open segment.
+
+        Args:
+            timeout: optional seconds to wait for the writer thread
+
+        Returns:
+            True if the segments were published before the timeout.
+        """
+        if self._closed:
+            return True
+        until = None if timeout is None else time.monotonic() + timeout
+        done = threading.Event()
+        try:
+            self._queue.put(done, timeout=timeout)
+        except queue.Full:
+            return False
+        # a writer that stopped will never release the flush
+        while not done.wait(1.0 if until is None else min(max(until - time.monotonic(), 0.0), 1.0)):
+            if not self._thread.is_alive():
+                logger.error(f"Disk sink writer below {self.root} stopped, segments were not published")
+                return False
+            if until is not None and time.monotonic() >= until:
+                return False
+        return True
+
+    def close(self):
+        """Publishes every open segment and stops the writer thread."""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        self._recover()
+        while True:
+            stop = False
+            for item in self._next_items():
+                if item is None:
+                    stop = True
+                else:
+                    self._handle(item)
+            try:
+                self._rotate_due()
+                self._sync_due()
+            except Exception:
+                logger.exception(f"Disk sink writer failed below {self.root}")
+            if stop:
+                self._rotate_all()
+                return
+
+    def _next_items(self) -> list[tuple[str, bytes] | threading.Event | None]:
+        try:
+            items = [self._queue.get(timeout=self._wait())]
+        except queue.Empty:
+            return []
+        # drain what queued up meanwhile so it shares one fsync
+        while len(items) < 1000:
+            try:
+                items.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    def _handle(self, item: tuple[str, bytes] | threading.Event):
+        # an error is logged and leaves the writer running, a flush is released either way
+        try:
+            if isinstance(item, threading.Event):
+                self._rotate_all()
+            else:
+                self._append(*item)
+        except Exception:
+            logger.exception(f"Disk sink writer failed below {self.root}")
+        finally:
+            if isinstance(item, threading.Event):
+                item.set()
+
+    def _recover(self):
+        """Publishes the part files a crashed writer left below root, cut after their last complete feature."""
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                if name.startswith(".") and name.endswith(".part"):
+                    try:
+                        self._recover_part(os.path.join(directory, name))
+                    except Exception:
+                        logger.exception(f"Failed to recover segment {os.path.join(directory, name)}")
+
+    def _recover_part(self, part_path: str):
+        directory, name = os.path.split(part_path)
+        path = os.path.join(directory, name[1 : -len(".part")])
+        ndjson = path.endswith(".ndjson")
+        with open(part_path, "r+b") as f:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    # the open segment of a running writer sharing the root
+                    return
+            length, count = _complete_length(f.read(), ndjson)
+            if count > 0:
+                f.truncate(length)
+                f.seek(length)
+                if not ndjson:
+                    f.write(_FOOTER)
+                f.flush()
+                os.fsync(f.fileno())
+        if count == 0:
+            os.remove(part_path)
+            return
+        os.replace(part_path, path)
+        _fsync_directory(directory)
+        logger.warning(f"Recovered segment {path} of {count} trajectories left by a crashed writer")
+
+    def _wait(self) -> float:
+        if not self._segments:
+            return self.max_age
+        now = time.monotonic()
+        oldest = min(segment.opened for segment in self._segments.values())
+        return max(min(oldest + self.max_age - now, self._last_sync + self.fsync_interval - now), 0.01)
+
+    def _append(self, prefix: str, feature: bytes):
+        try:
+            segment = self._segments.get(prefix)
+            if segment is None:
+                directory = os.path.join(self.root, prefix)
+                if directory not in self._directories:
+                    os.makedirs(directory, exist_ok=True)
+                    self._directories.add(directory)
+                segment = self._segments[prefix] = _Segment(directory, self.extension)
+                if self.output_format != "ndjson":
+                    segment.size += segment.file.write(_HEADER)
+            elif self.output_format != "ndjson":
+                segment.size += segment.file.write(b",")
+            segment.size += segment.file.write(feature)
+            if self.output_format == "ndjson":
+                segment.size += segment.file.write(b"\n")
+            segment.count += 1
+            segment.dirty = True
+            if segment.size >= self.max_bytes:
+                self._publish(prefix)
+        except OSError:
+            logger.exception(f"Failed to write trajectory to {self.root}/{prefix}")
+
+    def _rotate_due(self):
+        now = time.monotonic()
+        for prefix in [p for p, segment in self._segments.items() if now - segment.opened >= self.max_age]:
+            self._publish(prefix)
+
+    def _rotate_all(self):
+        for prefix in list(self._segments):
+            self._publish(prefix)
+
+    def _sync_due(self):
+        if time.monotonic() - self._last_sync < self.fsync_interval:
+            return
+        for segment in self._segments.values():
+            if segment.dirty:
+                try:
+                    segment.file.flush()
+                    os.fsync(segment.file.fileno())
+                except OSError:
+                    logger.exception(f"Failed to sync segment {segment.part_path}")
+                    continue
+                segment.dirty = False
+                self.fsyncs += 1
+        self._last_sync = time.monotonic()
+
+    def _publish(self, prefix: str):
+        segment = self._segments.pop(prefix)
+        try:
+            if self.output_format != "ndjson":
+                segment.size += segment.file.write(_FOOTER)
+            segment.file.flush()
+            os.fsync(segment.file.fileno())
+            segment.file.close()
+            os.replace(segment.part_path, segment.path)
+            _fsync_directory(os.path.dirname(segment.path))
+        except OSError:
+            logger.exception(f"Failed to publish segment {segment.path}")
+            return
+        self.fsyncs += 1
+        self.published_objects += 1
+        self.published_trajectories += segment.count
+        self.published_bytes += segment.size
+        logger.debug(f"Published segment {segment.path} of {segment.count} trajectories")
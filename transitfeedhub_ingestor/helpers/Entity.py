@@ -1,13 +1,112 @@
 import datetime
 import json
 import os
+import sys
+import threading
 import uuid
-from typing import cast
+from array import array
+from collections.abc import Sequence
+from itertools import compress
+from typing import TYPE_CHECKING, Any, NamedTuple, cast
 
 from transitfeedhub_ingestor.protobuf import gtfs_realtime_pb2
 
-from .s3Uploader import upload_file
-from .types import FeatureDict
+from .geometry import bearing_delta, distance_m, simplify_mask
+from .MFJSONWriter import MFJSONWriter
+from .s3Uploader import BackgroundUploader, upload_file
+from .types import FeatureDict, MFJSONDict, PropertiesDict
+
+if TYPE_CHECKING:
+    from .BatchSink import TrajectorySink
+    from .StaticGTFS import StaticGTFS
+
+
+class StringDictionary:
+    """Dictionary encoder shared by every Entity for low-cardinality string columns such as stop_id.
+
+    Each distinct value is interned and stored once per process, entities only keep the integer code.
+    """
+
+    def __init__(self):
+        self._values: list[str] = []
+        self._codes: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def values(self, length: int | None = None) -> list[str]:
+        """Returns the dictionary, optionally only the first length values, indexed by code."""
+        return self._values[:length]
+
+    def encode(self, value: str) -> int:
+        code = self._codes.get(value)
+        if code is None:
+            with self._lock:
+                code = self._codes.get(value)
+                if code is None:
+                    code = len(self._values)
+                    self._values.append(sys.intern(value))
+                    self._codes[self._values[code]] = code
+        return code
+
+    def decode(self, code: int) -> str:
+        return self._values[code]
+
+
+STOP_IDS = StringDictionary()
+
+
+def _json_default(o: Any) -> Any:
+    if isinstance(o, array):
+        return o.tolist()  # pyright: ignore[reportUnknownMemberType, reportUnknownVariableType]
+    if isinstance(o, datetime.datetime):
+        return o.isoformat()
+    slots: tuple[str, ...] = getattr(o, "__slots__", ())
+    return {slot: getattr(o, slot) for slot in slots if not slot.startswith("_")}
+
+
+class RunLengthPolicy(NamedTuple):
+    """Tolerances under which Entity.update treats an observation as unchanged.
+
+    An observation is unchanged when every discrete value (status, stop, occupancy, congestion, odometer, speed and the
+    carriage occupancies) equals the last row and the position and bearing moved at most distance metres and bearing
+    degrees, which absorbs GPS jitter of vehicles on layover or held at a terminal.
+    """
+
+    distance: float = 10.0
+    bearing: float = 15.0
+
+
+class SegmentPolicy(NamedTuple):
+    """Limits after which VehiclePositionFeed cuts a trajectory into rolling segments.
+
+    A trajectory that holds max_points rows, spans max_age seconds of observations or holds an estimated max_bytes of
+    column data (see Entity.nbytes) is saved and its vehicle continues in a new segment starting at the last
+    observation. Age is measured on the feed timestamps, so a replay cuts where the live feed did. memory_budget bounds
+    the estimated bytes of all in-flight trajectories of a feed, the segments with the oldest first observation are cut
+    first while it is exceeded. A limit of None is disabled.
+    """
+
+    max_points: int | None = None
+    max_age: float | None = None
+    max_bytes: int | None = None
+    memory_budget: int | None = None
+
+    def due(self, entity: "Entity") -> bool:
+        if self.max_points is not None and len(entity) >= self.max_points:
+            return True
+        if self.max_age is not None and entity.timestamps[-1] - entity.timestamps[0] >= self.max_age:
+            return True
+        return self.max_bytes is not None and entity.nbytes >= self.max_bytes
+
+
+# occupancy of a carriage in an observation it is missing from
+CARRIAGE_NO_DATA: int = gtfs_realtime_pb2.VehiclePosition.NO_DATA_AVAILABLE
+
+
+def _carriage_key(label: str, carriage_sequence: int) -> str:
+    return label or f"#{carriage_sequence}"
 
 
 class Carriage:
@@ -23,23 +122,125 @@ class Carriage:
         Creates a class represeting:
         label: string for train number or other identifier
         carriage_sequence: integer representing order of train car placement. I.e 1 is the front
-        occupancy_status: list of integers representing the occupancy status enum from GTFS RT Standard
+        occupancy_status: array of unsigned bytes representing the occupancy status enum from GTFS RT Standard
 
     """
 
-    def __init__(self, carriage_details: gtfs_realtime_pb2.VehiclePosition.CarriageDetails):
+    __slots__ = ("carriage_sequence", "label", "occupancy_status")
+
+    def __init__(self, carriage_details: gtfs_realtime_pb2.VehiclePosition.CarriageDetails, backfill: int = 0):
         self.label: str = carriage_details.label
         self.carriage_sequence: int = carriage_details.carriage_sequence
-        self.occupancy_status: list[int] = [carriage_details.occupancy_status]
+        # observations from before the carriage joined the consist have no data
+        self.occupancy_status: array[int] = array("B", [CARRIAGE_NO_DATA]) * backfill
+        self.occupancy_status.append(carriage_details.occupancy_status)
+
+    @property
+    def key(self) -> str:
+        """Identity of the carriage within its Entity, the label or the sequence of an unlabelled carriage."""
+        return _carriage_key(self.label, self.carriage_sequence)
+
+    @property
+    def measure_name(self) -> str:
+        """Name of the occupancy series in temporalProperties."""
+        return f"carriage_{self.carriage_sequence}_{self.label}"
+
+    @classmethod
+    def from_columns(cls, label: str, carriage_sequence: int, occupancy_status: "array[int]") -> "Carriage":
+        """Rebuilds a Carriage from a previously captured occupancy column, used when restoring a checkpoint."""
+        carriage = cls.__new__(cls)
+        carriage.label = label
+        carriage.carriage_sequence = carriage_sequence
+        carriage.occupancy_status = occupancy_status
+        return carriage
 
     def Update(self, carriage_details: gtfs_realtime_pb2.VehiclePosition.CarriageDetails):
         self.occupancy_status.append(carriage_details.occupancy_status)
 
     def toJSON(self):
-        return json.dumps(self, default=lambda o: o.__dict__, sort_keys=True, indent=4)
+        return json.dumps(self, default=_json_default, sort_keys=True, indent=4)
 
 
 class Entity:
+    """A single vehicle trajectory accumulated from successive Vehicle Position messages.
+
+    Temporal values are kept in typed array columns rather than lists of boxed Python objects. Timestamps are
+    stored as epoch seconds and only formatted to ISO 8601 when the trajectory is serialized, and stop ids are
+    dictionary encoded through STOP_IDS.
+    """
+
+    __slots__ = (
+        "_carriage_index",
+        "_stop_id_codes",
+        "bearing",
+        "carriages",
+        "congestion_level",
+        "created",
+        "current_status",
+        "current_stop_sequence",
+        "direction_id",
+        "entity_id",
+        "label",
+        "latitude",
+        "license_plate",
+        "longitude",
+        "occupancy_percentage",
+        "occupancy_status",
+        "odometer",
+        "route_id",
+        "schedule_relationship",
+        "speed",
+        "start_date",
+        "start_time",
+        "timestamps",
+        "trip_id",
+        "vehicle_id",
+        "vehicle_label",
+    )
+
+    # trip and vehicle descriptor values that do not change over the life of the entity
+    STATIC_FIELDS: tuple[str, ...] = (
+        "entity_id",
+        "direction_id",
+        "label",
+        "route_id",
+        "trip_id",
+        "schedule_relationship",
+        "start_date",
+        "start_time",
+        "vehicle_id",
+        "vehicle_label",
+        "license_plate",
+    )
+    # typed temporal columns, one value per observation
+    COLUMNS: tuple[str, ...] = (
+        "bearing",
+        "current_status",
+        "odometer",
+        "speed",
+        "_stop_id_codes",
+        "timestamps",
+        "current_stop_sequence",
+        "longitude",
+        "latitude",
+        "occupancy_status",
+        "occupancy_percentage",
+        "congestion_level",
+    )
+    # discrete measures whose transitions survive simplify
+    DISCRETE_COLUMNS: tuple[str, ...] = (
+        "current_status",
+        "_stop_id_codes",
+        "current_stop_sequence",
+        "occupancy_status",
+        "occupancy_percentage",
+        "congestion_level",
+    )
+    # columns that repeat the previous row in the closing row of a run, see update
+    _RUN_COLUMNS: tuple[str, ...] = tuple(name for name in COLUMNS if name != "timestamps")
+    # sum of the item sizes of COLUMNS, every carriage adds one byte per row
+    ROW_BYTES: int = 47
+
     def __init__(self, entity: gtfs_realtime_pb2.VehiclePosition):
         self.entity_id: str = entity.vehicle.id
 
@@ -58,57 +259,273 @@ class Entity:
         self.license_plate: str = entity.vehicle.license_plate
 
         # Temporal
-        self.bearing: list[float] = [entity.position.bearing]
-        self.current_status: list[int] = [entity.current_status]
-        self.odometer: list[float] = [entity.position.odometer]
-        self.speed: list[float] = [entity.position.speed]
-        self.stop_id: list[str] = [entity.stop_id]
-        self.updated_at: list[str] = [datetime.datetime.fromtimestamp(entity.timestamp).isoformat()]
-        self.current_stop_sequence: list[int] = [entity.current_stop_sequence]
-        self.coordinates: list[list[float]] = [[entity.position.longitude, entity.position.latitude]]
-        self.occupancy_status: list[int] = [entity.occupancy_status]
-        self.occupancy_percentage: list[int] = [entity.occupancy_percentage]
-        self.congestion_level: list[int] = [entity.congestion_level]
-
-        self.carriages = [Carriage(c) for c in entity.multi_carriage_details]
-
-        # TODO: get multicarriage details
-        # print(entity.vehicle.multi_carriage_details)
-        # print(entity.vehicle.multi_carriage_details[0].label)
-        # print(entity.vehicle.multi_carriage_details[0].carriage_sequence)
-        # first two = static, third = temporal
-        # print(entity.vehicle.multi_carriage_details[0].occupancy_status)
-
-    def update(self, entity: gtfs_realtime_pb2.VehiclePosition):
-        # Temporal
-        self.bearing.append(entity.position.bearing)
+        self.bearing: array[float] = array("f")
+        self.current_status: array[int] = array("B")
+        self.odometer: array[float] = array("d")
+        self.speed: array[float] = array("f")
+        self._stop_id_codes: array[int] = array("I")
+        self.timestamps: array[int] = array("Q")
+        self.current_stop_sequence: array[int] = array("I")
+        self.longitude: array[float] = array("f")
+        self.latitude: array[float] = array("f")
+        self.occupancy_status: array[int] = array("B")
+        self.occupancy_percentage: array[int] = array("I")
+        self.congestion_level: array[int] = array("B")
+        self._append(entity)
+
+        # carriages in the order they joined, each with one occupancy value per observation
+        self.carriages: list[Carriage] = []
+        self._carriage_index: dict[str, Carriage] = {}
+        self._update_carriages(entity)
+
+    @classmethod
+    def from_columns(
+        cls,
+        static: dict[str, Any],
+        created: datetime.datetime,
+        columns: "dict[str, array[Any]]",
+        carriages: list[Carriage],
+    ) -> "Entity":
+        """Rebuilds an Entity from previously captured columns, used when restoring a checkpoint.
+
+        Args:
+            static: value of every name in STATIC_FIELDS
+            created: creation time of the original entity
+            columns: array of every name in COLUMNS, stop ids already encoded with STOP_IDS
+            carriages: restored carriages
+        """
+        entity = cls.__new__(cls)
+        for name in cls.STATIC_FIELDS:
+            setattr(entity, name, static[name])
+        for name in cls.COLUMNS:
+            setattr(entity, name, columns[name])
+        entity.created = created
+        entity.carriages = carriages
+        entity._carriage_index = {c.key: c for c in carriages}
+        return entity
+
+    def restore_row(self, row: int, values: Sequence[Any], carriages: Sequence[Sequence[Any]] = ()):
+        """Writes one row captured by a checkpoint log, appending it or overwriting the closing row of a run.
+
+        Args:
+            row: index of the row, at most one past the last row
+            values: value of every name in COLUMNS, stop ids already encoded with STOP_IDS
+            carriages: (label, carriage_sequence, occupancy_status) of every carriage in the row
+        """
+        for name, value in zip(self.COLUMNS, values):
+            column: array[Any] = getattr(self, name)
+            if row < len(column):
+                column[row] = value
+            else:
+                column.append(value)
+        for label, carriage_sequence, occupancy_status in carriages:
+            key = _carriage_key(label, carriage_sequence)
+            carriage = self._carriage_index.get(key)
+            if carriage is None:
+                carriage = Carriage.from_columns(label, carriage_sequence, array("B", [CARRIAGE_NO_DATA]) * row)
+                self._carriage_index[key] = carriage
+                self.carriages.append(carriage)
+            if row < len(carriage.occupancy_status):
+                carriage.occupancy_status[row] = occupancy_status
+            else:
+                carriage.occupancy_status.append(occupancy_status)
+        for carriage in self.carriages:
+            if len(carriage.occupancy_status) <= row:
+                carriage.occupancy_status.append(CARRIAGE_NO_DATA)
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    @property
+    def nbytes(self) -> int:
+        """Estimated bytes held by the temporal columns and carriage series, excluding array over-allocation."""
+        return len(self.timestamps) * (self.ROW_BYTES + len(self.carriages))
+
+    def _append(self, entity: gtfs_realtime_pb2.VehiclePosition):
+        position = entity.position
+        self.bearing.append(position.bearing)
         self.current_status.append(entity.current_status)
+        self.odometer.append(position.odometer)
+        self.speed.append(position.speed)
+        self._stop_id_codes.append(STOP_IDS.encode(entity.stop_id))
+        self.timestamps.append(entity.timestamp)
         self.current_stop_sequence.append(entity.current_stop_sequence)
-        self.coordinates.append([entity.position.longitude, entity.position.latitude])
+        self.longitude.append(position.longitude)
+        self.latitude.append(position.latitude)
         self.occupancy_status.append(entity.occupancy_status)
         self.occupancy_percentage.append(entity.occupancy_percentage)
-        self.speed.append(entity.position.speed)
-        self.odometer.append(entity.position.odometer)
-        # TODO: need to convert to ISO 8601 format
-        self.updated_at.append(datetime.datetime.fromtimestamp(entity.timestamp).isoformat())
-        self.stop_id.append(entity.stop_id)
         self.congestion_level.append(entity.congestion_level)
 
-        for carriage in entity.multi_carriage_details:
-            carriage_obj = next((c for c in self.carriages if c.label == carriage.label), None)
-            if carriage_obj:
-                carriage_obj.Update(carriage)
+    def update(self, entity: gtfs_realtime_pb2.VehiclePosition, run_length: RunLengthPolicy | None = None) -> bool:
+        """Appends an observation.
+
+        With a run_length policy, observations unchanged from the last row are collapsed into runs that only keep
+        their first and last timestamp. The first repeat closes the run with a copy of the last row at its own
+        timestamp, later repeats move that closing timestamp forward. Both ends of a run share the position it started
+        at, so the MovingPoint stays stationary over the run when it is interpolated.
+
+        Args:
+            entity: Vehicle Position of this vehicle with a new timestamp
+            run_length: tolerances for collapsing unchanged observations, every observation is kept when None
+
+        Returns:
+            False if the observation only moved the closing timestamp of a run, True if a row was stored.
+        """
+        if run_length is not None and self._unchanged(entity, run_length):
+            if self._run_open():
+                self.timestamps[-1] = entity.timestamp
+                return False
+            for name in self._RUN_COLUMNS:
+                column: array[Any] = getattr(self, name)
+                column.append(column[-1])
+            self.timestamps.append(entity.timestamp)
+            for carriage in self.carriages:
+                carriage.occupancy_status.append(carriage.occupancy_status[-1])
+            return True
+
+        # Temporal
+        self._append(entity)
+        self._update_carriages(entity)
+        return True
+
+    def _update_carriages(self, entity: gtfs_realtime_pb2.VehiclePosition):
+        """Appends the occupancy of every carriage for the observation just appended.
+
+        Carriages are looked up by key, so a consist change mid-trip adds the new carriages, backfilled with
+        CARRIAGE_NO_DATA, and fills CARRIAGE_NO_DATA for carriages missing from the observation. Every series keeps
+        one value per timestamp.
+        """
+        n = len(self.timestamps)
+        index = self._carriage_index
+        for details in entity.multi_carriage_details:
+            carriage = index.get(_carriage_key(details.label, details.carriage_sequence))
+            if carriage is None:
+                carriage = Carriage(details, backfill=n - 1)
+                index[carriage.key] = carriage
+                self.carriages.append(carriage)
+            elif len(carriage.occupancy_status) < n:
+                carriage.Update(details)
+        for carriage in self.carriages:
+            if len(carriage.occupancy_status) < n:
+                carriage.occupancy_status.append(CARRIAGE_NO_DATA)
+
+    def _unchanged(self, entity: gtfs_realtime_pb2.VehiclePosition, run_length: RunLengthPolicy) -> bool:
+        position = entity.position
+        if (
+            self.current_status[-1] != entity.current_status
+            or self.current_stop_sequence[-1] != entity.current_stop_sequence
+            or self.occupancy_status[-1] != entity.occupancy_status
+            or self.occupancy_percentage[-1] != entity.occupancy_percentage
+            or self.congestion_level[-1] != entity.congestion_level
+            or self.odometer[-1] != position.odometer
+            or self.speed[-1] != position.speed
+            or STOP_IDS.decode(self._stop_id_codes[-1]) != entity.stop_id
+        ):
+            return False
+        if (
+            distance_m(self.longitude[-1], self.latitude[-1], position.longitude, position.latitude)
+            > run_length.distance
+            or bearing_delta(self.bearing[-1], position.bearing) > run_length.bearing
+        ):
+            return False
+        if not self.carriages and not entity.multi_carriage_details:
+            return True
+        # every carriage must report the same occupancy, a carriage joining or leaving is a change
+        occupancy = {
+            c.key: c.occupancy_status[-1] for c in self.carriages if c.occupancy_status[-1] != CARRIAGE_NO_DATA
+        }
+        return occupancy == {
+            _carriage_key(details.label, details.carriage_sequence): details.occupancy_status
+            for details in entity.multi_carriage_details
+        }
+
+    def _run_open(self) -> bool:
+        # the last row closes a run when it repeats the row before it
+        if len(self.timestamps) < 2:
+            return False
+        for name in self._RUN_COLUMNS:
+            column: array[Any] = getattr(self, name)
+            if column[-1] != column[-2]:
+                return False
+        return all(c.occupancy_status[-1] == c.occupancy_status[-2] for c in self.carriages)
+
+    def simplify(self, tolerance: float) -> int:
+        """Drops the points that simplification finds redundant, keeping every column aligned.
+
+        Points are selected with a time synchronized Douglas-Peucker (see geometry.simplify_mask) with a tolerance in
+        metres. Both rows around every change of a discrete measure are always kept, so transitions keep their exact
+        time. Carriage series are filtered along with the other columns.
+
+        Args:
+            tolerance: maximum distance in metres between a dropped point and the simplified trajectory
+
+        Returns:
+            Number of points dropped.
+        """
+        n = len(self.timestamps)
+        if n < 3:
+            return 0
+        discrete: list[array[Any]] = [getattr(self, name) for name in self.DISCRETE_COLUMNS]
+        anchors: set[int] = set()
+        for column in discrete + [c.occupancy_status for c in self.carriages]:
+            for i in range(1, n):
+                if column[i] != column[i - 1]:
+                    anchors.add(i - 1)
+                    anchors.add(i)
+
+        keep = simplify_mask(self.longitude, self.latitude, self.timestamps, tolerance, anchors)
+        kept = sum(keep)
+        if kept == n:
+            return 0
+        for name in self.COLUMNS:
+            column: array[Any] = getattr(self, name)
+            setattr(self, name, array(column.typecode, compress(column, keep)))
+        for carriage in self.carriages:
+            carriage.occupancy_status = array("B", compress(carriage.occupancy_status, keep))
+        return n - kept
+
+    @property
+    def stop_id(self) -> list[str]:
+        return [STOP_IDS.decode(code) for code in self._stop_id_codes]
+
+    @property
+    def coordinates(self) -> list[list[float]]:
+        return [[lon, lat] for lon, lat in zip(self.longitude, self.latitude)]
+
+    @property
+    def updated_at(self) -> list[str]:
+        # ISO 8601 strings are only built on demand, storage keeps epoch seconds
+        return [datetime.datetime.fromtimestamp(t).isoformat() for t in self.timestamps]
 
     def checkage(self):
         # checks age of object and returns age in seconds
         return (datetime.datetime.now() - self.created).total_seconds()
 
     def toJSON(self):
-        return json.dumps(self, default=lambda o: o.__dict__, sort_keys=True, indent=4)
+        return json.dumps(self, default=_json_default, sort_keys=True, indent=4)
 
-    def toMFJSON(self) -> str:
-        # TODO: add carriage details
+    def properties(self, gtfs: "StaticGTFS | None" = None) -> PropertiesDict:
         # TODO: Need to update properties being written out
+        properties: PropertiesDict = {
+            "trajectory_id": 0,
+            "entity_id": self.entity_id,
+            "direction_id": self.direction_id,
+            "label": self.label,
+            "trip_id": self.trip_id,
+            "route_id": self.route_id,
+            "schedule_relationship": self.schedule_relationship,
+            "trip_start_date": self.start_date,
+            "trip_start_time": self.start_time,
+            "vehicle_id": self.vehicle_id,
+            "vehicle_label": self.vehicle_label,
+            "license_plate": self.license_plate,
+        }
+        if gtfs is not None:
+            gtfs.enrich(properties)
+        return properties
+
+    def toMFJSONDict(self, gtfs: "StaticGTFS | None" = None) -> MFJSONDict:
+        updated_at = self.updated_at
         dict_template = {
             "type": "FeatureCollection",
             "features": [
@@ -117,44 +534,31 @@ class Entity:
                     "temporalGeometry": {
                         "type": "MovingPoint",
                         "coordinates": self.coordinates,
-                        "datetimes": self.updated_at,
+                        "datetimes": updated_at,
                         "interpolation": "Linear",
                     },
-                    "properties": {
-                        "trajectory_id": 0,
-                        "entity_id": self.entity_id,
-                        "direction_id": self.direction_id,
-                        "label": self.label,
-                        "trip_id": self.trip_id,
-                        "route_id": self.route_id,
-                        "schedule_relationship": self.schedule_relationship,
-                        "trip_start_date": self.start_date,
-                        "trip_start_time": self.start_time,
-                        "vehicle_id": self.vehicle_id,
-                        "vehicle_label": self.vehicle_label,
-                        "license_plate": self.license_plate,
-                    },
+                    "properties": self.properties(gtfs),
                     "temporalProperties": [
                         {
-                            "datetimes": self.updated_at,
+                            "datetimes": updated_at,
                             "bearing": {
                                 "type": "Measure",
-                                "values": self.bearing,
+                                "values": self.bearing.tolist(),
                                 "interpolation": "Linear",
                             },
                             "current_status": {
                                 "type": "Measure",
-                                "values": self.current_status,
+                                "values": self.current_status.tolist(),
                                 "interpolation": "Discrete",
                             },
                             "odometer": {
                                 "type": "Measure",
-                                "values": self.odometer,
+                                "values": self.odometer.tolist(),
                                 "interpolation": "Discrete",
                             },
                             "speed": {
                                 "type": "Measure",
-                                "values": self.speed,
+                                "values": self.speed.tolist(),
                                 "interpolation": "Linear",
                             },
                             "stop_id": {
@@ -164,22 +568,22 @@ class Entity:
                             },
                             "current_stop_sequence": {
                                 "type": "Measure",
-                                "values": self.current_stop_sequence,
+                                "values": self.current_stop_sequence.tolist(),
                                 "interpolation": "Discrete",
                             },
                             "occupancy_status": {
                                 "type": "Measure",
-                                "values": self.occupancy_status,
+                                "values": self.occupancy_status.tolist(),
                                 "interpolation": "Discrete",
                             },
                             "occupancy_percentage": {
                                 "type": "Measure",
-                                "values": self.occupancy_percentage,
+                                "values": self.occupancy_percentage.tolist(),
                                 "interpolation": "Discrete",
                             },
                             "congestion_level": {
                                 "type": "Measure",
-                                "values": self.congestion_level,
+                                "values": self.congestion_level.tolist(),
                                 "interpolation": "Discrete",
                             },
                         }
@@ -189,28 +593,48 @@ class Entity:
         }
         first_feature = cast(FeatureDict, dict_template["features"][0])
         temporal_properties = first_feature["temporalProperties"][0]
+        if gtfs is not None:
+            temporal_properties["stop_name"] = {
+                "type": "Measure",
+                "values": [gtfs.stop_name(stop_id) for stop_id in self.stop_id],
+                "interpolation": "Discrete",
+            }
         for carriage in self.carriages:
-            carriage_key = f"carriage_{carriage.carriage_sequence}_{carriage.label}"
-            temporal_properties[carriage_key] = {
+            temporal_properties[carriage.measure_name] = {
                 "type": "Measure",
-                "values": carriage.occupancy_status,
+                "values": carriage.occupancy_status.tolist(),
                 "interpolation": "Discrete",
             }
 
+        return cast(MFJSONDict, dict_template)
+
+    def toMFJSON(self, gtfs: "StaticGTFS | None" = None) -> str:
         return json.dumps(
-            dict_template,
+            self.toMFJSONDict(gtfs),
             indent=4,
         )
 
-    def save(self, file_path: str):
-        isExist = os.path.exists(f"{file_path}/{self.route_id}")
-        if isExist is False:
-            os.makedirs(f"{file_path}/{self.route_id}", mode=0o777, exist_ok=False)
-            with open(f"{file_path}/{self.route_id}/{uuid.uuid4()}.mfjson", "w") as f:
-                f.write(self.toMFJSON())
-        else:
-            with open(f"{file_path}/{self.route_id}/{uuid.uuid4()}.mfjson", "w") as f:
-                f.write(self.toMFJSON())
+    def save(self, file_path: str, batch_sink: "TrajectorySink | None" = None):
+        if batch_sink is not None:
+            # rolled up with the other trajectories of the route instead of one file per trajectory
+            batch_sink.add(self, f"{file_path}/{self.route_id}")
+            return
+        os.makedirs(f"{file_path}/{self.route_id}", mode=0o777, exist_ok=True)
+        with open(f"{file_path}/{self.route_id}/{uuid.uuid4()}.mfjson", "w") as f:
+            f.write(self.toMFJSON())
 
-    def savetos3(self, bucket: str, file_path: str):
-        upload_file(self.toMFJSON(), bucket, f"{file_path}/{uuid.uuid4()}.mfjson")
+    def savetos3(
+        self,
+        bucket: str,
+        file_path: str,
+        uploader: BackgroundUploader | None = None,
+        writer: MFJSONWriter | None = None,
+    ):
+        object_name = f"{file_path}/{uuid.uuid4()}.mfjson"
+        data: str | bytes = self.toMFJSON() if writer is None else writer.write(self)
+        content_encoding = None if writer is None else writer.content_encoding
+        if uploader is not None:
+            # hand off to the upload workers, only blocks when the upload queue is full
+            uploader.submit(data, bucket, object_name, content_encoding)
+        else:
+            upload_file(data, bucket, object_name, content_encoding=content_encoding)
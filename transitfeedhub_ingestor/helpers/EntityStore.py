@@ -0,0 +1,100 @@
+from collections.abc import Callable, Iterable, Iterator
+
+from transitfeedhub_ingestor.protobuf import gtfs_realtime_pb2
+
+from .Entity import Entity
+
+
+class EntityStore:
+    """Registry of in-flight Entity objects keyed by vehicle id.
+
+    Replaces the plain list previously held by VehiclePositionFeed so that lookup, insert and evict are O(1)
+    instead of a linear scan over every tracked vehicle. The raw epoch timestamp last applied to every entity is kept
+    alongside, so index_changes can tell unchanged vehicles apart without touching their entities.
+    """
+
+    def __init__(self):
+        self._entities: dict[str, Entity] = {}
+        self._last_timestamps: dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._entities)
+
+    def __iter__(self) -> Iterator[Entity]:
+        # iterate over a snapshot so callers can evict while looping
+        return iter(list(self._entities.values()))
+
+    def __contains__(self, entity_id: object) -> bool:
+        return entity_id in self._entities
+
+    def get(self, entity_id: str) -> Entity | None:
+        return self._entities.get(entity_id)
+
+    def add(self, entity: Entity):
+        """Inserts an entity, replacing any existing entity tracked under the same id."""
+        self._entities[entity.entity_id] = entity
+        self._last_timestamps[entity.entity_id] = entity.timestamps[-1]
+
+    def record(self, entity: Entity):
+        """Remembers the last timestamp of an entity updated outside of a reconcile, e.g. by a checkpoint replay."""
+        self._last_timestamps[entity.entity_id] = entity.timestamps[-1]
+
+    def evict(self, entity_id: str) -> Entity | None:
+        """Removes an entity from the store.
+
+        Args:
+            entity_id: vehicle id of the entity to remove
+
+        Returns:
+            The removed Entity, or None if the id was not tracked.
+        """
+        self._last_timestamps.pop(entity_id, None)
+        return self._entities.pop(entity_id, None)
+
+    def ids(self) -> set[str]:
+        return set(self._entities)
+
+    def clear(self):
+        self._entities.clear()
+        self._last_timestamps.clear()
+
+    def index_changes(
+        self,
+        feed_entities: Iterable[gtfs_realtime_pb2.VehiclePosition],
+        accept: Callable[[gtfs_realtime_pb2.VehiclePosition], bool] | None = None,
+    ) -> tuple[dict[str, gtfs_realtime_pb2.VehiclePosition], set[str]]:
+        """Indexes the vehicles of a feed message by vehicle id and finds the tracked ones left unchanged.
+
+        If a vehicle id appears more than once, the first occurrence wins. A vehicle is unchanged when its raw epoch
+        timestamp equals the last one applied to its entity. Only the vehicle id and timestamp are read, so unchanged
+        vehicles are skipped before any other field is extracted. The new timestamps are remembered right away: once the
+        message is reconciled every entity of a vehicle in it ends at the timestamp of that vehicle, whether it was
+        updated, created, split or cut into a segment.
+
+        Args:
+            feed_entities: A list of GTFS Realtime Binding Vehicle Positions
+            accept: optional filter, vehicles it rejects are left out of the index as if they were not in the feed,
+                later occurrences of their id included. Unchanged tracked vehicles were accepted before and are not
+                filtered again.
+
+        Returns:
+            Dictionary of vehicle id to Vehicle Position, and the ids of the tracked vehicles that did not change.
+        """
+        index: dict[str, gtfs_realtime_pb2.VehiclePosition] = {}
+        unchanged: set[str] = set()
+        # a rejected first occurrence also rejects the later ones
+        rejected: set[str] = set()
+        last_timestamps = self._last_timestamps
+        for feed_entity in feed_entities:
+            vehicle_id = feed_entity.vehicle.id
+            if vehicle_id not in index and vehicle_id not in rejected:
+                timestamp = feed_entity.timestamp
+                if last_timestamps.get(vehicle_id) == timestamp:
+                    index[vehicle_id] = feed_entity
+                    unchanged.add(vehicle_id)
+                elif accept is not None and not accept(feed_entity):
+                    rejected.add(vehicle_id)
+                else:
+                    index[vehicle_id] = feed_entity
+                    last_timestamps[vehicle_id] = timestamp
+        return index, unchanged
@@ -0,0 +1,193 @@
+import bisect
+import glob
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from array import array
+from collections.abc import Iterator
+
+from .setup_logger import logger
+
+_SEGMENT_MAGIC = b"TFHSEG1"
+# segment flags
+_FLAG_COMPRESSED = 0x01
+# feed timestamp, length of the stored payload
+_RECORD = struct.Struct("<QI")
+_HEADER_SIZE = len(_SEGMENT_MAGIC) + 1
+
+
+def _segment_start(path: str) -> int:
+    # segment-{timestamp}.seg, or segment-{timestamp}-{pid}.seg after a restart within the same second
+    return int(os.path.basename(path)[len("segment-") : -len(".seg")].split("-")[0])
+
+
+class FeedArchiveWriter:
+    """Appends raw feed payloads to rotating, length-prefixed segment files.
+
+    Every payload is written as (feed timestamp, length, payload) to the open segment
+    {directory}/segment-{first timestamp}.seg and a (timestamp, offset) pair is appended to the segment's .idx file,
+    so a reader can seek straight to a time window. Index timestamps never decrease, a payload older than its
+    predecessor is indexed at its predecessor's timestamp. Segments rotate once they reach max_segment_bytes or have
+    been open max_segment_age seconds. With compress every payload is zlib compressed on its own, which keeps records
+    individually addressable.
+
+    Args:
+        directory: directory holding the segments and their indexes
+        max_segment_bytes: rotate the segment once it holds this many bytes
+        max_segment_age: rotate the segment once it has been open this many seconds
+        compress: zlib compress the payloads of new segments
+        compresslevel: zlib compression level
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        max_segment_bytes: int = 256 * 1024 * 1024,
+        max_segment_age: float = 3600,
+        compress: bool = False,
+        compresslevel: int = 6,
+    ):
+        os.makedirs(directory, exist_ok=True)
+        self.directory: str = directory
+        self.max_segment_bytes: int = max_segment_bytes
+        self.max_segment_age: float = max_segment_age
+        self.compress: bool = compress
+        self.compresslevel: int = compresslevel
+        self.archived: int = 0
+        self._segment = None
+        self._index = None
+        self._opened: float = 0
+        self._last_timestamp: int = 0
+        self._lock = threading.Lock()
+
+    def append(self, payload: bytes, timestamp: int | None = None):
+        """Archives one payload.
+
+        Args:
+            payload: serialized FeedMessage as fetched
+            timestamp: FeedHeader timestamp of the payload, defaults to the current time
+        """
+        if timestamp is None:
+            timestamp = int(time.time())
+        stored = zlib.compress(payload, self.compresslevel) if self.compress else payload
+        with self._lock:
+            if self._segment is None or self._due():
+                self._rotate(timestamp)
+            segment, index = self._segment, self._index
+            if segment is None or index is None:
+                return
+            self._last_timestamp = max(self._last_timestamp, timestamp)
+            index.write(struct.pack("<QQ", self._last_timestamp, segment.tell()))
+            segment.write(_RECORD.pack(timestamp, len(stored)))
+            segment.write(stored)
+            # flushed so readers and a crash see every complete record
+            segment.flush()
+            index.flush()
+            self.archived += 1
+
+    def close(self):
+        with self._lock:
+            self._close_segment()
+
+    def _due(self) -> bool:
+        if self._segment is None:
+            return True
+        return self._segment.tell() >= self.max_segment_bytes or time.monotonic() - self._opened >= self.max_segment_age
+
+    def _rotate(self, timestamp: int):
+        self._close_segment()
+        path = os.path.join(self.directory, f"segment-{timestamp:012d}.seg")
+        if os.path.exists(path):
+            # a restart within the same second, keep the existing segment untouched
+            path = os.path.join(self.directory, f"segment-{timestamp:012d}-{os.getpid()}.seg")
+        self._segment = open(path, "wb")  # noqa: SIM115
+        self._segment.write(_SEGMENT_MAGIC + bytes([_FLAG_COMPRESSED if self.compress else 0]))
+        self._index = open(f"{path[: -len('.seg')]}.idx", "wb")  # noqa: SIM115
+        self._opened = time.monotonic()
+        logger.debug(f"Archiving feed payloads to {path}")
+
+    def _close_segment(self):
+        if self._segment is not None:
+            self._segment.close()
+            self._segment = None
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+
+
+class FeedArchiveReader:
+    """Iterates the payloads of a FeedArchiveWriter directory by time window.
+
+    Segments outside the window are skipped by their name and index, the others are memory mapped and read between
+    the indexed offsets of the window bounds, so a window can be replayed without loading whole segments. A segment
+    without a readable index is scanned from its start.
+
+    Args:
+        directory: directory holding the segments and their indexes
+    """
+
+    def __init__(self, directory: str):
+        self.directory: str = directory
+
+    def segments(self) -> list[str]:
+        return sorted(glob.glob(os.path.join(self.directory, "segment-*.seg")), key=lambda p: (_segment_start(p), p))
+
+    def iter_window(self, start: int = 0, end: int | None = None) -> Iterator[tuple[int, bytes]]:
+        """Yields (timestamp, payload) for every archived payload with start <= timestamp <= end.
+
+        Args:
+            start: first feed timestamp of the window
+            end: last feed timestamp of the window, open ended when None
+        """
+        for path in self.segments():
+            if end is not None and _segment_start(path) > end:
+                break
+            if os.path.getsize(path) < _HEADER_SIZE:
+                continue
+            timestamps, offsets = self._load_index(path)
+            if not offsets:
+                yield from self._read_segment(path, _HEADER_SIZE, None, start, end)
+                continue
+            if timestamps[-1] < start:
+                continue
+            first = bisect.bisect_left(timestamps, start)
+            last = len(offsets) if end is None else bisect.bisect_right(timestamps, end)
+            if first < last:
+                yield from self._read_segment(
+                    path, offsets[first], offsets[last] if last < len(offsets) else None, start, end
+                )
+
+    def _load_index(self, path: str) -> "tuple[array[int], array[int]]":
+        entries = array("Q")
+        try:
+            with open(f"{path[: -len('.seg')]}.idx", "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b""
+        # a torn index entry is dropped, its record is still found by scanning
+        entries.frombytes(data[: len(data) - len(data) % 16])
+        return entries[0::2], entries[1::2]
+
+    def _read_segment(
+        self, path: str, offset: int, stop: int | None, start: int, end: int | None
+    ) -> Iterator[tuple[int, bytes]]:
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as segment:
+            if segment[: len(_SEGMENT_MAGIC)] != _SEGMENT_MAGIC:
+                logger.warning(f"Skipping {path}, not a feed archive segment")
+                return
+            compressed = bool(segment[len(_SEGMENT_MAGIC)] & _FLAG_COMPRESSED)
+            pos = max(offset, _HEADER_SIZE)
+            stop = len(segment) if stop is None else min(stop, len(segment))
+            while pos + _RECORD.size <= stop:
+                timestamp, length = _RECORD.unpack_from(segment, pos)
+                pos += _RECORD.size
+                if pos + length > len(segment):
+                    logger.warning(f"Ignoring torn archive record at {pos} in {path}")
+                    return
+                if start <= timestamp and (end is None or timestamp <= end):
+                    payload = segment[pos : pos + length]
+                    yield timestamp, zlib.decompress(payload) if compressed else payload
+                pos += length
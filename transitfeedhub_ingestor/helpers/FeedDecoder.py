@@ -0,0 +1,170 @@
+import threading
+from collections.abc import Collection, Iterator
+from functools import cache
+from typing import Any, cast
+
+from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
+from google.protobuf.message import Message
+
+from transitfeedhub_ingestor.protobuf import gtfs_realtime_pb2
+
+from .setup_logger import logger
+
+# fields of the GTFS Realtime messages nothing downstream of get_entities reads, left out by the minimal decode.
+# Entity reads every field of VehiclePosition, so only what surrounds it is pruned.
+MINIMAL_DROPPED_FIELDS: dict[str, tuple[str, ...]] = {
+    "FeedEntity": ("trip_update", "alert", "shape", "stop", "trip_modifications"),
+    "TripDescriptor": ("modified_trip",),
+    "VehicleDescriptor": ("wheelchair_accessible",),
+}
+
+
+def protobuf_backend() -> str:
+    """Name of the active protobuf implementation: "upb", "cpp" or "python"."""
+    try:
+        from google.protobuf.internal import api_implementation
+    except ImportError:
+        return "unknown"
+    return api_implementation.Type()
+
+
+def report_protobuf_backend() -> str:
+    """Logs which protobuf implementation decodes the feeds, the pure Python one parses an order of magnitude slower.
+
+    Returns:
+        Name of the backend, see protobuf_backend.
+    """
+    backend = protobuf_backend()
+    if backend in ("upb", "cpp"):
+        logger.info(f"Decoding feeds with the {backend} protobuf backend")
+    else:
+        logger.warning(
+            f"Decoding feeds with the {backend} protobuf backend, install a protobuf wheel with the upb backend "
+            "and unset PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION for faster parsing"
+        )
+    return backend
+
+
+@cache
+def minimal_feed_message_class(keep: tuple[str, ...] = ()) -> type[Message]:
+    """FeedMessage class of a copy of the GTFS Realtime schema without the MINIMAL_DROPPED_FIELDS.
+
+    The wire format is unchanged, so it parses the same payloads. Dropped fields are skipped as unknown fields instead
+    of being decoded into messages, which saves most of the parse time of feeds combining trip updates or alerts with
+    the vehicle positions. The schema lives in a private pool so it never clashes with gtfs_realtime_pb2.
+
+    Args:
+        keep: FeedEntity fields to decode in addition to vehicle, e.g. the fields of the accumulators of a feed
+    """
+    proto = descriptor_pb2.FileDescriptorProto()
+    gtfs_realtime_pb2.DESCRIPTOR.CopyToProto(proto)
+    for message in proto.message_type:
+        dropped = set(MINIMAL_DROPPED_FIELDS.get(message.name, ()))
+        if message.name == "FeedEntity":
+            dropped -= set(keep)
+        if dropped:
+            kept = [field for field in message.field if field.name not in dropped]
+            del message.field[:]
+            message.field.extend(kept)
+    pool = descriptor_pool.DescriptorPool()
+    pool.Add(proto)
+    return message_factory.GetMessageClass(pool.FindMessageTypeByName(f"{proto.package}.FeedMessage"))
+
+
+class VehicleEntities(Collection[gtfs_realtime_pb2.VehiclePosition]):
+    """Lazy view of the Vehicle Positions of a decoded FeedMessage.
+
+    Iterating yields the vehicle of every entity that has one, without building a list of them. The view stays valid
+    until it is released back to its FeedDecoder, which VehiclePositionFeed.reconcile does at the end of the cycle.
+    """
+
+    __slots__ = ("_length", "message")
+
+    def __init__(self, message: Message):
+        self.message: Any = message
+        self._length: int | None = None
+
+    @property
+    def header_timestamp(self) -> int:
+        return self.message.header.timestamp
+
+    def __iter__(self) -> Iterator[gtfs_realtime_pb2.VehiclePosition]:
+        for entity in self.message.entity:
+            if entity.HasField("vehicle"):
+                yield entity.vehicle
+
+    def __len__(self) -> int:
+        if self._length is None:
+            self._length = sum(1 for entity in self.message.entity if entity.HasField("vehicle"))
+        return self._length
+
+    def __contains__(self, item: object) -> bool:
+        return any(vehicle == item for vehicle in self)
+
+    def of(self, field: str) -> Iterator[Any]:
+        """Yields the field of every entity that has it, e.g. "trip_update" or "alert" of a combined feed."""
+        for entity in self.message.entity:
+            if entity.HasField(field):
+                yield getattr(entity, field)
+
+
+class FeedDecoder:
+    """Decodes FeedMessage payloads into lazy VehicleEntities views.
+
+    With reuse, decoded messages are cleared and parsed into again once released instead of allocating a new message
+    every cycle. That only pays off with the pure Python backend. upb clears a large message slower than it allocates a
+    new one and never gives the arena of a cleared message back, so a reused message grows by a payload every cycle.
+    Reuse therefore defaults to on for the python backend only.
+
+    Args:
+        minimal: decode with minimal_feed_message_class, skipping the fields nothing downstream reads
+        keep: FeedEntity fields the minimal decode keeps in addition to vehicle, see minimal_feed_message_class
+        reuse: reuse released messages, by default only with the pure Python backend
+        max_free: released messages kept for reuse, one per cycle of the feed that can be in flight
+    """
+
+    def __init__(self, minimal: bool = False, keep: tuple[str, ...] = (), reuse: bool | None = None, max_free: int = 2):
+        self.minimal: bool = minimal
+        backend = protobuf_backend()
+        self.reuse: bool = backend == "python" if reuse is None else reuse
+        if self.reuse and backend == "upb":
+            logger.warning("Reusing FeedMessages with the upb protobuf backend grows their arena every cycle")
+        self.max_free: int = max_free
+        self._message_class: type[Message] = (
+            minimal_feed_message_class(keep) if minimal else gtfs_realtime_pb2.FeedMessage
+        )
+        self._free: list[Message] = []
+        self._lock = threading.Lock()
+
+    def decode(self, content: bytes) -> VehicleEntities:
+        """Parses a serialized FeedMessage.
+
+        Raises:
+            DecodeError: the payload is not a valid FeedMessage
+        """
+        message = None
+        if self.reuse:
+            with self._lock:
+                if self._free:
+                    message = self._free.pop()
+        if message is None:
+            message = self._message_class()
+        try:
+            message.ParseFromString(content)
+        except Exception:
+            self._recycle(message)
+            raise
+        return VehicleEntities(message)
+
+    def release(self, entities: Collection[gtfs_realtime_pb2.VehiclePosition] | None):
+        """Hands the message behind a view back for reuse, the view and its vehicles must not be used afterwards."""
+        if self.reuse and isinstance(entities, VehicleEntities):
+            self._recycle(cast(Message, entities.message))
+
+    def _recycle(self, message: Message):
+        if not self.reuse or not isinstance(message, self._message_class):
+            return
+        message.Clear()
+        with self._lock:
+            if len(self._free) < self.max_free:
+                self._free.append(message)
@@ -0,0 +1,490 @@
+import asyncio
+import json
+import math
+import random
+import statistics
+import time
+from collections import deque
+from collections.abc import Collection
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+
+from transitfeedhub_ingestor.protobuf import gtfs_realtime_pb2
+
+from .BatchSink import BatchSink, TrajectorySink, s3_publisher
+from .Checkpoint import Checkpointer
+from .DiskSink import DiskSink
+from .Entity import RunLengthPolicy, SegmentPolicy
+from .FeedArchive import FeedArchiveWriter
+from .FeedDecoder import FeedDecoder
+from .IngestFilter import IngestFilter
+from .Metrics import MetricsRegistry
+from .MFJSONWriter import MFJSONWriter
+from .s3Uploader import BackgroundUploader
+from .setup_logger import logger
+from .StaticGTFS import StaticGTFS
+from .TripUpdates import TripUpdateAccumulator
+from .VehiclePositionFeed import VehiclePositionFeed
+
+
+class AdaptivePoll:
+    """Learns the publish cadence of a feed and times its polls just after the next expected publish.
+
+    The cadence is the median of the last deltas between new FeedHeader timestamps, the lag the smallest delay seen
+    between a FeedHeader timestamp and the payload becoming available, which covers the publish latency and clock skew
+    of the server. Polls are aimed margin seconds after the header timestamp of the last payload plus cadence and lag.
+    A poll that finds the feed unchanged was early and is retried after retry seconds, doubling up to the cadence, so
+    the lag is known to about retry seconds. Errors and empty payloads (e.g. overnight without service) back off
+    exponentially from the cadence up to max_backoff, the first new payload restores the learned cadence. Until a
+    cadence is learned the feed is probed every retry seconds: polling slower than the feed publishes would only ever
+    see multiples of its cadence.
+
+    Args:
+        min_interval: lower bound in seconds of the learned cadence
+        max_interval: upper bound in seconds of the learned cadence, longer deltas (e.g. after a backoff) are ignored
+        margin: seconds to wait after the expected publish
+        retry: seconds before polling again after an early poll
+        backoff: factor the delay grows by with every consecutive error or empty payload
+        max_backoff: upper bound in seconds of the backoff delay
+        window: header timestamp deltas and lags the estimates are taken over
+    """
+
+    def __init__(
+        self,
+        min_interval: float = 5.0,
+        max_interval: float = 120.0,
+        margin: float = 1.0,
+        retry: float = 2.0,
+        backoff: float = 2.0,
+        max_backoff: float = 900.0,
+        window: int = 9,
+    ):
+        self.min_interval: float = min_interval
+        self.max_interval: float = max_interval
+        self.margin: float = margin
+        self.retry: float = retry
+        self.backoff: float = backoff
+        self.max_backoff: float = max_backoff
+        self._deltas: deque[float] = deque(maxlen=window)
+        self._lags: deque[float] = deque(maxlen=window)
+        self.last_header_timestamp: int | None = None
+        # consecutive polls that found the feed unchanged, and that failed or returned no vehicles
+        self.early_polls: int = 0
+        self.failures: int = 0
+        # polls that returned a new payload, and the seconds between its header timestamp and the fetch
+        self.new_payloads: int = 0
+        self.staleness_seconds: float = 0.0
+
+    @property
+    def cadence(self) -> float | None:
+        if not self._deltas:
+            return None
+        return min(max(statistics.median(self._deltas), self.min_interval), self.max_interval)
+
+    @property
+    def lag(self) -> float:
+        return min(self._lags) if self._lags else 0.0
+
+    def observe(self, feed_entities: Collection[Any] | None, header_timestamp: int | None, now: float):
+        """Records the outcome of a fetch, see VehiclePositionFeed.get_entities.
+
+        Args:
+            feed_entities: the fetched Vehicle Positions, None if the feed had not changed
+            header_timestamp: FeedHeader timestamp of the last new payload
+            now: wall clock time the fetch returned at
+        """
+        if feed_entities is None:
+            self.early_polls += 1
+            return
+        if len(feed_entities) == 0:
+            # get_entities returns no vehicles both for empty feeds and for swallowed errors
+            self.failed()
+            return
+        early_polls = self.early_polls
+        self.failures = 0
+        self.early_polls = 0
+        self.new_payloads += 1
+        if not header_timestamp:
+            return
+        previous = self.last_header_timestamp
+        if previous is not None and 0 < header_timestamp - previous <= self.max_interval:
+            self._deltas.append(header_timestamp - previous)
+        self.last_header_timestamp = header_timestamp
+        staleness = now - header_timestamp
+        self.staleness_seconds += staleness
+        # a poll that was not preceded by an early one only bounds the lag, without the margin it was aimed at it
+        # would creep up by the margin with every window
+        self._lags.append(staleness if early_polls else staleness - self.margin)
+
+    def failed(self):
+        """Records a failed cycle."""
+        self.failures += 1
+        self.early_polls = 0
+
+    def next_delay(self, now: float, interval: float) -> float:
+        """Seconds to wait before the next poll.
+
+        Args:
+            now: current wall clock time
+            interval: fixed interval of the schedule, the base of the backoff until a cadence is learned
+        """
+        cadence = self.cadence
+        if self.failures:
+            return min((cadence or interval) * self.backoff**self.failures, self.max_backoff)
+        if cadence is None or self.last_header_timestamp is None:
+            return min(interval, self.retry)
+        if self.early_polls:
+            return min(self.retry * self.backoff ** (self.early_polls - 1), cadence)
+        expected = self.last_header_timestamp + cadence + self.lag + self.margin
+        if expected <= now:
+            # polls fell behind, aim at the next publish instead of the missed ones
+            expected += math.ceil((now - expected) / cadence) * cadence
+        return expected - now
+
+
+class FeedSchedule:
+    """Polling settings for a single feed hosted by the FeedScheduler.
+
+    Args:
+        feed: the VehiclePositionFeed to poll
+        interval: seconds between the start of two cycles. Defaults to feed.timeout, which is re-read every cycle.
+        jitter: upper bound in seconds of a random delay added to every tick. The delay is not carried over to the
+            next tick, so jitter never accumulates into drift.
+        max_concurrency: maximum number of cycles of this feed in flight at once. The fetches of a feed run one at
+            a time, as they update its validators and last header timestamp, and reconcile runs one cycle at a time in
+            tick order, so a cycle only overlaps the previous one by fetching while it reconciles. Ticks that arrive
+            while the limit is reached are skipped.
+        adaptive: optional AdaptivePoll timing each poll after the previous cycle instead of the fixed rate, one
+            cycle at a time. interval is then only the base of the backoff until the cadence of the feed is learned.
+    """
+
+    def __init__(
+        self,
+        feed: VehiclePositionFeed,
+        interval: float | None = None,
+        jitter: float = 0.0,
+        max_concurrency: int = 1,
+        adaptive: AdaptivePoll | None = None,
+    ):
+        self.feed: VehiclePositionFeed = feed
+        self._interval: float | None = interval
+        self.jitter: float = jitter
+        self.max_concurrency: int = max(max_concurrency, 1)
+        self.adaptive: AdaptivePoll | None = adaptive
+        self.cycles: int = 0
+        self.skipped_ticks: int = 0
+        self.errors: int = 0
+
+    @property
+    def interval(self) -> float:
+        return self._interval if self._interval is not None else self.feed.timeout
+
+
+class FeedScheduler:
+    """Hosts many feeds in one process on a single asyncio event loop.
+
+    Each feed runs on its own fixed-rate cadence: ticks are anchored to the time the feed was started rather than to
+    the end of the previous cycle, so fetch, parse and upload time do not push later cycles back. Feeds with an
+    AdaptivePoll are instead polled just after their next expected publish. Blocking work
+    (network I/O, protobuf parsing, reconcile and uploads) is run in a shared thread pool so a slow feed never blocks
+    the others.
+
+    Args:
+        schedules: one FeedSchedule per feed
+        max_workers: size of the thread pool shared by all feeds. Defaults to one thread per cycle that can be in
+            flight, the sum of the max_concurrency of the schedules, so feeds stuck in a fetch never hold the threads
+            the other feeds need.
+        fail_fast: stop every feed and re-raise from run when a cycle raises SystemExit (a catastrophic request
+            error), instead of counting it as an error of its feed. Used by supervised workers, which are restarted.
+    """
+
+    def __init__(self, schedules: list[FeedSchedule], max_workers: int | None = None, fail_fast: bool = False):
+        self.schedules: list[FeedSchedule] = schedules
+        self.max_workers: int = (
+            max_workers
+            if max_workers is not None
+            else max(sum(1 if s.adaptive is not None else s.max_concurrency for s in schedules), 1)
+        )
+        self.fail_fast: bool = fail_fast
+        self._stopping: asyncio.Event | None = None
+        self._executor: ThreadPoolExecutor | None = None
+        self._fatal: SystemExit | None = None
+        # fetches in flight, cancelled by _abandon once the until of stop passes
+        self._fetches: set[asyncio.Future[Collection[gtfs_realtime_pb2.VehiclePosition] | None]] = set()
+        self._abandon_handle: asyncio.TimerHandle | None = None
+        self._abandoned: bool = False
+
+    def stop(self, until: float | None = None):
+        """Stops scheduling new cycles. Cycles already in flight are allowed to finish.
+
+        Must be called from the event loop, e.g. by a signal handler added with add_signal_handler.
+
+        Args:
+            until: optional time.monotonic() time run stops waiting at, e.g. the end of a shutdown grace period.
+                Cycles still fetching then are abandoned: their fetch finishes in the background and its payload is
+                dropped, so a hung feed cannot hold up the shutdown for its whole request timeout. Cycles already
+                reconciling are still awaited.
+        """
+        if self._stopping is None:
+            return
+        self._stopping.set()
+        if until is not None and self._abandon_handle is None:
+            loop = asyncio.get_running_loop()
+            self._abandon_handle = loop.call_later(max(until - time.monotonic(), 0.0), self._abandon)
+
+    async def run(self):
+        self._stopping = asyncio.Event()
+        self._abandoned = False
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="feed")
+        try:
+            await asyncio.gather(*(self._run_schedule(schedule, self._stopping) for schedule in self.schedules))
+        finally:
+            if self._abandon_handle is not None:
+                self._abandon_handle.cancel()
+                self._abandon_handle = None
+            # the threads of abandoned fetches are not waited for
+            self._executor.shutdown(wait=not self._abandoned, cancel_futures=True)
+            self._executor = None
+        if self._fatal is not None:
+            raise self._fatal
+
+    def close(self, timeout: float | None = None):
+        """Drains the accumulators, flushes the batch sinks and closes the checkpointers and archives of every feed.
+
+        Args:
+            timeout: optional seconds flushing the batch sinks may take, e.g. what is left of a shutdown grace period
+        """
+        until = None if timeout is None else time.monotonic() + timeout
+        for schedule in self.schedules:
+            feed = schedule.feed
+            feed.drain_accumulators()
+            if feed.batch_sink is not None:
+                feed.batch_sink.flush(None if until is None else max(until - time.monotonic(), 0.0))
+            if feed.checkpointer is not None:
+                feed.checkpointer.close()
+            if feed.archive is not None:
+                feed.archive.close()
+
+    async def _run_schedule(self, schedule: FeedSchedule, stopping: asyncio.Event):
+        if schedule.adaptive is not None:
+            await self._run_adaptive(schedule, schedule.adaptive, stopping)
+            return
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(schedule.max_concurrency)
+        fetching = asyncio.Lock()
+        in_flight: set[asyncio.Task[None]] = set()
+        previous: asyncio.Task[None] | None = None
+
+        interval = schedule.interval
+        start = loop.time()
+        tick = 0
+        while not stopping.is_set():
+            deadline = start + tick * interval + random.uniform(0, schedule.jitter)  # noqa: S311
+            try:
+                await asyncio.wait_for(stopping.wait(), timeout=max(deadline - loop.time(), 0))
+                break
+            except asyncio.TimeoutError:
+                pass
+
+            if slots.locked():
+                schedule.skipped_ticks += 1
+                logger.warning(f"Skipping tick for {schedule.feed.url}, {schedule.max_concurrency} cycle(s) in flight")
+            else:
+                await slots.acquire()
+                previous = asyncio.create_task(self._cycle(schedule, slots, fetching, previous))
+                in_flight.add(previous)
+                previous.add_done_callback(in_flight.discard)
+
+            if schedule.interval != interval:
+                # timeout was changed by the feed (e.g. backoff after an error), re-anchor the cadence
+                interval = schedule.interval
+                start = loop.time()
+                tick = 1
+            else:
+                # fixed rate: ticks that were missed while the loop was busy are not replayed
+                tick = max(tick + 1, math.floor((loop.time() - start) / interval) + 1)
+
+        if in_flight:
+            await asyncio.gather(*in_flight, return_exceptions=True)
+
+    async def _run_adaptive(self, schedule: FeedSchedule, adaptive: AdaptivePoll, stopping: asyncio.Event):
+        slots = asyncio.Semaphore(1)
+        fetching = asyncio.Lock()
+        while not stopping.is_set():
+            await slots.acquire()
+            await self._cycle(schedule, slots, fetching, None)
+            delay = adaptive.next_delay(time.time(), schedule.interval)
+            delay += random.uniform(0, schedule.jitter)  # noqa: S311
+            try:
+                await asyncio.wait_for(stopping.wait(), timeout=delay)
+                break
+            except asyncio.TimeoutError:
+                pass
+
+    def _abandon(self):
+        self._abandoned = True
+        if self._fetches:
+            logger.warning(f"Abandoning {len(self._fetches)} fetch(es) still in flight at the shutdown deadline")
+        for fetch in list(self._fetches):
+            fetch.cancel()
+
+    async def _fetch(self, feed: VehiclePositionFeed) -> Collection[gtfs_realtime_pb2.VehiclePosition] | None:
+        fetch = asyncio.get_running_loop().run_in_executor(self._executor, feed.get_entities)
+        self._fetches.add(fetch)
+        try:
+            return await fetch
+        finally:
+            self._fetches.discard(fetch)
+
+    async def _cycle(
+        self,
+        schedule: FeedSchedule,
+        slots: asyncio.Semaphore,
+        fetching: asyncio.Lock,
+        previous: asyncio.Task[None] | None,
+    ):
+        loop = asyncio.get_running_loop()
+        feed = schedule.feed
+        try:
+            async with fetching:
+                # cycles still waiting for the fetch of the previous one when it was abandoned find nothing
+                feed_entities = None if self._abandoned else await self._fetch(feed)
+            if schedule.adaptive is not None:
+                schedule.adaptive.observe(feed_entities, feed.last_header_timestamp, time.time())
+            if previous is not None:
+                # reconcile snapshots in the order they were requested
+                await asyncio.gather(previous, return_exceptions=True)
+            await loop.run_in_executor(self._executor, feed.reconcile, feed_entities)
+            schedule.cycles += 1
+        except asyncio.CancelledError:
+            # only the fetch was cancelled by _abandon, the cycle ends like one that found nothing
+            if not self._abandoned:
+                raise
+        except SystemExit as e:
+            schedule.errors += 1
+            if schedule.adaptive is not None:
+                schedule.adaptive.failed()
+            logger.exception(f"Cycle failed for {feed.url}")
+            if self.fail_fast:
+                self._fatal = e
+                self.stop()
+        except Exception:
+            # a failing feed must not take down the other feeds hosted by this process
+            schedule.errors += 1
+            if schedule.adaptive is not None:
+                schedule.adaptive.failed()
+            logger.exception(f"Cycle failed for {feed.url}")
+        finally:
+            slots.release()
+
+
+def load_feed_schedules(
+    path: str, uploader: BackgroundUploader | None = None, metrics: MetricsRegistry | None = None
+) -> list[FeedSchedule]:
+    """Reads a multi-feed JSON config, see feed_schedules.
+
+    Args:
+        path: path to the JSON config file
+        uploader: optional background upload pool shared by all feeds
+        metrics: optional registry every feed reports its metrics to, labelled with its agency
+
+    Returns:
+        One FeedSchedule per configured feed.
+    """
+    with open(path) as f:
+        config: list[dict[str, Any]] = json.load(f)
+    return feed_schedules(config, uploader, metrics)
+
+
+def feed_schedules(
+    config: list[dict[str, Any]], uploader: BackgroundUploader | None = None, metrics: MetricsRegistry | None = None
+) -> list[FeedSchedule]:
+    """Builds the feeds of a multi-feed config.
+
+    The config is a list of objects with the VehiclePositionFeed arguments (url, agency, s3_bucket and optionally
+    file_path, headers, query_params, https_verify, timeout), the optional MF-JSON output settings compact and gzip,
+    plus the optional FeedSchedule settings jitter and max_concurrency. An optional "adaptive" object (AdaptivePoll
+    arguments) polls the feed after its learned publish cadence instead of every timeout seconds. An optional "batch"
+    object (BatchSink arguments output_format, max_bytes, max_count, max_age) rolls trajectories up per agency, date and
+    route, an optional "disk" object (DiskSink arguments root, output_format, max_bytes, max_age, fsync_interval)
+    appends them to segment files on local disk instead. With "checkpoint_dir" (and optionally "snapshot_interval" in
+    cycles) the in-flight entities are checkpointed there and restored before the first poll. An optional "archive"
+    object (FeedArchiveWriter arguments directory, max_segment_bytes, max_segment_age, compress) keeps every new raw
+    payload. An optional "run_length" object (RunLengthPolicy arguments distance and bearing) collapses unchanged
+    observations into runs and an optional "simplify" tolerance in metres simplifies trajectories when they are saved.
+    An optional "segments" object (SegmentPolicy arguments max_points, max_age, max_bytes and memory_budget) cuts
+    long-lived trajectories into rolling segments. With "minimal_decode" payloads are decoded without the fields nothing
+    reads, such as the trip updates and alerts of combined feeds. With "trip_updates" set to true the trip updates of a
+    combined feed are collected into delay series from the same payloads, see TripUpdateAccumulator. An optional
+    "filter" object (routes, agencies, agency_separator, a "geofence" GeoJSON path and the "cells" of its grid, see
+    IngestFilter.from_config) only ingests the vehicles of those routes and agencies inside the service area. An
+    optional "static_gtfs" object (StaticGTFS.load arguments path of the GTFS zip and cache_dir) adds the route names,
+    trip headsigns and stop names of the static feed to the trajectories.
+
+    Args:
+        config: one object per feed
+        uploader: optional background upload pool shared by all feeds
+        metrics: optional registry every feed reports its metrics to, labelled with its agency
+
+    Returns:
+        One FeedSchedule per configured feed.
+    """
+    schedules: list[FeedSchedule] = []
+    for feed_config in config:
+        agency: str = feed_config["agency"]
+        gtfs = StaticGTFS.load(**feed_config["static_gtfs"]) if "static_gtfs" in feed_config else None
+        batch_sink: TrajectorySink | None = None
+        if "disk" in feed_config:
+            batch_sink = DiskSink(**feed_config["disk"], gtfs=gtfs)
+        elif "batch" in feed_config:
+            batch_sink = BatchSink(
+                s3_publisher(feed_config["s3_bucket"], uploader),
+                gzip=feed_config.get("gzip", False),
+                gtfs=gtfs,
+                **feed_config["batch"],
+            )
+        # a flag, an empty object as written by older configs enables it too
+        accumulators = [TripUpdateAccumulator()] if feed_config.get("trip_updates") not in (None, False) else []
+        checkpointer = None
+        if "checkpoint_dir" in feed_config:
+            # left to the Checkpointer default unless the config sets it
+            interval = (
+                {"snapshot_interval": feed_config["snapshot_interval"]} if "snapshot_interval" in feed_config else {}
+            )
+            checkpointer = Checkpointer(feed_config["checkpoint_dir"], **interval)
+        feed = VehiclePositionFeed(
+            feed_config["url"],
+            agency,
+            feed_config.get("file_path", f"./data/{agency}"),
+            s3_bucket=feed_config["s3_bucket"],
+            headers=feed_config.get("headers"),
+            query_params=feed_config.get("query_params"),
+            https_verify=feed_config.get("https_verify", True),
+            timeout=feed_config.get("timeout", 30),
+            uploader=uploader,
+            writer=MFJSONWriter(
+                compact=feed_config.get("compact", True), gzip=feed_config.get("gzip", False), gtfs=gtfs
+            ),
+            batch_sink=batch_sink,
+            checkpointer=checkpointer,
+            archive=FeedArchiveWriter(**feed_config["archive"]) if "archive" in feed_config else None,
+            run_length=RunLengthPolicy(**feed_config["run_length"]) if "run_length" in feed_config else None,
+            simplify=feed_config.get("simplify"),
+            segments=SegmentPolicy(**feed_config["segments"]) if "segments" in feed_config else None,
+            metrics=metrics.feed(agency) if metrics is not None else None,
+            decoder=FeedDecoder(
+                minimal=feed_config.get("minimal_decode", False), keep=tuple(a.field for a in accumulators)
+            ),
+            accumulators=accumulators,
+            ingest_filter=IngestFilter.from_config(feed_config["filter"]) if "filter" in feed_config else None,
+        )
+        feed.restore()
+        schedules.append(
+            FeedSchedule(
+                feed,
+                jitter=feed_config.get("jitter", 0.0),
+                max_concurrency=feed_config.get("max_concurrency", 1),
+                adaptive=AdaptivePoll(**feed_config["adaptive"]) if "adaptive" in feed_config else None,
+            )
+        )
+    return schedules
@@ -0,0 +1,210 @@
+import json
+import math
+from array import array
+from collections.abc import Collection, Sequence
+from typing import Any
+
+from transitfeedhub_ingestor.protobuf import gtfs_realtime_pb2
+
+# (x1, y1, x2, y2, polygon) of one ring edge, in degrees of longitude and latitude
+_Edge = tuple[float, float, float, float, int]
+# a ring is a closed sequence of (longitude, latitude), a polygon its outer ring followed by its holes
+Ring = Sequence[Sequence[float]]
+
+_OUTSIDE, _INSIDE, _BOUNDARY = 0, 1, 2
+
+
+class EmptyGeofenceError(ValueError):
+    """Raised when a Geofence is built without any polygon edge."""
+
+
+def _polygon_edges(polygons: Sequence[Sequence[Ring]]) -> list[_Edge]:
+    edges: list[_Edge] = []
+    for index, polygon in enumerate(polygons):
+        for ring in polygon:
+            for (x1, y1), (x2, y2) in zip(ring, [*ring[1:], ring[0]]):
+                if (x1, y1) != (x2, y2):
+                    edges.append((x1, y1, x2, y2, index))
+    return edges
+
+
+class Geofence:
+    """Point-in-polygon test of WGS 84 positions against service area polygons, backed by a uniform grid.
+
+    The bounding box of the polygons is cut into square cells, about cells along its longer side. Cells no polygon edge
+    passes through are entirely inside or outside and answer a lookup with a single array read. Only points in a cell
+    on a boundary are ray cast, against the edges of their grid row. Polygons are tested in plain longitude and
+    latitude, which is exact enough for service areas away from the poles and the antimeridian. Holes are supported,
+    overlapping polygons are combined as a union.
+
+    Args:
+        polygons: every polygon as its outer ring followed by its holes, rings as (longitude, latitude) pairs
+        cells: grid cells along the longer side of the bounding box
+    """
+
+    def __init__(self, polygons: Sequence[Sequence[Ring]], cells: int = 256):
+        edges = _polygon_edges(polygons)
+        if not edges:
+            raise EmptyGeofenceError()
+        self.min_lon: float = min(min(e[0], e[2]) for e in edges)
+        self.min_lat: float = min(min(e[1], e[3]) for e in edges)
+        self.max_lon: float = max(max(e[0], e[2]) for e in edges)
+        self.max_lat: float = max(max(e[1], e[3]) for e in edges)
+        self.cell: float = max(self.max_lon - self.min_lon, self.max_lat - self.min_lat) / max(cells, 1) or 1.0
+        self.columns: int = max(math.ceil((self.max_lon - self.min_lon) / self.cell), 1)
+        self.rows: int = max(math.ceil((self.max_lat - self.min_lat) / self.cell), 1)
+
+        # edges whose latitude span overlaps each row, every horizontal ray through the row only crosses these
+        self._row_edges: list[list[_Edge]] = [[] for _ in range(self.rows)]
+        self._cells: array[int] = array("b", bytes(self.columns * self.rows))
+        for edge in edges:
+            x1, y1, x2, y2, _ = edge
+            row_range = range(self._row(min(y1, y2)), self._row(max(y1, y2)) + 1)
+            for row in row_range:
+                self._row_edges[row].append(edge)
+                # conservative: every cell of the bounding box of the edge is treated as a boundary cell
+                for column in range(self._column(min(x1, x2)), self._column(max(x1, x2)) + 1):
+                    self._cells[row * self.columns + column] = _BOUNDARY
+        self._classify()
+
+    def _classify(self):
+        # a cell no edge passes through is on one side of every boundary, its centre decides for the whole cell. The
+        # centres of a row are swept right to left so the crossings of the row are counted once instead of per cell.
+        for row in range(self.rows):
+            lat = self.min_lat + (row + 0.5) * self.cell
+            crossings = sorted(
+                (
+                    ((x2 - x1) * (lat - y1) / (y2 - y1) + x1, polygon)
+                    for x1, y1, x2, y2, polygon in self._row_edges[row]
+                    if (y1 > lat) != (y2 > lat)
+                ),
+                reverse=True,
+            )
+            inside = 0
+            crossed = 0
+            for column in range(self.columns - 1, -1, -1):
+                lon = self.min_lon + (column + 0.5) * self.cell
+                while crossed < len(crossings) and crossings[crossed][0] > lon:
+                    inside ^= 1 << crossings[crossed][1]
+                    crossed += 1
+                index = row * self.columns + column
+                if self._cells[index] != _BOUNDARY:
+                    self._cells[index] = _INSIDE if inside else _OUTSIDE
+
+    @classmethod
+    def from_geojson(cls, geojson: str | dict[str, Any], cells: int = 256) -> "Geofence":
+        """Builds a Geofence from the Polygons and MultiPolygons of a GeoJSON file path or object.
+
+        Raises:
+            EmptyGeofenceError: if the GeoJSON holds no polygon.
+        """
+        root: dict[str, Any]
+        if isinstance(geojson, str):
+            with open(geojson) as f:
+                root = json.load(f)
+        else:
+            root = geojson
+        polygons: list[Sequence[Ring]] = []
+        pending: list[dict[str, Any]] = [root]
+        while pending:
+            obj = pending.pop()
+            kind = obj.get("type")
+            if kind == "FeatureCollection":
+                pending.extend(obj["features"])
+            elif kind == "Feature" and obj.get("geometry"):
+                pending.append(obj["geometry"])
+            elif kind == "GeometryCollection":
+                pending.extend(obj["geometries"])
+            elif kind == "Polygon":
+                polygons.append(obj["coordinates"])
+            elif kind == "MultiPolygon":
+                polygons.extend(obj["coordinates"])
+        return cls(polygons, cells)
+
+    def _row(self, lat: float) -> int:
+        return min(max(int((lat - self.min_lat) / self.cell), 0), self.rows - 1)
+
+    def _column(self, lon: float) -> int:
+        return min(max(int((lon - self.min_lon) / self.cell), 0), self.columns - 1)
+
+    def _cast(self, row: int, lon: float, lat: float) -> bool:
+        # even-odd rule per polygon along a ray towards +longitude, inside if inside any polygon
+        inside = 0
+        for x1, y1, x2, y2, polygon in self._row_edges[row]:
+            if (y1 > lat) != (y2 > lat) and lon < (x2 - x1) * (lat - y1) / (y2 - y1) + x1:
+                inside ^= 1 << polygon
+        return inside != 0
+
+    def contains(self, lon: float, lat: float) -> bool:
+        if not (self.min_lon <= lon <= self.max_lon and self.min_lat <= lat <= self.max_lat):
+            return False
+        row = self._row(lat)
+        state = self._cells[row * self.columns + self._column(lon)]
+        if state == _BOUNDARY:
+            return self._cast(row, lon, lat)
+        return state == _INSIDE
+
+
+class IngestFilter:
+    """Decides which vehicles of a feed are ingested, before any Entity is created for them.
+
+    Vehicles must match the route allow list, the agency allow list and lie inside the geofence, each check is skipped
+    when it is not configured. GTFS Realtime vehicles carry no agency, so agencies match the prefix regional aggregators
+    put in front of their route ids (e.g. "SF" of "SF:14"). Rejected vehicles are treated as absent from the feed: a
+    tracked vehicle that leaves the geofence or changes to a filtered route is saved out.
+
+    Args:
+        routes: route ids to keep
+        agencies: route id prefixes to keep
+        agency_separator: separator between the agency prefix and the route id
+        geofence: service area vehicles must be inside of
+    """
+
+    def __init__(
+        self,
+        routes: Collection[str] | None = None,
+        agencies: Collection[str] | None = None,
+        agency_separator: str = ":",
+        geofence: Geofence | None = None,
+    ):
+        self.routes: frozenset[str] | None = frozenset(routes) if routes is not None else None
+        self.agencies: frozenset[str] | None = frozenset(agencies) if agencies is not None else None
+        self.agency_separator: str = agency_separator
+        self.geofence: Geofence | None = geofence
+        # vehicles rejected by the route or agency allow lists and by the geofence
+        self.rejected_routes: int = 0
+        self.rejected_geofence: int = 0
+
+    @classmethod
+    def from_config(cls, config: dict[str, Any]) -> "IngestFilter":
+        """Builds an IngestFilter from a feed config object.
+
+        The object holds the IngestFilter arguments routes, agencies and agency_separator, plus an optional
+        "geofence" GeoJSON file path or object and the "cells" of its grid.
+        """
+        geofence = config.get("geofence")
+        return cls(
+            routes=config.get("routes"),
+            agencies=config.get("agencies"),
+            agency_separator=config.get("agency_separator", ":"),
+            geofence=Geofence.from_geojson(geofence, config.get("cells", 256)) if geofence is not None else None,
+        )
+
+    @property
+    def rejected(self) -> int:
+        return self.rejected_routes + self.rejected_geofence
+
+    def __call__(self, feed_entity: gtfs_realtime_pb2.VehiclePosition) -> bool:
+        if self.routes is not None or self.agencies is not None:
+            route_id = feed_entity.trip.route_id
+            if (self.routes is not None and route_id not in self.routes) or (
+                self.agencies is not None and route_id.partition(self.agency_separator)[0] not in self.agencies
+            ):
+                self.rejected_routes += 1
+                return False
+        if self.geofence is not None:
+            position = feed_entity.position
+            if not self.geofence.contains(position.longitude, position.latitude):
+                self.rejected_geofence += 1
+                return False
+        return True
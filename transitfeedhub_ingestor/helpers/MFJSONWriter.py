@@ -0,0 +1,127 @@
+import gzip
+import io
+import json
+from array import array
+from collections.abc import Iterable, Sequence
+from json.encoder import encode_basestring_ascii
+from typing import TYPE_CHECKING, Any, Protocol, cast
+
+if TYPE_CHECKING:
+    from .Entity import Entity
+    from .StaticGTFS import StaticGTFS
+
+# (Entity attribute, interpolation) in the order they are written to temporalProperties
+TEMPORAL_MEASURES: tuple[tuple[str, str], ...] = (
+    ("bearing", "Linear"),
+    ("current_status", "Discrete"),
+    ("odometer", "Discrete"),
+    ("speed", "Linear"),
+    ("stop_id", "Discrete"),
+    ("current_stop_sequence", "Discrete"),
+    ("occupancy_status", "Discrete"),
+    ("occupancy_percentage", "Discrete"),
+    ("congestion_level", "Discrete"),
+)
+
+
+class _Writable(Protocol):
+    def write(self, data: bytes, /) -> int: ...
+
+
+def _floats(values: Iterable[float]) -> str:
+    text = ",".join(map(float.__repr__, values))
+    # repr of a finite float never contains an "n", nan and inf need the json spelling
+    if "n" in text:
+        return ",".join(json.dumps(v) for v in values)
+    return text
+
+
+def _values(values: "array[Any] | Sequence[str]") -> str:
+    if isinstance(values, array):
+        if values.typecode in "fd":
+            return _floats(cast("array[float]", values))
+        return ",".join(map(str, values))
+    return ",".join(encode_basestring_ascii(v) for v in values)
+
+
+class MFJSONWriter:
+    """Serializes an Entity to MF-JSON bytes, streaming the columns straight into the output.
+
+    The compact mode writes the same document as Entity.toMFJSON without indentation and without building the
+    intermediate dict, each temporal column is written directly from its array. With gzip enabled the output is
+    compressed while it is written and content_encoding should be sent along with the upload. With the static GTFS feed
+    of the agency the route names, trip headsign and shape are added to the properties and the stop names as a
+    stop_name measure.
+
+    Args:
+        compact: write without indentation. When False the indented Entity.toMFJSON document is written.
+        gzip: gzip the output
+        compresslevel: gzip compression level
+        gtfs: optional static GTFS lookup tables the output is enriched from
+    """
+
+    content_type: str = "application/json"
+
+    def __init__(
+        self, compact: bool = True, gzip: bool = False, compresslevel: int = 6, gtfs: "StaticGTFS | None" = None
+    ):
+        self.compact: bool = compact
+        self.gzip: bool = gzip
+        self.compresslevel: int = compresslevel
+        self.gtfs: StaticGTFS | None = gtfs
+
+    @property
+    def content_encoding(self) -> str | None:
+        return "gzip" if self.gzip else None
+
+    def write(self, entity: "Entity") -> bytes:
+        buffer = io.BytesIO()
+        if self.gzip:
+            with gzip.GzipFile(fileobj=buffer, mode="wb", compresslevel=self.compresslevel, mtime=0) as out:
+                self.stream(entity, out)
+        else:
+            self.stream(entity, buffer)
+        return buffer.getvalue()
+
+    def stream(self, entity: "Entity", out: _Writable):
+        if not self.compact:
+            out.write(entity.toMFJSON(self.gtfs).encode("utf-8"))
+            return
+
+        out.write(b'{"type":"FeatureCollection","features":[')
+        self.stream_feature(entity, out)
+        out.write(b"]}")
+
+    def stream_feature(self, entity: "Entity", out: _Writable):
+        """Writes the compact Feature of an entity, without the FeatureCollection wrapper."""
+        datetimes = _values(entity.updated_at).encode("ascii")
+        coordinates = ",".join(f"[{lon!r},{lat!r}]" for lon, lat in zip(entity.longitude, entity.latitude))
+        properties = json.dumps(entity.properties(self.gtfs), separators=(",", ":"))
+
+        out.write(b'{"type":"Feature","temporalGeometry":')
+        out.write(f'{{"type":"MovingPoint","coordinates":[{coordinates}],"datetimes":['.encode("ascii"))
+        out.write(datetimes)
+        out.write(b'],"interpolation":"Linear"},"properties":')
+        out.write(properties.encode("utf-8"))
+        out.write(b',"temporalProperties":[{"datetimes":[')
+        out.write(datetimes)
+        out.write(b"]")
+        for name, interpolation in TEMPORAL_MEASURES:
+            self._measure(out, name, getattr(entity, name), interpolation)
+        if self.gtfs is not None:
+            stop_names = [self.gtfs.stop_name(stop_id) for stop_id in entity.stop_id]
+            self._measure(out, "stop_name", stop_names, "Discrete")
+        for carriage in entity.carriages:
+            self._measure(out, carriage.measure_name, carriage.occupancy_status, "Discrete")
+        out.write(b"}]}")
+
+    def _measure(
+        self,
+        out: _Writable,
+        name: str,
+        values: "array[Any] | Sequence[str]",
+        interpolation: str,
+    ):
+        out.write(f',{encode_basestring_ascii(name)}:{{"type":"Measure","values":['.encode("ascii"))
+        out.write(_values(values).encode("ascii"))
+        out.write(f'],"interpolation":"{interpolation}"}}'.encode("ascii"))
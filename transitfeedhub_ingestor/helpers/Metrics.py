@@ -0,0 +1,276 @@
+import bisect
+import http.server
+import json
+import math
+import threading
+from collections.abc import Callable, Mapping, Sequence
+from urllib.parse import parse_qsl, urlsplit
+
+from .setup_logger import logger
+
+# histogram bucket upper bounds, +Inf is implied
+LATENCY_BUCKETS: tuple[float, ...] = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS: tuple[float, ...] = (1e3, 1e4, 5e4, 1e5, 2.5e5, 5e5, 1e6, 2.5e6, 5e6, 1e7, 2.5e7)
+
+# name: (bucket bounds, help)
+HISTOGRAMS: dict[str, tuple[tuple[float, ...], str]] = {
+    "fetch_seconds": (LATENCY_BUCKETS, "Latency of the feed request."),
+    "payload_bytes": (SIZE_BUCKETS, "Size of the fetched payloads."),
+    "parse_seconds": (LATENCY_BUCKETS, "Time to parse a fetched payload."),
+    "diff_seconds": (LATENCY_BUCKETS, "Time per cycle to diff the feed against the tracked entities."),
+    "update_seconds": (LATENCY_BUCKETS, "Time per cycle to create and update entities."),
+    "serialize_seconds": (LATENCY_BUCKETS, "Time per cycle to serialize and hand off saved trajectories."),
+    "upload_seconds": (LATENCY_BUCKETS, "Latency of a single object upload."),
+}
+GAUGES: dict[str, str] = {
+    "entities": "Tracked entities.",
+    "carriages": "Open carriages of the tracked entities.",
+    "resident_points": "Rows held by the tracked entities.",
+}
+COUNTERS: dict[str, str] = {
+    "creates": "Entities created.",
+    "updates": "Observations applied to existing entities.",
+    "splits": "Trajectories split on a direction change.",
+    "evictions": "Entities saved out and evicted.",
+    "decode_errors": "Payloads that could not be decoded.",
+    "unchanged_vehicles": "Tracked vehicles skipped because their timestamp had not changed.",
+    "filtered_vehicles": "Vehicles rejected by the route, agency or geofence filter.",
+    "skipped_cycles": "Cycles skipped because the feed had not changed.",
+}
+# stages observed per cycle from the deltas of VehiclePositionFeed.stage_seconds, fetch is observed per request
+_CYCLE_HISTOGRAMS: tuple[str, ...] = ("diff", "update", "serialize")
+
+
+class Histogram:
+    """Cumulative Prometheus histogram."""
+
+    __slots__ = ("bounds", "count", "counts", "sum")
+
+    def __init__(self, bounds: Sequence[float]):
+        self.bounds: tuple[float, ...] = tuple(bounds)
+        # one count per bound plus +Inf, not cumulative
+        self.counts: list[int] = [0] * (len(self.bounds) + 1)
+        self.sum: float = 0.0
+        self.count: int = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def copy(self) -> "Histogram":
+        histogram = Histogram(self.bounds)
+        histogram.counts = list(self.counts)
+        histogram.sum = self.sum
+        histogram.count = self.count
+        return histogram
+
+
+class FeedMetrics:
+    """Histograms, gauges and counters of one feed.
+
+    Request, payload, parse and upload histograms are observed where they are measured, the stage histograms, gauges
+    and counters are taken once per cycle by end_cycle, which also logs the cycle as a single JSON line.
+
+    Args:
+        feed: value of the feed label, the agency of the feed
+    """
+
+    def __init__(self, feed: str):
+        self.feed: str = feed
+        self.histograms: dict[str, Histogram] = {name: Histogram(bounds) for name, (bounds, _) in HISTOGRAMS.items()}
+        self.gauges: dict[str, int] = dict.fromkeys(GAUGES, 0)
+        self.counters: dict[str, int] = dict.fromkeys(COUNTERS, 0)
+        self.cycles: int = 0
+        self._stage_seconds: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, value: float):
+        with self._lock:
+            self.histograms[name].observe(value)
+
+    def end_cycle(self, stage_seconds: Mapping[str, float], counters: Mapping[str, int], gauges: Mapping[str, int]):
+        """Records one reconcile cycle.
+
+        Args:
+            stage_seconds: cumulative seconds per stage, the time of this cycle is the delta to the previous call
+            counters: cumulative value of every name in COUNTERS
+            gauges: current value of every name in GAUGES
+        """
+        stages = {stage: seconds - self._stage_seconds.get(stage, 0.0) for stage, seconds in stage_seconds.items()}
+        self._stage_seconds = dict(stage_seconds)
+        with self._lock:
+            for stage in _CYCLE_HISTOGRAMS:
+                self.histograms[f"{stage}_seconds"].observe(stages.get(stage, 0.0))
+            self.counters.update(counters)
+            self.gauges.update(gauges)
+            self.cycles += 1
+        line = {
+            "event": "cycle",
+            "feed": self.feed,
+            "cycle": self.cycles,
+            **{f"{stage}_seconds": round(seconds, 6) for stage, seconds in stages.items()},
+            **gauges,
+            **counters,
+        }
+        logger.info(json.dumps(line))
+
+    def samples(self) -> tuple[dict[str, Histogram], dict[str, int], dict[str, int]]:
+        """Consistent copy of the histograms, gauges and counters."""
+        with self._lock:
+            histograms = {name: histogram.copy() for name, histogram in self.histograms.items()}
+            return histograms, dict(self.gauges), dict(self.counters)
+
+    def load(self, histograms: Mapping[str, Histogram], gauges: Mapping[str, int], counters: Mapping[str, int]):
+        """Replaces every value with samples taken in another process, see Supervisor."""
+        with self._lock:
+            self.histograms.update({name: histogram.copy() for name, histogram in histograms.items()})
+            self.gauges.update(gauges)
+            self.counters.update(counters)
+
+
+def _format_value(value: float) -> str:
+    return "+Inf" if math.isinf(value) else repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class MetricsRegistry:
+    """The FeedMetrics of every feed hosted by the process, rendered in the Prometheus text format.
+
+    Args:
+        namespace: prefix of every metric name
+    """
+
+    def __init__(self, namespace: str = "transitfeedhub"):
+        self.namespace: str = namespace
+        self._feeds: dict[str, FeedMetrics] = {}
+        self._lock = threading.Lock()
+
+    def feed(self, name: str) -> FeedMetrics:
+        """Returns the FeedMetrics labelled name, creating it on first use."""
+        with self._lock:
+            metrics = self._feeds.get(name)
+            if metrics is None:
+                metrics = self._feeds[name] = FeedMetrics(name)
+            return metrics
+
+    def observe_upload(self, object_name: str, seconds: float):
+        """Upload observer, see s3Uploader.set_upload_observer.
+
+        Object names start with the agency of the feed that produced them, uploads of other objects are ignored.
+        """
+        metrics = self._feeds.get(object_name.lstrip("/").split("/", 1)[0])
+        if metrics is not None:
+            metrics.observe("upload_seconds", seconds)
+
+    def render(self) -> str:
+        with self._lock:
+            feeds = list(self._feeds.values())
+        samples = [(_escape(metrics.feed), *metrics.samples()) for metrics in feeds]
+        lines: list[str] = []
+        for name, (_, help_text) in HISTOGRAMS.items():
+            metric = f"{self.namespace}_{name}"
+            lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} histogram"]
+            for feed, histograms, _, _ in samples:
+                histogram = histograms[name]
+                cumulative = 0
+                for bound, count in zip((*histogram.bounds, math.inf), histogram.counts):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{{feed="{feed}",le="{_format_value(bound)}"}} {cumulative}')
+                lines.append(f'{metric}_sum{{feed="{feed}"}} {_format_value(histogram.sum)}')
+                lines.append(f'{metric}_count{{feed="{feed}"}} {histogram.count}')
+        for name, help_text in GAUGES.items():
+            metric = f"{self.namespace}_{name}"
+            lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} gauge"]
+            lines += [f'{metric}{{feed="{feed}"}} {gauges[name]}' for feed, _, gauges, _ in samples]
+        for name, help_text in COUNTERS.items():
+            metric = f"{self.namespace}_{name}_total"
+            lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} counter"]
+            lines += [f'{metric}{{feed="{feed}"}} {counters[name]}' for feed, _, _, counters in samples]
+        return "\n".join(lines) + "\n"
+
+
+# handler of a control endpoint, called with the query parameters, returns whether the request was accepted
+Control = Callable[[dict[str, str]], bool]
+
+
+class MetricsServer:
+    """Serves the metrics of a MetricsRegistry on GET /metrics from a daemon thread.
+
+    Optional control endpoints answer POST requests to their path with 202 Accepted, or 409 Conflict when the control
+    declines, e.g. the profiling endpoints of Profiler.controls. An optional health callable is served as JSON on
+    GET /health.
+
+    Args:
+        registry: metrics to serve
+        host: address to bind, local only by default
+        port: port to bind, 0 picks a free port
+        controls: control endpoints by path
+        health: returns the JSON serializable health of the process
+    """
+
+    def __init__(
+        self,
+        registry: MetricsRegistry,
+        host: str = "127.0.0.1",
+        port: int = 9464,
+        controls: Mapping[str, Control] | None = None,
+        health: Callable[[], object] | None = None,
+    ):
+        self.registry: MetricsRegistry = registry
+        self.controls: dict[str, Control] = dict(controls or {})
+        self.health: Callable[[], object] | None = health
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = urlsplit(self.path).path
+                if path == "/metrics":
+                    self._reply(200, registry.render(), "text/plain; version=0.0.4; charset=utf-8")
+                elif path == "/health" and server.health is not None:
+                    self._reply(200, json.dumps(server.health()), "application/json")
+                else:
+                    self.send_error(404)
+
+            def do_POST(self):
+                url = urlsplit(self.path)
+                control = server.controls.get(url.path)
+                if control is None:
+                    self.send_error(404)
+                    return
+                try:
+                    accepted = control(dict(parse_qsl(url.query)))
+                except ValueError as e:
+                    self.send_error(400, str(e))
+                    return
+                self._reply(202 if accepted else 409, "accepted\n" if accepted else "busy\n", "text/plain")
+
+            def _reply(self, status: int, text: str, content_type: str):
+                body = text.encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args: object):  # noqa: A002
+                pass
+
+        self._server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics", daemon=True)
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def start(self):
+        self._thread.start()
+        logger.info(f"Serving metrics on port {self.port}")
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
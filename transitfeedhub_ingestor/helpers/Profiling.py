@@ -0,0 +1,271 @@
+import cProfile
+import json
+import linecache
+import os
+import pstats
+import signal
+import threading
+import time
+import tracemalloc
+from collections.abc import Callable, Collection, Sequence
+from typing import Any
+
+from transitfeedhub_ingestor.protobuf import gtfs_realtime_pb2
+
+from .setup_logger import logger
+from .VehiclePositionFeed import VehiclePositionFeed
+
+# modules tracemalloc diffs are attributed to: entities, carriages and the serializers
+TRACE_SITES: tuple[str, ...] = ("Entity.py", "MFJSONWriter.py", "BatchSink.py", "DiskSink.py")
+
+
+def _site(traceback: tracemalloc.Traceback) -> tracemalloc.Frame | None:
+    # the most recent frame in one of the TRACE_SITES modules
+    for frame in reversed(traceback):
+        if os.path.basename(frame.filename) in TRACE_SITES:
+            return frame
+    return None
+
+
+class Profiler:
+    """On-demand cProfile, tracemalloc and largest-entity captures of running feeds.
+
+    Nothing is hooked into the feeds until a capture is requested, then get_entities and reconcile of every feed are
+    wrapped on the instance and unwrapped again once every requested capture is written, so feeds run their plain
+    methods while no capture is active. Captures count the cycles of all feeds together and are written to directory:
+
+    - profile: a cProfile of the fetch and reconcile calls of the next cycles, saved as profile-*.prof with a
+      cumulative time summary in profile-*.txt. Profiled calls of different feeds run one at a time.
+    - tracemalloc: a snapshot diff after every one of the next cycles, saved as tracemalloc-*.txt, attributed to the
+      Entity, Carriage and serializer lines (TRACE_SITES) that allocated the memory
+    - entities: the top_k largest tracked entities of every feed by Entity.nbytes, taken at the end of the next cycle
+      and saved as entities-*.json
+
+    Args:
+        feeds: feeds to capture
+        directory: directory receiving the captures
+        top_k: rows of every summary and entities per dump
+        trace_frames: frames stored per traced allocation
+    """
+
+    def __init__(
+        self,
+        feeds: Sequence[VehiclePositionFeed],
+        directory: str = "./data/profiles",
+        top_k: int = 20,
+        trace_frames: int = 25,
+    ):
+        self.feeds: list[VehiclePositionFeed] = list(feeds)
+        self.directory: str = directory
+        self.top_k: int = top_k
+        self.trace_frames: int = trace_frames
+        # paths of every capture written
+        self.captures: list[str] = []
+
+        self._lock = threading.Lock()
+        # only one thread may run under the profiler at a time
+        self._profile_lock = threading.Lock()
+        self._profile: cProfile.Profile | None = None
+        self._profile_cycles: int = 0
+        self._trace_cycles: int = 0
+        self._trace_snapshot: tracemalloc.Snapshot | None = None
+        self._started_tracing: bool = False
+        self._entity_dumps: list[VehiclePositionFeed] = []
+
+    @property
+    def active(self) -> bool:
+        return self._profile is not None or self._trace_snapshot is not None or bool(self._entity_dumps)
+
+    def request_profile(self, cycles: int = 10) -> bool:
+        """Profiles the next cycles.
+
+        Returns:
+            False if a profile is already being captured.
+        """
+        with self._lock:
+            if self._profile is not None:
+                return False
+            self._profile = cProfile.Profile()
+            self._profile_cycles = max(cycles, 1)
+            self._install()
+        logger.info(f"Profiling the next {cycles} cycles")
+        return True
+
+    def request_tracemalloc(self, cycles: int = 3) -> bool:
+        """Diffs the traced allocations of the next cycles.
+
+        Returns:
+            False if a trace is already being captured.
+        """
+        with self._lock:
+            if self._trace_snapshot is not None:
+                return False
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(self.trace_frames)
+                self._started_tracing = True
+            self._trace_snapshot = tracemalloc.take_snapshot()
+            self._trace_cycles = max(cycles, 1)
+            self._install()
+        logger.info(f"Tracing allocations over the next {cycles} cycles")
+        return True
+
+    def request_top_entities(self) -> bool:
+        """Dumps the largest entities of every feed at the end of its next cycle.
+
+        Returns:
+            False if a dump is already pending.
+        """
+        with self._lock:
+            if self._entity_dumps:
+                return False
+            self._entity_dumps = list(self.feeds)
+            self._install()
+        return True
+
+    def controls(self) -> dict[str, Callable[[dict[str, str]], bool]]:
+        """Control endpoints for MetricsServer.
+
+        POST /debug/profile?cycles=N, /debug/tracemalloc?cycles=N or /debug/entities to request a capture.
+        """
+        return {
+            "/debug/profile": lambda query: self.request_profile(int(query.get("cycles", 10))),
+            "/debug/tracemalloc": lambda query: self.request_tracemalloc(int(query.get("cycles", 3))),
+            "/debug/entities": lambda query: self.request_top_entities(),
+        }
+
+    def install_signal_handlers(self, profile_cycles: int = 10, trace_cycles: int = 3):
+        """SIGUSR1 profiles the next profile_cycles cycles, SIGUSR2 traces allocations and dumps the largest entities.
+
+        Only available where the platform has these signals, must be called from the main thread.
+        """
+        if not hasattr(signal, "SIGUSR1"):
+            logger.warning("Profiling signals are not available on this platform")
+            return
+        signal.signal(signal.SIGUSR1, lambda signum, frame: self.request_profile(profile_cycles))
+
+        def memory(signum: int, frame: Any):
+            self.request_tracemalloc(trace_cycles)
+            self.request_top_entities()
+
+        signal.signal(signal.SIGUSR2, memory)
+
+    def _install(self):
+        for feed in self.feeds:
+            # instance attributes shadow the methods until _uninstall removes them
+            attributes = vars(feed)
+            if "reconcile" not in attributes:
+                attributes["get_entities"] = self._wrap_fetch(feed.get_entities)
+                attributes["reconcile"] = self._wrap_reconcile(feed, feed.reconcile)
+
+    def _uninstall(self):
+        for feed in self.feeds:
+            for name in ("get_entities", "reconcile"):
+                vars(feed).pop(name, None)
+
+    def _wrap_fetch(
+        self, get_entities: Callable[[], Collection[gtfs_realtime_pb2.VehiclePosition] | None]
+    ) -> Callable[[], Collection[gtfs_realtime_pb2.VehiclePosition] | None]:
+        def profiled() -> Collection[gtfs_realtime_pb2.VehiclePosition] | None:
+            profile = self._profile
+            if profile is None:
+                return get_entities()
+            with self._profile_lock:
+                return profile.runcall(get_entities)
+
+        return profiled
+
+    def _wrap_reconcile(
+        self,
+        feed: VehiclePositionFeed,
+        reconcile: Callable[[Collection[gtfs_realtime_pb2.VehiclePosition] | None], None],
+    ) -> Callable[[Collection[gtfs_realtime_pb2.VehiclePosition] | None], None]:
+        def profiled(feed_entities: Collection[gtfs_realtime_pb2.VehiclePosition] | None):
+            profile = self._profile
+            if profile is None:
+                reconcile(feed_entities)
+            else:
+                with self._profile_lock:
+                    profile.runcall(reconcile, feed_entities)
+            self._end_cycle(feed, profile)
+
+        return profiled
+
+    def _end_cycle(self, feed: VehiclePositionFeed, profile: cProfile.Profile | None):
+        with self._lock:
+            # a reconcile that started before the profile was requested is not one of its cycles
+            if profile is not None and profile is self._profile:
+                self._profile_cycles -= 1
+                if self._profile_cycles <= 0:
+                    self._write_profile(profile)
+                    self._profile = None
+            if self._trace_snapshot is not None:
+                snapshot = tracemalloc.take_snapshot()
+                self._trace_cycles -= 1
+                self._write_trace(self._trace_snapshot, snapshot)
+                self._trace_snapshot = snapshot if self._trace_cycles > 0 else None
+                if self._trace_snapshot is None and self._started_tracing:
+                    tracemalloc.stop()
+                    self._started_tracing = False
+            if feed in self._entity_dumps:
+                self._entity_dumps.remove(feed)
+                self._write_entities(feed)
+            if not self.active:
+                self._uninstall()
+
+    def _path(self, kind: str, extension: str, name: str = "") -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        path = os.path.join(self.directory, f"{kind}-{name + '-' if name else ''}{stamp}.{extension}")
+        # never overwrite an earlier capture of the same second
+        count = 1
+        while os.path.exists(path) or path in self.captures:
+            path = os.path.join(self.directory, f"{kind}-{name + '-' if name else ''}{stamp}-{count}.{extension}")
+            count += 1
+        self.captures.append(path)
+        return path
+
+    def _write_profile(self, profile: cProfile.Profile):
+        path = self._path("profile", "prof")
+        profile.dump_stats(path)
+        with open(f"{path[: -len('.prof')]}.txt", "w") as f:
+            pstats.Stats(profile, stream=f).sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self.top_k * 2)
+        logger.info(f"Wrote profile to {path}")
+
+    def _write_trace(self, before: tracemalloc.Snapshot, after: tracemalloc.Snapshot):
+        diffs = after.compare_to(before, "traceback")
+        sites: dict[tuple[str, int], list[int]] = {}
+        for diff in diffs:
+            frame = _site(diff.traceback)
+            if frame is not None:
+                totals = sites.setdefault((frame.filename, frame.lineno), [0, 0])
+                totals[0] += diff.size_diff
+                totals[1] += diff.count_diff
+        path = self._path("tracemalloc", "txt")
+        with open(path, "w") as f:
+            f.write(f"Allocations attributed to {', '.join(TRACE_SITES)}\n")
+            for (filename, lineno), (size, count) in sorted(sites.items(), key=lambda i: -abs(i[1][0]))[: self.top_k]:
+                source = linecache.getline(filename, lineno).strip()
+                f.write(f"{size / 1024:+10.1f} KiB {count:+8d} {os.path.basename(filename)}:{lineno} {source}\n")
+            f.write("\nTop allocations by line\n")
+            for diff in after.compare_to(before, "lineno")[: self.top_k]:
+                f.write(f"{diff}\n")
+        logger.info(f"Wrote allocation diff to {path}")
+
+    def _write_entities(self, feed: VehiclePositionFeed):
+        largest = sorted(feed.entities, key=lambda entity: entity.nbytes, reverse=True)[: self.top_k]
+        rows = [
+            {
+                "entity_id": entity.entity_id,
+                "route_id": entity.route_id,
+                "trip_id": entity.trip_id,
+                "rows": len(entity),
+                "carriages": len(entity.carriages),
+                "nbytes": entity.nbytes,
+                "age_seconds": round(entity.checkage(), 1),
+            }
+            for entity in largest
+        ]
+        path = self._path("entities", "json", feed.agency)
+        with open(path, "w") as f:
+            json.dump({"agency": feed.agency, "entities": len(feed.entities), "largest": rows}, f, indent=2)
+        logger.info(f"Wrote the {len(rows)} largest entities of {feed.agency} to {path}")
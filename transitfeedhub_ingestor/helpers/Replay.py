@@ -0,0 +1,196 @@
+import glob
+import os
+import sys
+import time
+from collections.abc import Iterable, Iterator
+from typing import Any, NamedTuple
+
+import requests
+from requests.adapters import BaseAdapter
+
+from .BatchSink import BatchSink, TrajectorySink, memory_publisher
+from .Entity import RunLengthPolicy, SegmentPolicy
+from .FeedArchive import FeedArchiveReader
+from .VehiclePositionFeed import STAGES, VehiclePositionFeed
+
+try:
+    import resource
+except ImportError:  # pragma: no cover, not available on Windows
+    resource = None
+
+
+class ReplayReport(NamedTuple):
+    snapshots: int
+    seconds: float
+    # cumulative seconds per VehiclePositionFeed stage
+    stage_seconds: dict[str, float]
+    # peak resident set size of the process, None where it cannot be measured
+    peak_rss_bytes: int | None
+    trajectories: int
+    objects: int
+    published_bytes: int
+    # observations applied to entities and rows stored for them
+    observations: int
+    stored_rows: int
+    # points dropped by simplification when trajectories were saved
+    simplified_rows: int
+    # trajectories cut into rolling segments, and largest estimated bytes in flight after a snapshot
+    segments_cut: int
+    peak_entity_bytes: int
+    # tracked vehicles skipped because their timestamp had not changed
+    unchanged_vehicles: int
+
+    @property
+    def snapshots_per_second(self) -> float:
+        return self.snapshots / self.seconds if self.seconds else 0.0
+
+    @property
+    def compression_ratio(self) -> float:
+        return self.observations / self.stored_rows if self.stored_rows else 1.0
+
+    @property
+    def skip_rate(self) -> float:
+        seen = self.unchanged_vehicles + self.observations
+        return self.unchanged_vehicles / seen if seen else 0.0
+
+    def format(self) -> str:
+        snapshots = max(self.snapshots, 1)
+        lines = [
+            f"snapshots: {self.snapshots} in {self.seconds:.2f} s ({self.snapshots_per_second:.1f} snapshots/s)",
+            *(
+                f"  {stage:<9} {seconds:8.3f} s {seconds / snapshots * 1e3:8.2f} ms/snapshot"
+                for stage, seconds in self.stage_seconds.items()
+            ),
+            f"trajectories: {self.trajectories} in {self.objects} objects, {self.published_bytes / 1e6:.2f} MB",
+            f"observations: {self.observations} stored as {self.stored_rows} rows ({self.compression_ratio:.2f}x)",
+            f"simplification dropped {self.simplified_rows} rows",
+            f"segments cut: {self.segments_cut}, peak in-flight trajectories {self.peak_entity_bytes / 1e6:.2f} MB",
+            f"unchanged vehicles skipped: {self.unchanged_vehicles} ({self.skip_rate:.1%} of observed vehicles)",
+        ]
+        if self.peak_rss_bytes is not None:
+            lines.append(f"peak RSS: {self.peak_rss_bytes / 1e6:.1f} MB")
+        return "\n".join(lines)
+
+
+def peak_rss_bytes() -> int | None:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def snapshot_files(paths: Iterable[str]) -> Iterator[bytes]:
+    """Yields the payload of every snapshot file, e.g. the tests/mockapi_data captures."""
+    for path in paths:
+        with open(path, "rb") as f:
+            yield f.read()
+
+
+def snapshot_directory(directory: str) -> Iterator[bytes]:
+    """Yields the payloads of a snapshot directory, or of a FeedArchiveWriter directory, in time order."""
+    if glob.glob(os.path.join(directory, "segment-*.seg")):
+        for _, payload in FeedArchiveReader(directory).iter_window():
+            yield payload
+    else:
+        yield from snapshot_files(sorted(glob.glob(os.path.join(directory, "*.pb"))))
+
+
+REPLAY_URL = "replay://feed"
+
+
+class ReplayAdapter(BaseAdapter):
+    """Transport adapter answering every request with the current recorded payload.
+
+    Mounted for replay:// on the session of a VehiclePositionFeed, so replays go through the real request path.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.payload: bytes = b""
+
+    def send(self, request: requests.PreparedRequest, *args: Any, **kwargs: Any) -> requests.Response:
+        response = requests.Response()
+        response.status_code = 200
+        response.url = request.url or REPLAY_URL
+        response.request = request
+        response._content = self.payload  # pyright: ignore[reportPrivateUsage]
+        return response
+
+    def close(self):
+        pass
+
+
+def replay(
+    payloads: Iterable[bytes],
+    agency: str = "replay",
+    batch_sink: TrajectorySink | None = None,
+    drain: bool = True,
+    run_length: RunLengthPolicy | None = None,
+    simplify: float | None = None,
+    segments: SegmentPolicy | None = None,
+) -> ReplayReport:
+    """Feeds recorded payloads through the fetch, reconcile and serialization path of a VehiclePositionFeed.
+
+    Payloads are served by a ReplayAdapter without any pacing, so the replay runs as fast as the pipeline allows.
+    Trajectories are published to batch_sink, by default an in-memory BatchSink publishing one object per
+    trajectory, so nothing reaches S3.
+
+    Args:
+        payloads: serialized FeedMessages in the order they were fetched
+        agency: agency of the replayed feed, used in object names
+        batch_sink: sink receiving the saved trajectories
+        drain: save the entities still in flight after the last payload
+        run_length: collapse unchanged observations into runs, see Entity.update
+        simplify: simplification tolerance in metres for saved trajectories, see Entity.simplify
+        segments: rolling segment policy, see SegmentPolicy
+
+    Returns:
+        Throughput, per-stage time, peak RSS and output counts of the replay.
+    """
+    if batch_sink is None:
+        batch_sink = BatchSink(memory_publisher({}), max_count=1)
+    feed = VehiclePositionFeed(
+        url=REPLAY_URL,
+        agency=agency,
+        file_path="",
+        s3_bucket="",
+        batch_sink=batch_sink,
+        run_length=run_length,
+        simplify=simplify,
+        segments=segments,
+    )
+    adapter = ReplayAdapter()
+    feed.session.mount("replay://", adapter)
+
+    snapshots = 0
+    peak_entity_bytes = 0
+    start = time.perf_counter()
+    for payload in payloads:
+        adapter.payload = payload
+        feed.consume_pb()
+        snapshots += 1
+        peak_entity_bytes = max(peak_entity_bytes, sum(entity.nbytes for entity in feed.entities))
+    if drain:
+        for entity in list(feed.entities):
+            feed.save_entity_to_s3(entity)
+    flush_start = time.perf_counter()
+    batch_sink.flush()
+    feed.stage_seconds["serialize"] += time.perf_counter() - flush_start
+    seconds = time.perf_counter() - start
+
+    return ReplayReport(
+        snapshots=snapshots,
+        seconds=seconds,
+        stage_seconds={stage: feed.stage_seconds[stage] for stage in STAGES},
+        peak_rss_bytes=peak_rss_bytes(),
+        trajectories=batch_sink.published_trajectories,
+        objects=batch_sink.published_objects,
+        published_bytes=batch_sink.published_bytes,
+        observations=feed.observations,
+        stored_rows=feed.observations - feed.collapsed_observations,
+        simplified_rows=feed.simplified_rows,
+        segments_cut=feed.segments_cut,
+        peak_entity_bytes=peak_entity_bytes,
+        unchanged_vehicles=feed.unchanged_vehicles,
+    )
@@ -0,0 +1,157 @@
+import os
+import shutil
+import time
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+from .Checkpoint import Checkpointer
+from .s3Uploader import BackgroundUploader
+from .setup_logger import logger
+from .VehiclePositionFeed import VehiclePositionFeed
+
+# seconds of a shutdown deadline kept for spilling by default
+SPILL_RESERVE = 5.0
+
+
+class DrainReport(NamedTuple):
+    seconds: float
+    # open trajectories saved out, single point entities dropped as usual, and entities still in flight when time was up
+    saved: int
+    dropped: int
+    spilled: int
+    # objects uploaded while draining, and written to the upload spool instead
+    uploaded: int
+    spooled: int
+
+    def format(self) -> str:
+        return (
+            f"drained in {self.seconds:.2f} s: {self.saved} trajectories saved out, {self.dropped} single point "
+            f"entities dropped, {self.uploaded} objects uploaded, {self.spooled} objects spooled, {self.spilled} "
+            "entities spilled to disk"
+        )
+
+
+def spill_directory(spill_dir: str, agency: str) -> str:
+    return os.path.join(spill_dir, agency)
+
+
+def save_until(started: float, deadline: float, spill_reserve: float = SPILL_RESERVE) -> float:
+    """Returns the time.monotonic() time saving out stops at, spill_reserve seconds before the end of the deadline.
+
+    Args:
+        started: time.monotonic() time the shutdown started at, e.g. when SIGTERM was received
+        deadline: seconds the shutdown may take
+        spill_reserve: seconds kept for spilling at the end of the deadline
+    """
+    return started + max(deadline - spill_reserve, 0.0)
+
+
+def _drain_feed(feed: VehiclePositionFeed, until: float) -> tuple[int, int]:
+    # hands off the series and trajectories still in flight until the time is up, then the rollups of the batch sink,
+    # returns the trajectories saved and the single point entities dropped
+    feed.drain_accumulators()
+    saved = dropped = 0
+    for entity in list(feed.entities):
+        if time.monotonic() >= until:
+            break
+        if len(entity) > 1:
+            saved += 1
+        else:
+            dropped += 1
+        feed.save_entity_to_s3(entity)
+    if feed.batch_sink is not None and not feed.batch_sink.flush(max(until - time.monotonic(), 0.0)):
+        logger.warning(f"Batch sink of {feed.agency} could not publish every batch within the shutdown deadline")
+    return saved, dropped
+
+
+def _spill_feed(feed: VehiclePositionFeed, spill_dir: str) -> int:
+    # the feed checkpointer also records the evictions of the drain, so a restart does not resurrect saved entities
+    if feed.checkpointer is not None:
+        feed.checkpointer.commit(feed.entities, snapshot=True)
+        feed.checkpointer.flush()
+        return len(feed.entities)
+    if len(feed.entities) == 0:
+        return 0
+    directory = spill_directory(spill_dir, feed.agency)
+    shutil.rmtree(directory, ignore_errors=True)
+    checkpointer = Checkpointer(directory)
+    checkpointer.commit(feed.entities, snapshot=True)
+    checkpointer.close()
+    return len(feed.entities)
+
+
+def drain(
+    feeds: Sequence[VehiclePositionFeed],
+    uploader: BackgroundUploader | None,
+    deadline: float,
+    spill_dir: str,
+    spill_reserve: float = SPILL_RESERVE,
+    started: float | None = None,
+) -> DrainReport:
+    """Saves out the open trajectories of stopped feeds within a shutdown grace period.
+
+    The feeds are drained in parallel, each saving its entities through its batch sink or the uploader while the
+    upload workers already send them. Saving and uploading stop spill_reserve seconds before the deadline. Entities
+    still in flight are then spilled as a checkpoint snapshot, into the checkpoint of their feed or below spill_dir
+    (see restore_spill), and objects not uploaded yet are written to the upload spool (see
+    BackgroundUploader.replay_spool). Polling must have stopped, see FeedScheduler.stop; pass it the save_until of
+    the same deadline so cycles stuck in a fetch do not use up the grace period before the drain starts.
+
+    Args:
+        feeds: the feeds to drain
+        uploader: background upload pool shared by the feeds, if any
+        deadline: seconds the drain may take, within the grace period of the orchestrator
+        spill_dir: parent of the spilled entities of the feeds without a checkpointer
+        spill_reserve: seconds kept for spilling at the end of the deadline
+        started: time.monotonic() time the deadline is measured from, e.g. when SIGTERM was received. Defaults to now.
+
+    Returns:
+        What was saved and uploaded versus spilled.
+    """
+    start = started if started is not None else time.monotonic()
+    until = save_until(start, deadline, spill_reserve)
+    uploaded = uploader.uploaded if uploader is not None else 0
+    spooled = uploader.spooled if uploader is not None else 0
+    saved = dropped = 0
+    if uploader is not None:
+        # batches published past the deadline go to the spool instead of waiting for the upload queue
+        uploader.deadline = until
+    if feeds:
+        with ThreadPoolExecutor(max_workers=len(feeds), thread_name_prefix="drain") as executor:
+            for feed_saved, feed_dropped in executor.map(_drain_feed, feeds, [until] * len(feeds)):
+                saved += feed_saved
+                dropped += feed_dropped
+    if uploader is not None and not uploader.flush(max(until - time.monotonic(), 0.0)):
+        logger.warning(f"Uploads did not finish within the {deadline} s shutdown deadline, spooling the rest")
+    spilled = sum(_spill_feed(feed, spill_dir) for feed in feeds)
+    if uploader is not None:
+        uploader.spill()
+    report = DrainReport(
+        seconds=time.monotonic() - start,
+        saved=saved,
+        dropped=dropped,
+        spilled=spilled,
+        uploaded=uploader.uploaded - uploaded if uploader is not None else 0,
+        spooled=uploader.spooled - spooled if uploader is not None else 0,
+    )
+    logger.info(report.format())
+    return report
+
+
+def restore_spill(feeds: Sequence[VehiclePositionFeed], spill_dir: str) -> int:
+    """Restores the entities spilled by drain into the feeds without a checkpointer.
+
+    Returns:
+        Number of entities restored.
+    """
+    restored = 0
+    for feed in feeds:
+        directory = spill_directory(spill_dir, feed.agency)
+        if feed.checkpointer is not None or not os.path.isdir(directory):
+            continue
+        checkpointer = Checkpointer(directory)
+        restored += checkpointer.restore(feed.entities, feed.run_length)
+        checkpointer.close()
+        shutil.rmtree(directory)
+    return restored
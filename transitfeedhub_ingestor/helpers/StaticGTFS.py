@@ -0,0 +1,305 @@
+import contextlib
+import csv
+import io
+import json
+import mmap
+import os
+import struct
+import zipfile
+import zlib
+from array import array
+from collections.abc import Iterator, Sequence
+from typing import Any, cast
+
+from .setup_logger import logger
+from .types import PropertiesDict
+
+_CACHE_MAGIC = b"TFHGTFS1"
+_HEADER_LENGTH = struct.Struct("<Q")
+_CACHE_VERSION = 1
+
+# table name, GTFS file, columns, the first one being the key the table is indexed by
+_TABLES: tuple[tuple[str, str, tuple[str, ...]], ...] = (
+    ("routes", "routes.txt", ("route_id", "route_short_name", "route_long_name")),
+    ("trips", "trips.txt", ("trip_id", "route_id", "trip_headsign", "shape_id")),
+    ("stops", "stops.txt", ("stop_id", "stop_name")),
+    ("shapes", "shapes.txt", ("shape_id",)),
+)
+
+
+class CorruptGTFSCacheError(ValueError):
+    """Raised while opening a lookup cache that is not a StaticGTFS cache or was cut short."""
+
+
+def _csv_rows(archive: zipfile.ZipFile, name: str) -> Iterator[dict[str, str]]:
+    # feeds are sometimes zipped with their enclosing directory, files are matched by base name
+    member = next((m for m in archive.namelist() if os.path.basename(m) == name), None)
+    if member is None:
+        return
+    with archive.open(member) as f:
+        yield from csv.DictReader(io.TextIOWrapper(f, encoding="utf-8-sig", newline=""))
+
+
+def _index_slots(rows: int) -> int:
+    # power of two at least twice the row count, so linear probes stay short
+    slots = 8
+    while slots < 2 * rows:
+        slots *= 2
+    return slots
+
+
+class _CacheBuilder:
+    """Interns the strings of every table once and lays the tables out as arrays of string codes."""
+
+    def __init__(self):
+        self.codes: dict[str, int] = {"": 0}
+        self.blob = bytearray()
+        self.offsets: array[int] = array("I", [0, 0])
+        self.sections: dict[str, array[Any]] = {}
+
+    def intern(self, value: str) -> int:
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.codes)
+            self.blob += value.encode("utf-8")
+            self.offsets.append(len(self.blob))
+        return code
+
+    def add_table(self, name: str, columns: Sequence[str], rows: Sequence[dict[str, str]]):
+        # row-major string codes, rows repeating a key keep the first one like the index does
+        cells: array[int] = array("I")
+        index: array[int] = array("I", bytes(4 * _index_slots(len(rows))))
+        mask = len(index) - 1
+        count = 0
+        for row in rows:
+            key = row.get(columns[0], "")
+            slot = zlib.crc32(key.encode("utf-8")) & mask
+            while index[slot] and self.blob_of(cells[(index[slot] - 1) * len(columns)]) != key:
+                slot = (slot + 1) & mask
+            if index[slot]:
+                continue
+            cells.extend(self.intern(row.get(column, "")) for column in columns)
+            count += 1
+            index[slot] = count
+        self.sections[f"{name}.cells"] = cells
+        self.sections[f"{name}.index"] = index
+
+    def add_shapes(self, rows: Sequence[dict[str, str]]):
+        points: dict[str, list[tuple[int, float, float]]] = {}
+        for row in rows:
+            points.setdefault(row["shape_id"], []).append((
+                int(row["shape_pt_sequence"]),
+                float(row["shape_pt_lon"]),
+                float(row["shape_pt_lat"]),
+            ))
+        self.add_table("shapes", ("shape_id",), [{"shape_id": shape_id} for shape_id in points])
+        # (longitude, latitude) pairs of every shape in the order of the table, ordered by shape_pt_sequence
+        coordinates: array[float] = array("d")
+        offsets: array[int] = array("I", [0])
+        for shape in points.values():
+            for _, lon, lat in sorted(shape):
+                coordinates.extend((lon, lat))
+            offsets.append(len(coordinates))
+        self.sections["shapes.coordinates"] = coordinates
+        self.sections["shapes.offsets"] = offsets
+
+    def blob_of(self, code: int) -> str:
+        return self.blob[self.offsets[code] : self.offsets[code + 1]].decode("utf-8")
+
+    def write(self, path: str, source: dict[str, int]):
+        self.sections["strings.offsets"] = self.offsets
+        layout: dict[str, list[Any]] = {}
+        pos = 0
+        for name, section in self.sections.items():
+            # sections start 8 byte aligned so they can be cast in place
+            layout[name] = [pos, len(section) * section.itemsize, section.typecode]
+            pos += -(-len(section) * section.itemsize // 8) * 8
+        layout["strings.blob"] = [pos, len(self.blob), "B"]
+        header = json.dumps({"version": _CACHE_VERSION, "source": source, "sections": layout}).encode("utf-8")
+        start = len(_CACHE_MAGIC) + _HEADER_LENGTH.size + len(header)
+        start += -start % 8
+        with open(f"{path}.{os.getpid()}.tmp", "wb") as f:
+            f.write(_CACHE_MAGIC)
+            f.write(_HEADER_LENGTH.pack(len(header)))
+            f.write(header.ljust(start - len(_CACHE_MAGIC) - _HEADER_LENGTH.size))
+            for section in self.sections.values():
+                data = section.tobytes()
+                f.write(data.ljust(-(-len(data) // 8) * 8, b"\0"))
+            f.write(self.blob)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f"{path}.{os.getpid()}.tmp", path)
+
+
+class _Table:
+    """Read-only view of one table of the cache, rows are found by their key through an open addressing index."""
+
+    def __init__(self, gtfs: "StaticGTFS", name: str, width: int):
+        self._gtfs = gtfs
+        self.width: int = width
+        self.cells: memoryview = gtfs.section(f"{name}.cells")
+        self._index: memoryview = gtfs.section(f"{name}.index")
+        self._mask: int = len(self._index) - 1
+
+    def __len__(self) -> int:
+        return len(self.cells) // self.width
+
+    def find(self, key: str) -> int:
+        """Returns the row of key, or -1."""
+        data = key.encode("utf-8")
+        slot = zlib.crc32(data) & self._mask
+        while True:
+            row = self._index[slot]
+            if not row:
+                return -1
+            if self._gtfs.raw(self.cells[(row - 1) * self.width]) == data:
+                return row - 1
+            slot = (slot + 1) & self._mask
+
+    def value(self, row: int, column: int) -> str:
+        return self._gtfs.string(self.cells[row * self.width + column])
+
+
+class StaticGTFS:
+    """Lookup tables of the static GTFS feed of an agency, enriching the MF-JSON output with names and headsigns.
+
+    The routes, trips, stops and shapes of the GTFS zip are parsed once into a binary cache file: every distinct
+    string stored once in a string table, each table as an array of string codes plus an open addressing hash index
+    on its key. The cache is memory-mapped, so a restart neither re-parses the CSVs nor loads the tables into Python
+    objects, and it is rebuilt whenever the size or modification time of the zip changes. A lookup hashes the id and
+    compares it against the mapped bytes. Strings decoded from the cache are memoized, every trajectory of a route
+    shares the same name objects and nothing is stored per Entity.
+
+    Use StaticGTFS.load to open a feed, through the cache.
+
+    Args:
+        path: path of the lookup cache file
+    """
+
+    def __init__(self, path: str):
+        self.path: str = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if self._mmap[: len(_CACHE_MAGIC)] != _CACHE_MAGIC:
+                raise CorruptGTFSCacheError(path)
+            (length,) = _HEADER_LENGTH.unpack_from(self._mmap, len(_CACHE_MAGIC))
+            start = len(_CACHE_MAGIC) + _HEADER_LENGTH.size
+            header: dict[str, Any] = json.loads(self._mmap[start : start + length])
+            if header.get("version") != _CACHE_VERSION:
+                raise CorruptGTFSCacheError(path)
+            self.source: dict[str, int] = header["source"]
+            self._sections: dict[str, list[Any]] = header["sections"]
+            data = memoryview(self._mmap)[start + length + -(start + length) % 8 :]
+            if any(offset + size > len(data) for offset, size, _ in self._sections.values()):
+                raise CorruptGTFSCacheError(path)
+            self._data: memoryview = data
+            self._blob: memoryview = self.section("strings.blob")
+            self._offsets: memoryview = self.section("strings.offsets")
+            self.routes: _Table = _Table(self, "routes", len(_TABLES[0][2]))
+            self.trips: _Table = _Table(self, "trips", len(_TABLES[1][2]))
+            self.stops: _Table = _Table(self, "stops", len(_TABLES[2][2]))
+            self.shapes: _Table = _Table(self, "shapes", len(_TABLES[3][2]))
+            self._shape_offsets: memoryview = self.section("shapes.offsets")
+            self._shape_coordinates: memoryview = self.section("shapes.coordinates")
+        except (ValueError, KeyError, struct.error):
+            self.close()
+            raise
+        # decoded strings by code, shared by every trajectory
+        self._strings: dict[int, str] = {}
+        # stop names by stop id, the stop ids themselves are interned by STOP_IDS
+        self._stop_names: dict[str, str] = {}
+
+    @classmethod
+    def build(cls, gtfs_path: str, cache_path: str) -> "StaticGTFS":
+        """Parses the GTFS zip into a new lookup cache at cache_path and opens it."""
+        stat = os.stat(gtfs_path)
+        builder = _CacheBuilder()
+        with zipfile.ZipFile(gtfs_path) as archive:
+            for name, file_name, columns in _TABLES[:3]:
+                builder.add_table(name, columns, list(_csv_rows(archive, file_name)))
+            builder.add_shapes(list(_csv_rows(archive, "shapes.txt")))
+        builder.write(cache_path, {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns})
+        return cls(cache_path)
+
+    @classmethod
+    def load(cls, path: str, cache_dir: str = "./data/gtfs") -> "StaticGTFS":
+        """Opens the lookup cache of a GTFS zip, building it first if it is missing, stale or corrupt.
+
+        Args:
+            path: path of the static GTFS zip
+            cache_dir: directory of the lookup cache, named after the zip
+        """
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_path = os.path.join(cache_dir, f"{os.path.splitext(os.path.basename(path))[0]}.gtfscache")
+        if os.path.exists(cache_path):
+            stat = os.stat(path)
+            try:
+                gtfs = cls(cache_path)
+            except (OSError, ValueError, KeyError, struct.error) as e:
+                logger.warning(f"Rebuilding unreadable GTFS cache {cache_path}: {e!r}")
+            else:
+                if gtfs.source == {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}:
+                    return gtfs
+                gtfs.close()
+                logger.info(f"Rebuilding GTFS cache {cache_path}, {path} changed")
+        return cls.build(path, cache_path)
+
+    def close(self):
+        # the views into the map must be dropped before it can be closed
+        for name in (
+            "routes",
+            "trips",
+            "stops",
+            "shapes",
+            "_blob",
+            "_offsets",
+            "_shape_offsets",
+            "_shape_coordinates",
+            "_data",
+        ):
+            self.__dict__.pop(name, None)
+        # views returned by shape may still be alive, the map is then released once they are collected
+        with contextlib.suppress(BufferError):
+            self._mmap.close()
+
+    def section(self, name: str) -> memoryview:
+        offset, size, typecode = cast("tuple[int, int, Any]", self._sections[name])
+        return cast(memoryview, self._data[offset : offset + size].cast(typecode))
+
+    def raw(self, code: int) -> bytes:
+        return self._blob[self._offsets[code] : self._offsets[code + 1]].tobytes()
+
+    def string(self, code: int) -> str:
+        value = self._strings.get(code)
+        if value is None:
+            value = self._strings[code] = self.raw(code).decode("utf-8")
+        return value
+
+    def stop_name(self, stop_id: str) -> str:
+        """Name of a stop, "" if the stop is unknown."""
+        name = self._stop_names.get(stop_id)
+        if name is None:
+            row = self.stops.find(stop_id) if stop_id else -1
+            name = self._stop_names[stop_id] = self.stops.value(row, 1) if row >= 0 else ""
+        return name
+
+    def shape(self, shape_id: str) -> memoryview | None:
+        """(longitude, latitude) pairs of a shape as a flat view of doubles, None if the shape is unknown."""
+        row = self.shapes.find(shape_id)
+        if row < 0:
+            return None
+        return self._shape_coordinates[self._shape_offsets[row] : self._shape_offsets[row + 1]]
+
+    def enrich(self, properties: PropertiesDict):
+        """Adds the route names, trip headsign and shape of the trip or route of a trajectory to its properties."""
+        route_id = properties["route_id"]
+        trip = self.trips.find(properties["trip_id"]) if properties["trip_id"] else -1
+        if trip >= 0:
+            properties["trip_headsign"] = self.trips.value(trip, 2)
+            properties["shape_id"] = self.trips.value(trip, 3)
+            route_id = route_id or self.trips.value(trip, 1)
+        route = self.routes.find(route_id) if route_id else -1
+        if route >= 0:
+            properties["route_short_name"] = self.routes.value(route, 1)
+            properties["route_long_name"] = self.routes.value(route, 2)
@@ -0,0 +1,398 @@
+import asyncio
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+from collections.abc import Sequence
+from multiprocessing.process import BaseProcess
+from multiprocessing.queues import Queue
+from multiprocessing.synchronize import Event
+from typing import Any, NamedTuple
+
+from .FeedScheduler import FeedScheduler, feed_schedules
+from .Metrics import Histogram, MetricsRegistry
+from .s3Uploader import BackgroundUploader, set_upload_observer
+from .setup_logger import logger
+from .Shutdown import drain, restore_spill, save_until
+
+
+class FeedHealth(NamedTuple):
+    agency: str
+    cycles: int
+    errors: int
+    skipped_ticks: int
+    # cumulative seconds of CPU-bound work, see VehiclePositionFeed.cpu_seconds
+    cpu_seconds: float
+    entities: int
+
+
+class WorkerReport(NamedTuple):
+    worker: int
+    pid: int
+    # health of every feed of the worker by its position in the config
+    feeds: dict[int, FeedHealth]
+    # FeedMetrics.samples by agency, empty without metrics
+    metrics: dict[str, tuple[dict[str, Histogram], dict[str, int], dict[str, int]]]
+
+
+def available_cores() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # pragma: no cover, not available on macOS and Windows
+        return os.cpu_count() or 1
+
+
+def shard(costs: Sequence[float], workers: int) -> list[list[int]]:
+    """Assigns feeds to workers, the most expensive feed first to the least loaded worker.
+
+    Args:
+        costs: cost of every feed, e.g. the fraction of a core it keeps busy
+        workers: number of workers
+
+    Returns:
+        Sorted positions of the feeds assigned to every worker.
+    """
+    shards: list[list[int]] = [[] for _ in range(workers)]
+    loads = [0.0] * workers
+    for feed in sorted(range(len(costs)), key=lambda i: (-costs[i], i)):
+        worker = min(range(workers), key=lambda w: (loads[w], len(shards[w]), w))
+        shards[worker].append(feed)
+        loads[worker] += costs[feed]
+    return [sorted(feeds) for feeds in shards]
+
+
+def run_worker(
+    worker: int,
+    config: list[tuple[int, dict[str, Any]]],
+    reports: "Queue[WorkerReport]",
+    report_interval: float,
+    metrics_enabled: bool,
+    spool_dir: str,
+    spill_dir: str,
+    drain_deadline: float,
+    handoff: Event,
+):
+    """Entry point of a worker process, runs its share of the feeds on a FeedScheduler until SIGTERM.
+
+    A SystemExit of any feed stops the worker, the Supervisor restarts it. On the way out the open trajectories are
+    drained, see Shutdown.drain. When the feeds are handed off to other workers they are spilled right away instead
+    of saved out, so their trajectories continue in the next worker.
+
+    Args:
+        worker: index of the worker
+        config: the feeds of the worker with their position in the config
+        reports: queue receiving a WorkerReport every report_interval seconds and on exit
+        report_interval: seconds between reports
+        metrics_enabled: collect metrics and include their samples in the reports
+        spool_dir: parent of the upload spool of the worker
+        spill_dir: directory open trajectories are spilled to and restored from
+        drain_deadline: seconds the drain may take
+        handoff: set while the Supervisor stops workers to move their feeds
+    """
+    # interrupts are handled by the supervisor, which stops its workers with SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    uploader = BackgroundUploader(spool_dir=os.path.join(spool_dir, f"worker-{worker}"))
+    uploader.replay_spool()
+    metrics = None
+    if metrics_enabled:
+        metrics = MetricsRegistry()
+        set_upload_observer(metrics.observe_upload)
+    schedules = feed_schedules([feed for _, feed in config], uploader=uploader, metrics=metrics)
+    feeds = [schedule.feed for schedule in schedules]
+    restore_spill(feeds, spill_dir)
+    scheduler = FeedScheduler(schedules, fail_fast=True)
+
+    def report():
+        feeds = {
+            position: FeedHealth(
+                schedule.feed.agency,
+                schedule.cycles,
+                schedule.errors,
+                schedule.skipped_ticks,
+                schedule.feed.cpu_seconds,
+                len(schedule.feed.entities),
+            )
+            for (position, _), schedule in zip(config, schedules)
+        }
+        samples = {} if metrics is None else {s.feed.agency: metrics.feed(s.feed.agency).samples() for s in schedules}
+        reports.put(WorkerReport(worker, os.getpid(), feeds, samples))
+
+    # the drain deadline runs from SIGTERM, cycles stuck in a fetch are abandoned when the time to save out is up
+    stopped: list[float] = []
+
+    def deadline() -> float:
+        return 0.0 if handoff.is_set() else drain_deadline
+
+    def stop():
+        stopped.append(time.monotonic())
+        scheduler.stop(until=save_until(stopped[0], deadline()))
+
+    async def main():
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop)
+        task = asyncio.create_task(scheduler.run())
+        while not task.done():
+            await asyncio.wait({task}, timeout=report_interval)
+            report()
+        await task
+
+    try:
+        asyncio.run(main())
+    finally:
+        started = stopped[0] if stopped else time.monotonic()
+        drain(feeds, uploader, deadline(), spill_dir, started=started)
+        scheduler.close(timeout=max(started + deadline() - time.monotonic(), 0.0))
+        uploader.close(timeout=0)
+
+
+class _Worker:
+    def __init__(self, index: int, feeds: list[int]):
+        self.index: int = index
+        self.feeds: list[int] = feeds
+        self.process: BaseProcess | None = None
+        self.pid: int | None = None
+        self.started: float = 0.0
+        self.restarts: int = 0
+        # consecutive crashes within min_uptime of the start, drives the restart backoff
+        self.failures: int = 0
+        self.restart_at: float | None = None
+
+
+class Supervisor:
+    """Runs the feeds of a multi-feed config sharded over a pool of worker processes.
+
+    Protobuf parsing and serialization hold the GIL, so a single process saturates one core. The supervisor splits
+    the feeds over workers, each running its feeds on its own FeedScheduler (see run_worker), and restarts a worker
+    that exits with an exponential backoff, so a SystemExit of one feed only takes down the feeds of its worker.
+    Workers report the health and metrics of their feeds every report_interval seconds. Every rebalance_interval
+    seconds the feeds are re-sharded by their observed CPU cost (VehiclePositionFeed.cpu_seconds per second) when
+    that lowers the load of the busiest worker by at least rebalance_threshold. Workers whose feeds change are stopped
+    before any is started again, feeds with a checkpoint_dir resume their in-flight trajectories in the new worker.
+
+    Args:
+        config: one object per feed, see feed_schedules
+        workers: number of worker processes, defaults to the available cores, never more than there are feeds
+        metrics: optional registry aggregating the metrics reported by the workers
+        report_interval: seconds between worker reports
+        rebalance_interval: seconds between rebalancing checks
+        rebalance_threshold: minimum relative reduction of the busiest worker's load for a rebalance
+        restart_backoff: seconds before restarting a crashed worker, doubled for every consecutive crash
+        max_restart_backoff: upper bound of the restart delay
+        min_uptime: seconds a worker has to run before its next crash resets the backoff
+        stop_timeout: seconds a stopping worker is given before it is killed, workers are stopped in parallel
+        spool_dir: parent of the upload spools of the workers
+        drain_deadline: seconds a stopping worker may spend saving out its open trajectories, below stop_timeout
+        spill_dir: directory the open trajectories left after the drain are spilled to and restored from
+    """
+
+    def __init__(
+        self,
+        config: list[dict[str, Any]],
+        workers: int | None = None,
+        metrics: MetricsRegistry | None = None,
+        report_interval: float = 10.0,
+        rebalance_interval: float = 900.0,
+        rebalance_threshold: float = 0.25,
+        restart_backoff: float = 1.0,
+        max_restart_backoff: float = 60.0,
+        min_uptime: float = 60.0,
+        stop_timeout: float = 30.0,
+        spool_dir: str = "./data/spool",
+        drain_deadline: float = 25.0,
+        spill_dir: str = "./data/spill",
+    ):
+        self.config: list[dict[str, Any]] = config
+        self.metrics: MetricsRegistry | None = metrics
+        self.report_interval: float = report_interval
+        self.rebalance_interval: float = rebalance_interval
+        self.rebalance_threshold: float = rebalance_threshold
+        self.restart_backoff: float = restart_backoff
+        self.max_restart_backoff: float = max_restart_backoff
+        self.min_uptime: float = min_uptime
+        self.stop_timeout: float = stop_timeout
+        self.spool_dir: str = spool_dir
+        self.drain_deadline: float = drain_deadline
+        self.spill_dir: str = spill_dir
+        self.rebalances: int = 0
+
+        count = max(min(workers or available_cores(), len(config)), 1)
+        self.workers: list[_Worker] = [
+            _Worker(index, feeds) for index, feeds in enumerate(shard([1.0] * len(config), count))
+        ]
+        # latest health of every feed, and its CPU cost in cores
+        self.feeds: dict[int, FeedHealth] = {}
+        self.costs: dict[int, float] = {}
+        # (pid, cpu seconds, time) of the previous report of every feed
+        self._baselines: dict[int, tuple[int, float, float]] = {}
+        self._context = multiprocessing.get_context("spawn")
+        self._reports: Queue[WorkerReport] = self._context.Queue()
+        self._stopping = threading.Event()
+        self._handoff: Event = self._context.Event()
+        self._lock = threading.Lock()
+
+    def stop(self):
+        """Makes run stop the workers and return, safe to call from signal handlers and other threads."""
+        self._stopping.set()
+
+    def run(self):
+        for worker in self.workers:
+            self._start(worker)
+        last_rebalance = time.monotonic()
+        try:
+            while not self._stopping.is_set():
+                self._receive(timeout=0.5)
+                self._check_workers()
+                if time.monotonic() - last_rebalance >= self.rebalance_interval:
+                    last_rebalance = time.monotonic()
+                    self.rebalance()
+        finally:
+            self._stop_workers(self.workers)
+            self._receive(timeout=0)
+
+    def health(self) -> dict[str, Any]:
+        """JSON serializable state of every worker and feed, e.g. for MetricsServer."""
+        with self._lock:
+            return {
+                "workers": [
+                    {
+                        "worker": worker.index,
+                        "pid": worker.pid,
+                        "alive": worker.process is not None and worker.process.is_alive(),
+                        "restarts": worker.restarts,
+                        "uptime": round(time.monotonic() - worker.started, 1) if worker.process is not None else 0.0,
+                        "feeds": worker.feeds,
+                        "load": round(sum(self.costs.get(feed, 0.0) for feed in worker.feeds), 4),
+                    }
+                    for worker in self.workers
+                ],
+                "feeds": {
+                    str(position): {**health._asdict(), "cost": round(self.costs.get(position, 0.0), 4)}
+                    for position, health in sorted(self.feeds.items())
+                },
+                "rebalances": self.rebalances,
+            }
+
+    def rebalance(self) -> bool:
+        """Re-shards the feeds by their observed cost if that sufficiently unloads the busiest worker.
+
+        Returns:
+            True if any feed moved to another worker.
+        """
+        if len(self.costs) < len(self.config) or len(self.workers) < 2:
+            return False
+        costs = [self.costs[position] for position in range(len(self.config))]
+        current = max(sum(costs[feed] for feed in worker.feeds) for worker in self.workers)
+        shards = shard(costs, len(self.workers))
+        proposed = max(sum(costs[feed] for feed in feeds) for feeds in shards)
+        if current <= 0 or (current - proposed) / current < self.rebalance_threshold:
+            return False
+
+        # keep as many feeds as possible on the worker already running them
+        unassigned = list(self.workers)
+        assignment: dict[int, list[int]] = {}
+        for feeds in sorted(shards, key=len, reverse=True):
+            worker = max(unassigned, key=lambda w: (len(set(w.feeds) & set(feeds)), -w.index))
+            unassigned.remove(worker)
+            assignment[worker.index] = feeds
+        moved = [worker for worker in self.workers if worker.feeds != assignment[worker.index]]
+        logger.info(f"Rebalancing {len(moved)} workers, busiest worker load {current:.3f} -> {proposed:.3f}")
+        # stop first so no feed ever runs in two workers at once, handing the open trajectories over
+        self._handoff.set()
+        try:
+            self._stop_workers(moved)
+        finally:
+            self._handoff.clear()
+        for worker in moved:
+            worker.feeds = assignment[worker.index]
+            self._start(worker)
+        self.rebalances += 1
+        return True
+
+    def _start(self, worker: _Worker):
+        process = self._context.Process(
+            target=run_worker,
+            args=(
+                worker.index,
+                [(position, self.config[position]) for position in worker.feeds],
+                self._reports,
+                self.report_interval,
+                self.metrics is not None,
+                self.spool_dir,
+                self.spill_dir,
+                self.drain_deadline,
+                self._handoff,
+            ),
+            name=f"feed-worker-{worker.index}",
+            daemon=True,
+        )
+        process.start()
+        with self._lock:
+            worker.process = process
+            worker.pid = process.pid
+            worker.started = time.monotonic()
+            worker.restart_at = None
+        agencies = ", ".join(self.config[position]["agency"] for position in worker.feeds)
+        logger.info(f"Started worker {worker.index} (pid {process.pid}) for {agencies}")
+
+    def _stop_workers(self, workers: Sequence[_Worker]):
+        # every worker drains at the same time, all within one stop_timeout
+        alive = [(worker, worker.process) for worker in workers if worker.process is not None]
+        for _, process in alive:
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + self.stop_timeout
+        for worker, process in alive:
+            process.join(max(deadline - time.monotonic(), 0.0))
+            if process.is_alive():
+                logger.warning(f"Killing worker {worker.index} (pid {process.pid}), it did not stop in time")
+                process.kill()
+                process.join()
+            with self._lock:
+                worker.process = None
+
+    def _check_workers(self):
+        now = time.monotonic()
+        for worker in self.workers:
+            process = worker.process
+            if process is not None and not process.is_alive():
+                with self._lock:
+                    worker.process = None
+                    # a worker that crashes while starting up, e.g. on every poll, keeps backing off
+                    if now - worker.started >= self.min_uptime:
+                        worker.failures = 0
+                    worker.failures += 1
+                    delay = min(self.restart_backoff * 2 ** (worker.failures - 1), self.max_restart_backoff)
+                    worker.restart_at = now + delay
+                logger.error(
+                    f"Worker {worker.index} (pid {process.pid}) exited with {process.exitcode}, "
+                    f"restarting in {delay:.1f} s"
+                )
+            elif process is None and worker.restart_at is not None and now >= worker.restart_at:
+                worker.restarts += 1
+                self._start(worker)
+
+    def _receive(self, timeout: float):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                report = self._reports.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                return
+            self._record(report)
+
+    def _record(self, report: WorkerReport):
+        now = time.monotonic()
+        with self._lock:
+            for position, health in report.feeds.items():
+                self.feeds[position] = health
+                baseline = self._baselines.get(position)
+                if baseline is not None and baseline[0] == report.pid and now > baseline[2]:
+                    cost = (health.cpu_seconds - baseline[1]) / (now - baseline[2])
+                    previous = self.costs.get(position)
+                    # smoothed, a single slow cycle should not move a feed
+                    self.costs[position] = cost if previous is None else (previous + cost) / 2
+                self._baselines[position] = (report.pid, health.cpu_seconds, now)
+        if self.metrics is not None:
+            for agency, samples in report.metrics.items():
+                self.metrics.feed(agency).load(*samples)
@@ -0,0 +1,160 @@
+import datetime
+import json
+from array import array
+from collections.abc import Iterable
+
+from transitfeedhub_ingestor.protobuf import gtfs_realtime_pb2
+
+from .Accumulator import FeaturePublisher
+
+
+def _next_stop_delay(trip_update: gtfs_realtime_pb2.TripUpdate) -> int | None:
+    # the trip level delay, else the delay predicted for the next stop
+    if trip_update.HasField("delay"):
+        return trip_update.delay
+    if not trip_update.stop_time_update:
+        return None
+    stop_time = trip_update.stop_time_update[0]
+    for event in (stop_time.arrival, stop_time.departure):
+        if event.HasField("delay"):
+            return event.delay
+    return None
+
+
+def _next_stop_time(trip_update: gtfs_realtime_pb2.TripUpdate) -> int | None:
+    if not trip_update.stop_time_update:
+        return None
+    stop_time = trip_update.stop_time_update[0]
+    for event in (stop_time.arrival, stop_time.departure):
+        if event.HasField("time"):
+            return event.time
+    return None
+
+
+class DelaySeries:
+    """Predictions for the next stop of one trip over time, built from its successive TripUpdates.
+
+    Every observation keeps the stop the trip is heading to, its predicted arrival (or departure) time and the delay,
+    the trip level delay when the feed sets one. Times and delays a feed does not publish are kept as None.
+    """
+
+    __slots__ = (
+        "arrival_times",
+        "delays",
+        "direction_id",
+        "route_id",
+        "start_date",
+        "start_time",
+        "stop_ids",
+        "stop_sequences",
+        "timestamps",
+        "trip_id",
+        "vehicle_id",
+    )
+
+    def __init__(self, trip_update: gtfs_realtime_pb2.TripUpdate):
+        trip = trip_update.trip
+        self.trip_id: str = trip.trip_id
+        self.route_id: str = trip.route_id
+        self.direction_id: int = trip.direction_id
+        self.start_date: str = trip.start_date
+        self.start_time: str = trip.start_time
+        self.vehicle_id: str = trip_update.vehicle.id
+        self.timestamps: array[int] = array("q")
+        self.stop_sequences: array[int] = array("I")
+        self.stop_ids: list[str] = []
+        self.arrival_times: list[int | None] = []
+        self.delays: list[int | None] = []
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def update(self, trip_update: gtfs_realtime_pb2.TripUpdate, timestamp: int) -> bool:
+        """Appends an observation.
+
+        Args:
+            trip_update: TripUpdate of this trip
+            timestamp: time of the prediction, the TripUpdate timestamp or else the FeedHeader timestamp
+
+        Returns:
+            False if the series already holds an observation at timestamp.
+        """
+        if self.timestamps and self.timestamps[-1] == timestamp:
+            return False
+        next_stop = trip_update.stop_time_update[0] if trip_update.stop_time_update else None
+        self.timestamps.append(timestamp)
+        self.stop_sequences.append(next_stop.stop_sequence if next_stop is not None else 0)
+        self.stop_ids.append(next_stop.stop_id if next_stop is not None else "")
+        self.arrival_times.append(_next_stop_time(trip_update))
+        self.delays.append(_next_stop_delay(trip_update))
+        return True
+
+    def feature(self) -> bytes:
+        """The series as a GeoJSON Feature without geometry, its columns in the properties."""
+        return json.dumps(
+            {
+                "type": "Feature",
+                "geometry": None,
+                "properties": {
+                    "trip_id": self.trip_id,
+                    "route_id": self.route_id,
+                    "direction_id": self.direction_id,
+                    "start_date": self.start_date,
+                    "start_time": self.start_time,
+                    "vehicle_id": self.vehicle_id,
+                    "datetimes": [datetime.datetime.fromtimestamp(t).isoformat() for t in self.timestamps],
+                    "stop_sequence": self.stop_sequences.tolist(),
+                    "stop_id": self.stop_ids,
+                    "arrival_time": self.arrival_times,
+                    "delay": self.delays,
+                },
+            },
+            separators=(",", ":"),
+        ).encode("utf-8")
+
+
+class TripUpdateAccumulator:
+    """Accumulator turning the TripUpdates of a combined feed into one DelaySeries per trip.
+
+    A series is published once its trip leaves the feed, trips seen in a single payload only are dropped like
+    single-point trajectories. Series in flight are not checkpointed.
+    """
+
+    field: str = "trip_update"
+
+    def __init__(self):
+        self.series: dict[tuple[str, str], DelaySeries] = {}
+        # observations appended, repeated predictions skipped and series published
+        self.observations: int = 0
+        self.unchanged: int = 0
+        self.published: int = 0
+
+    def accumulate(
+        self, entities: Iterable[gtfs_realtime_pb2.TripUpdate], header_timestamp: int, publish: FeaturePublisher
+    ):
+        seen: set[tuple[str, str]] = set()
+        for trip_update in entities:
+            key = (trip_update.trip.trip_id, trip_update.trip.start_date)
+            if not key[0] or key in seen:
+                continue
+            seen.add(key)
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = DelaySeries(trip_update)
+            timestamp = trip_update.timestamp if trip_update.HasField("timestamp") else header_timestamp
+            if series.update(trip_update, timestamp):
+                self.observations += 1
+            else:
+                self.unchanged += 1
+        for key in self.series.keys() - seen:
+            self._publish(self.series.pop(key), publish)
+
+    def drain(self, publish: FeaturePublisher):
+        for series in self.series.values():
+            self._publish(series, publish)
+        self.series.clear()
+
+    def _publish(self, series: DelaySeries, publish: FeaturePublisher):
+        if len(series) > 1:
+            publish(series.feature(), series.route_id)
+            self.published += 1
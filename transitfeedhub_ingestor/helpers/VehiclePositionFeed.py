@@ -1,4 +1,7 @@
 import datetime
+import time
+import uuid
+from collections.abc import Collection, Sequence
 from typing import Any
 
 import requests
@@ -6,10 +9,56 @@ from google.protobuf.message import DecodeError
 
 from transitfeedhub_ingestor.protobuf import gtfs_realtime_pb2
 
-from .Entity import Entity
+from .Accumulator import Accumulator, FeaturePublisher
+from .BatchSink import TrajectorySink
+from .Checkpoint import Checkpointer
+from .Entity import Entity, RunLengthPolicy, SegmentPolicy
+from .EntityStore import EntityStore
+from .FeedArchive import FeedArchiveWriter
+from .FeedDecoder import FeedDecoder, VehicleEntities
+from .IngestFilter import IngestFilter
+from .Metrics import FeedMetrics
+from .MFJSONWriter import MFJSONWriter
+from .s3Uploader import BackgroundUploader, upload_file
 from .setup_logger import logger
 
 
+def read_header_timestamp(content: bytes) -> int | None:
+    """Decodes only the FeedHeader of a serialized FeedMessage and returns its timestamp.
+
+    Serializers write fields in field number order, so the header (field 1) is normally the first bytes of the
+    payload and can be read without parsing the entities.
+
+    Args:
+        content: serialized FeedMessage
+
+    Returns:
+        FeedHeader timestamp, or None if the header is not the first field or has no timestamp.
+    """
+    # field 1, wire type 2 (length delimited)
+    if not content or content[0] != 0x0A:
+        return None
+    length = 0
+    shift = 0
+    pos = 1
+    while pos < len(content):
+        byte = content[pos]
+        pos += 1
+        length |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            break
+        shift += 7
+    header = gtfs_realtime_pb2.FeedHeader()
+    try:
+        header.ParseFromString(content[pos : pos + length])
+    except DecodeError:
+        return None
+    return header.timestamp if header.HasField("timestamp") else None
+
+
+STAGES: tuple[str, ...] = ("fetch", "diff", "update", "serialize")
+
+
 class VehiclePositionFeed:
     def __init__(
         self,
@@ -21,8 +70,21 @@ class VehiclePositionFeed:
         query_params: None = None,
         https_verify: bool = True,
         timeout: int = 30,
+        request_timeout: float = 300,
+        uploader: BackgroundUploader | None = None,
+        writer: MFJSONWriter | None = None,
+        batch_sink: TrajectorySink | None = None,
+        checkpointer: Checkpointer | None = None,
+        archive: FeedArchiveWriter | None = None,
+        run_length: RunLengthPolicy | None = None,
+        simplify: float | None = None,
+        segments: SegmentPolicy | None = None,
+        metrics: FeedMetrics | None = None,
+        decoder: FeedDecoder | None = None,
+        accumulators: Sequence[Accumulator] | None = None,
+        ingest_filter: IngestFilter | None = None,
     ):
-        self.entities: list[Entity] = []
+        self.entities: EntityStore = EntityStore()
         self.url: str = url
         self.headers: Any = headers
         self.query_params: Any = query_params
@@ -31,29 +93,226 @@ class VehiclePositionFeed:
         self.s3_bucket: str = s3_bucket
         self.https_verify: bool = https_verify
         self.timeout: int = timeout
+        self.request_timeout: float = request_timeout
+        # optional background upload pool, trajectories are uploaded synchronously without one
+        self.uploader: BackgroundUploader | None = uploader
+        # serializer for saved trajectories, compact MF-JSON unless configured otherwise
+        self.writer: MFJSONWriter = writer if writer is not None else MFJSONWriter()
+        # optional rollup of saved trajectories per agency, date and route, into S3 objects or local segment files
+        self.batch_sink: TrajectorySink | None = batch_sink
+        # optional write-ahead log and snapshots of the in-flight entities, see restore
+        self.checkpointer: Checkpointer | None = checkpointer
+        # optional archive of every new raw payload, for replays after logic fixes
+        self.archive: FeedArchiveWriter | None = archive
+        # optional collapsing of unchanged observations into runs, see Entity.update
+        self.run_length: RunLengthPolicy | None = run_length
+        # optional simplification tolerance in metres applied to trajectories when they are saved
+        self.simplify: float | None = simplify
+        # optional cutting of long-lived trajectories into rolling segments and memory budget of the feed
+        self.segments: SegmentPolicy | None = segments
+        # optional per-stage histograms, gauges and counters, see end_cycle of FeedMetrics
+        self.metrics: FeedMetrics | None = metrics
+        # parses payloads into lazy views of their Vehicle Positions, optionally skipping unused fields
+        self.decoder: FeedDecoder = decoder if decoder is not None else FeedDecoder()
+        # optional collectors of the other entities of combined feeds, e.g. TripUpdateAccumulator
+        self.accumulators: list[Accumulator] = list(accumulators or [])
+        # optional route, agency and geofence filter, rejected vehicles are treated as absent from the feed
+        self.ingest_filter: IngestFilter | None = ingest_filter
+
+        # one pooled session per feed so connections and TLS sessions are reused between polls
+        self.session: requests.Session = requests.Session()
+        # validators of the last processed response, sent back as a conditional request
+        self.etag: str | None = None
+        self.last_modified: str | None = None
+        self.last_header_timestamp: int | None = None
+        # cycles skipped because the server answered 304 Not Modified
+        self.skipped_not_modified: int = 0
+        # cycles skipped because the FeedHeader timestamp was already processed
+        self.skipped_unchanged: int = 0
+        # cumulative seconds spent per stage: fetch (request and parse), diff, update and serialize
+        self.stage_seconds: dict[str, float] = dict.fromkeys(STAGES, 0.0)
+        # cumulative seconds spent parsing payloads, the CPU-bound part of fetch
+        self.parse_seconds: float = 0.0
+        # observations applied to entities, and how many of them only extended a run instead of storing a row
+        self.observations: int = 0
+        self.collapsed_observations: int = 0
+        # points dropped by simplification of saved trajectories
+        self.simplified_rows: int = 0
+        # trajectories cut by the segment policy, and how many of those cuts the memory budget forced
+        self.segments_cut: int = 0
+        self.budget_cuts: int = 0
+        # entities created, observations applied to existing entities, direction change splits, evicted entities and
+        # payloads that failed to decode
+        self.creates: int = 0
+        self.updates: int = 0
+        self.splits: int = 0
+        self.evictions: int = 0
+        self.decode_errors: int = 0
+        # tracked vehicles skipped because their timestamp had not changed, the skip rate is
+        # unchanged_vehicles / (unchanged_vehicles + updates)
+        self.unchanged_vehicles: int = 0
+
+    def find_entity(self, entity_id: str) -> Entity | None:
+        return self.entities.get(entity_id)
+
+    def restore(self) -> int:
+        """Rebuilds the in-flight entities from the checkpoint after a restart.
+
+        Returns:
+            Number of entities restored, 0 without a checkpointer.
+        """
+        if self.checkpointer is None:
+            return 0
+        return self.checkpointer.restore(self.entities, self.run_length)
+
+    def _create_entity(self, feed_entity: gtfs_realtime_pb2.VehiclePosition):
+        entity = Entity(feed_entity)
+        self.entities.add(entity)
+        self.observations += 1
+        self.creates += 1
+        if self.checkpointer is not None:
+            self.checkpointer.record_create(entity)
+
+    def _update_entity(self, entity: Entity, feed_entity: gtfs_realtime_pb2.VehiclePosition):
+        self.observations += 1
+        self.updates += 1
+        if not entity.update(feed_entity, self.run_length):
+            self.collapsed_observations += 1
+        if self.checkpointer is not None:
+            self.checkpointer.record_update(entity)
+        if self.segments is not None and self.segments.due(entity):
+            self._cut_segment(entity, feed_entity)
 
-    def find_entity(self, entity_id: str):
-        return next((e for e in self.entities if e.entity_id == entity_id), None)
+    def _cut_segment(self, entity: Entity, feed_entity: gtfs_realtime_pb2.VehiclePosition) -> Entity:
+        """Saves entity as a finished segment and continues its vehicle in a new one.
+
+        The new segment starts at feed_entity, the last observation of the saved segment, so consecutive segments share
+        a point and the trajectory stays continuous across the cut.
+
+        Returns:
+            The new segment.
+        """
+        self.save_entity_to_s3(entity)
+        segment = Entity(feed_entity)
+        self.entities.add(segment)
+        self.creates += 1
+        if self.checkpointer is not None:
+            self.checkpointer.record_create(segment)
+        self.segments_cut += 1
+        return segment
+
+    def _enforce_memory_budget(self, feed_index: dict[str, gtfs_realtime_pb2.VehiclePosition]):
+        if self.segments is None or self.segments.memory_budget is None:
+            return
+        budget = self.segments.memory_budget
+        total = sum(entity.nbytes for entity in self.entities)
+        if total <= budget:
+            return
+        for entity in sorted(self.entities, key=lambda e: e.timestamps[0]):
+            feed_entity = feed_index.get(entity.entity_id)
+            if len(entity) < 2 or feed_entity is None:
+                continue
+            total -= entity.nbytes
+            total += self._cut_segment(entity, feed_entity).nbytes
+            self.budget_cuts += 1
+            if total <= budget:
+                return
+        logger.warning(f"{self.file_path} holds {total} bytes of trajectories, over its budget of {budget}")
 
     def updatetimeout(self, timeout: int):
         self.timeout = timeout
 
-    def get_entities(self) -> list[gtfs_realtime_pb2.VehiclePosition] | None:
-        feed = None
-        try:
-            feed = gtfs_realtime_pb2.FeedMessage()
-            # TODO: add From and User Agent Headers
-            # headers = {
-            #     'User-Agent': 'Your App Name/1.0',
-            #     'From': 'your_email@example.com'
-            # }
-
-            response = requests.get(
-                self.url, headers=self.headers, params=self.query_params, verify=self.https_verify, timeout=300
-            )
+    @property
+    def cpu_seconds(self) -> float:
+        """Cumulative seconds of CPU-bound work: parsing, diffing, updating and serializing, without network waits."""
+        return (
+            self.parse_seconds
+            + self.stage_seconds["diff"]
+            + self.stage_seconds["update"]
+            + self.stage_seconds["serialize"]
+        )
+
+    @property
+    def filtered_vehicles(self) -> int:
+        # vehicles left out of the entities by the ingest filter
+        return self.ingest_filter.rejected if self.ingest_filter is not None else 0
+
+    @property
+    def skipped_cycles(self) -> int:
+        return self.skipped_not_modified + self.skipped_unchanged
+
+    def _request_headers(self) -> dict[str, str]:
+        headers: dict[str, str] = dict(self.headers or {})
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+    def _remember_validators(self, response: requests.Response):
+        self.etag = response.headers.get("ETag", self.etag)
+        self.last_modified = response.headers.get("Last-Modified", self.last_modified)
+
+    def _fetch(self) -> VehicleEntities | None:
+        # TODO: add From and User Agent Headers
+        # headers = {
+        #     'User-Agent': 'Your App Name/1.0',
+        #     'From': 'your_email@example.com'
+        # }
+
+        start = time.perf_counter()
+        response = self.session.get(
+            self.url,
+            headers=self._request_headers(),
+            params=self.query_params,
+            verify=self.https_verify,
+            timeout=self.request_timeout,
+        )
+        if self.metrics is not None:
+            self.metrics.observe("fetch_seconds", time.perf_counter() - start)
+        if response.status_code == 304:
+            self.skipped_not_modified += 1
+            logger.debug(f"Not modified {self.url}")
+            return None
+
+        header_timestamp = read_header_timestamp(response.content)
+        if header_timestamp and header_timestamp == self.last_header_timestamp:
+            self.skipped_unchanged += 1
+            self._remember_validators(response)
+            logger.debug(f"Unchanged header timestamp {header_timestamp} for {self.url}")
+            return None
 
-            feed.ParseFromString(response.content)
+        if self.archive is not None:
+            self.archive.append(response.content, header_timestamp)
+        start = time.perf_counter()
+        feed_entities = self.decoder.decode(response.content)
+        parse_seconds = time.perf_counter() - start
+        self.parse_seconds += parse_seconds
+        if self.metrics is not None:
+            self.metrics.observe("payload_bytes", len(response.content))
+            self.metrics.observe("parse_seconds", parse_seconds)
+        self._remember_validators(response)
+        self.last_header_timestamp = feed_entities.header_timestamp
+        return feed_entities
+
+    def get_entities(self) -> Collection[gtfs_realtime_pb2.VehiclePosition] | None:
+        """Fetches and parses the feed.
+
+        Returns:
+            Returns the Vehicle Positions in the feed, or None when the feed has not changed since the last
+            processed fetch (304 Not Modified, or an already processed FeedHeader timestamp). The Vehicle Positions
+            are a lazy view of the decoded message, valid until they are passed to reconcile.
+        """
+        start = time.perf_counter()
+        feed_entities: Collection[gtfs_realtime_pb2.VehiclePosition] = []
+        try:
+            fetched = self._fetch()
+            if fetched is None:
+                self.stage_seconds["fetch"] += time.perf_counter() - start
+                return None
+            feed_entities = fetched
         except DecodeError as e:
+            self.decode_errors += 1
             logger.warning(f"protobuf decode error for {self.url}, {e}")
         except requests.exceptions.Timeout:
             logger.warning(f"Timeout for {self.url}")
@@ -71,19 +330,10 @@ class VehiclePositionFeed:
             self.updatetimeout(300)
             logger.exception(e)
 
-        feed_entities: list[gtfs_realtime_pb2.VehiclePosition] = []
-        if feed:
-            # Returns list of feed entities
-            try:
-                feed_entities: list[gtfs_realtime_pb2.VehiclePosition] = [
-                    e.vehicle for e in feed.entity if e.HasField("vehicle")
-                ]
-            except Exception as e:
-                logger.info(f"message does not have vehicle field {e}")
-
+        self.stage_seconds["fetch"] += time.perf_counter() - start
         return feed_entities
 
-    def check_if_empty_protobuf(self, feed_entities: list[gtfs_realtime_pb2.VehiclePosition]) -> bool:
+    def check_if_empty_protobuf(self, feed_entities: Collection[gtfs_realtime_pb2.VehiclePosition]) -> bool:
         """Checks if there are any vehicles in the protobuf. If none, it logs a warning, this can be helpful to determine the operating hours of a feed.
 
         Args:
@@ -98,31 +348,32 @@ class VehiclePositionFeed:
         else:
             return False
 
-    def check_for_existing_entities(self, feed_entities: list[gtfs_realtime_pb2.VehiclePosition]) -> bool:
+    def check_for_existing_entities(self, feed_entities: Collection[gtfs_realtime_pb2.VehiclePosition]) -> bool:
         if len(self.entities) == 0:
             # check if any observations exist, if none create all new objects
+            accept = self.ingest_filter
             for feed_entity in feed_entities:
-                entity = Entity(feed_entity)
-                self.entities.append(entity)
+                if accept is None or accept(feed_entity):
+                    self._create_entity(feed_entity)
             return True
         else:
             return False
 
     def compare_current_ids_to_new_ids(
-        self, feed_entities: list[gtfs_realtime_pb2.VehiclePosition]
+        self, feed_entities: Collection[gtfs_realtime_pb2.VehiclePosition]
     ) -> tuple[set[str], set[str], set[str]]:
-        entity_ids_of_entity_objects: set[str] = {e.entity_id for e in self.entities}
-        entity_ids_in_feed: set[str] = {feed_entity.vehicle.id for feed_entity in feed_entities}
         """Determines which ids need to be created, updated, or deleted (saved).
 
-        This function takes
-
         Args:
             feed_entities: A list of GTFS Realtime Binding Vehicle Positions
 
         Returns:
             Returns tuple of three sets representing the ids to create, updated and remove. The order of returning is: entity_ids_to_create, entity_ids_to_update, entity_ids_to_remove.
         """
+        return self._diff_ids({feed_entity.vehicle.id for feed_entity in feed_entities})
+
+    def _diff_ids(self, entity_ids_in_feed: set[str]) -> tuple[set[str], set[str], set[str]]:
+        entity_ids_of_entity_objects: set[str] = self.entities.ids()
 
         # I am in the feed, and I have a corresponding object. Update me!
         entity_ids_to_update = entity_ids_in_feed.intersection(entity_ids_of_entity_objects)
@@ -141,57 +392,151 @@ class VehiclePositionFeed:
     # check if last updated date is equivalent to new date, to prevent duplication
 
     def save_entity_to_s3(self, entity: Entity):
-        if len(entity.updated_at) > 1:
+        start = time.perf_counter()
+        # before simplify, the checkpoint may still have to log the columns of the earlier cycles
+        if self.checkpointer is not None:
+            self.checkpointer.record_evict(entity)
+        if len(entity) > 1:
             now = datetime.datetime.now()
             strf_rep = now.strftime("%Y%m%d")
-            entity.savetos3(
-                self.s3_bucket,
-                f"{self.agency}/{strf_rep}/{entity.route_id}",
-            )
+            prefix = f"{self.agency}/{strf_rep}/{entity.route_id}"
+            if self.simplify is not None:
+                self.simplified_rows += entity.simplify(self.simplify)
+            if self.batch_sink is not None:
+                self.batch_sink.add(entity, prefix)
+            else:
+                entity.savetos3(self.s3_bucket, prefix, self.uploader, self.writer)
             logger.debug(f"Saving entity {entity.entity_id} | {self.file_path}")
-        # remove from list
-        self.entities.remove(entity)
+        # remove from store
+        self.entities.evict(entity.entity_id)
+        self.evictions += 1
+        self.stage_seconds["serialize"] += time.perf_counter() - start
+
+    def publish_feature(self, kind: str, feature: bytes, route_id: str):
+        """Publishes a GeoJSON Feature of an accumulator below {agency}/{kind}/{YYYYMMDD}/{route_id}.
+
+        Features go to the batch sink like trajectories, without one every feature is uploaded as a FeatureCollection
+        object of its own.
+        """
+        start = time.perf_counter()
+        prefix = f"{self.agency}/{kind}/{datetime.datetime.now().strftime('%Y%m%d')}/{route_id}"
+        if self.batch_sink is not None:
+            self.batch_sink.add_feature(feature, prefix)
+        else:
+            data = b'{"type":"FeatureCollection","features":[' + feature + b"]}"
+            object_name = f"{prefix}/{uuid.uuid4()}.json"
+            if self.uploader is not None:
+                self.uploader.submit(data, self.s3_bucket, object_name, None)
+            else:
+                upload_file(data, self.s3_bucket, object_name)
+        self.stage_seconds["serialize"] += time.perf_counter() - start
+
+    def drain_accumulators(self):
+        """Publishes the series every accumulator still holds, e.g. on shutdown."""
+        for accumulator in self.accumulators:
+            accumulator.drain(self._publisher(accumulator.field))
+
+    def _publisher(self, kind: str) -> FeaturePublisher:
+        def publish(feature: bytes, route_id: str):
+            self.publish_feature(kind, feature, route_id)
+
+        return publish
+
+    def _dispatch(self, feed_entities: Collection[gtfs_realtime_pb2.VehiclePosition] | None):
+        # the other entities of the payload, only a decoded message still carries them
+        if not self.accumulators or not isinstance(feed_entities, VehicleEntities):
+            return
+        for accumulator in self.accumulators:
+            accumulator.accumulate(
+                feed_entities.of(accumulator.field),
+                feed_entities.header_timestamp,
+                self._publisher(accumulator.field),
+            )
 
     def consume_pb(self):
-        feed_entities = self.get_entities()
+        self.reconcile(self.get_entities())
+
+    def reconcile(self, feed_entities: Collection[gtfs_realtime_pb2.VehiclePosition] | None):
+        """Applies one snapshot of Vehicle Positions to the tracked entities.
+
+        Creates entities for new vehicles, updates existing ones, splits trajectories on a direction change and saves
+        out vehicles that left the feed. With a segment policy, trajectories over its limits or the memory budget are
+        cut into rolling segments. The other entities of a decoded payload are handed to the accumulators.
+
+        Args:
+            feed_entities: A list of GTFS Realtime Binding Vehicle Positions, as returned by get_entities
+        """
+        start = time.perf_counter()
+        serialize = self.stage_seconds["serialize"]
+        diff = 0.0
         if (
             feed_entities
             and self.check_if_empty_protobuf(feed_entities) is False
             and self.check_for_existing_entities(feed_entities) is False
         ):
-            entity_ids_to_create, entity_ids_to_update, entity_ids_to_remove = self.compare_current_ids_to_new_ids(
-                feed_entities
-            )
+            # index the feed once so every lookup below is O(1), vehicles with an unchanged timestamp are skipped and
+            # vehicles the ingest filter rejects are left out
+            feed_index, unchanged = self.entities.index_changes(feed_entities, self.ingest_filter)
+            entity_ids_to_create, entity_ids_to_update, entity_ids_to_remove = self._diff_ids(set(feed_index))
+            diff = time.perf_counter() - start
+            self.stage_seconds["diff"] += diff
+            self.unchanged_vehicles += len(unchanged)
 
             for entity_id in entity_ids_to_create:
-                # return vehicle position class, matching by id
-                feed_ent = next((e for e in feed_entities if e.vehicle.id == entity_id), None)
-                if feed_ent:
-                    entity = Entity(feed_ent)
-                    self.entities.append(entity)
-
-            for entity_id in entity_ids_to_update:
-                update_feed_ent = next((e for e in feed_entities if e.vehicle.id == entity_id), None)
-                update_entity = self.find_entity(entity_id)
-                if (
-                    update_feed_ent
-                    and update_entity
-                    and update_entity.updated_at[-1]
-                    != datetime.datetime.fromtimestamp(update_feed_ent.timestamp).isoformat()
-                ):
+                self._create_entity(feed_index[entity_id])
+
+            for entity_id in entity_ids_to_update - unchanged:
+                update_feed_ent = feed_index[entity_id]
+                update_entity = self.entities.get(entity_id)
+                if update_entity and update_entity.timestamps[-1] != update_feed_ent.timestamp:
                     # check if direction changed
                     if update_entity.direction_id == update_feed_ent.trip.direction_id:
                         # if directions are same and not same timestamp update data
-                        update_entity.update(update_feed_ent)
+                        self._update_entity(update_entity, update_feed_ent)
                     else:
                         # if direction id changed and timestamp is new. Save out old and create new.
                         self.save_entity_to_s3(update_entity)
-                        entity = Entity(update_feed_ent)
-                        self.entities.append(entity)
+                        self._create_entity(update_feed_ent)
+                        self.splits += 1
 
             for entity_id in entity_ids_to_remove:
                 # move logic onto object
-                entity = self.find_entity(entity_id)
+                entity = self.entities.get(entity_id)
                 if entity:
                     # call save method
                     self.save_entity_to_s3(entity)
+
+            self._enforce_memory_budget(feed_index)
+
+        self._dispatch(feed_entities)
+        if self.batch_sink is not None:
+            flush_start = time.perf_counter()
+            self.batch_sink.flush_due()
+            self.stage_seconds["serialize"] += time.perf_counter() - flush_start
+        if self.checkpointer is not None:
+            self.checkpointer.commit(self.entities)
+        # everything not spent diffing or serializing went into creating and updating entities
+        serialize = self.stage_seconds["serialize"] - serialize
+        self.stage_seconds["update"] += time.perf_counter() - start - diff - serialize
+        self._end_cycle_metrics()
+        self.decoder.release(feed_entities)
+
+    def _end_cycle_metrics(self):
+        if self.metrics is None:
+            return
+        counters = {
+            "creates": self.creates,
+            "updates": self.updates,
+            "splits": self.splits,
+            "evictions": self.evictions,
+            "decode_errors": self.decode_errors,
+            "unchanged_vehicles": self.unchanged_vehicles,
+            "filtered_vehicles": self.filtered_vehicles,
+            "skipped_cycles": self.skipped_cycles,
+        }
+        gauges = {
+            "entities": len(self.entities),
+            "carriages": sum(len(entity.carriages) for entity in self.entities),
+            "resident_points": sum(len(entity) for entity in self.entities),
+        }
+        self.metrics.end_cycle(self.stage_seconds, counters, gauges)
@@ -0,0 +1,76 @@
+import math
+from collections.abc import Iterable, Sequence
+
+EARTH_RADIUS_M = 6_371_008.8
+
+
+def distance_m(lon1: float, lat1: float, lon2: float, lat2: float) -> float:
+    """Distance in metres between two WGS 84 points.
+
+    Uses the equirectangular approximation, which is accurate to well below a metre over the few kilometres that
+    separate successive vehicle positions.
+    """
+    x = math.radians(lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return EARTH_RADIUS_M * math.hypot(x, y)
+
+
+def bearing_delta(bearing1: float, bearing2: float) -> float:
+    """Smallest angle in degrees between two bearings."""
+    delta = abs(bearing1 - bearing2) % 360
+    return 360 - delta if delta > 180 else delta
+
+
+def simplify_mask(
+    longitude: Sequence[float],
+    latitude: Sequence[float],
+    timestamps: Sequence[int],
+    tolerance: float,
+    anchors: Iterable[int] = (),
+) -> list[bool]:
+    """Douglas-Peucker simplification of a trajectory using the synchronized euclidean distance.
+
+    A point is measured against the position interpolated at its own timestamp on the segment between the kept
+    points around it, rather than against the segment itself, so stops and speed changes survive simplification and
+    the simplified trajectory stays within tolerance metres of every original point at every original timestamp.
+    Coordinates are projected onto a local equirectangular plane around the first point.
+
+    Args:
+        longitude: longitudes of the trajectory
+        latitude: latitudes of the trajectory
+        timestamps: epoch seconds of every point
+        tolerance: maximum synchronized distance in metres of a dropped point
+        anchors: indices that are always kept, the trajectory is simplified between them
+
+    Returns:
+        Mask of the points to keep.
+    """
+    n = len(timestamps)
+    keep = [False] * n
+    if n == 0:
+        return keep
+    scale = math.cos(math.radians(latitude[0]))
+    xs = [math.radians(lon) * scale * EARTH_RADIUS_M for lon in longitude]
+    ys = [math.radians(lat) * EARTH_RADIUS_M for lat in latitude]
+
+    kept = sorted({0, n - 1, *(i for i in anchors if 0 <= i < n)})
+    for i in kept:
+        keep[i] = True
+    stack = [(first, last) for first, last in zip(kept, kept[1:]) if last - first > 1]
+    while stack:
+        first, last = stack.pop()
+        x0, y0, t0 = xs[first], ys[first], timestamps[first]
+        dx, dy, dt = xs[last] - x0, ys[last] - y0, timestamps[last] - t0
+        worst, worst_distance = -1, tolerance
+        for k in range(first + 1, last):
+            ratio = (timestamps[k] - t0) / dt if dt else 0.0
+            distance = math.hypot(xs[k] - x0 - dx * ratio, ys[k] - y0 - dy * ratio)
+            if distance > worst_distance:
+                worst, worst_distance = k, distance
+        if worst >= 0:
+            keep[worst] = True
+            if worst - first > 1:
+                stack.append((first, worst))
+            if last - worst > 1:
+                stack.append((worst, last))
+    return keep
@@ -1,28 +1,305 @@
 import io
+import os
+import queue
+import random
+import threading
+import time
+from collections.abc import Callable
+from typing import NamedTuple
 
 import boto3
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError
 from mypy_boto3_s3.client import S3Client
 
 from .setup_logger import logger
 
+_s3_client: S3Client | None = None
+_s3_client_lock = threading.Lock()
+# called with (object name, seconds) after every successful upload, see set_upload_observer
+_upload_observer: Callable[[str, float], None] | None = None
 
-def upload_file(data: str, bucket: str, object_name: str) -> bool:
+
+def get_s3_client() -> S3Client:
+    """Returns the process wide S3 client, creating it on first use.
+
+    boto3 clients are thread safe, so a single client (and its connection pool) is shared by every upload.
+    """
+    global _s3_client
+    if _s3_client is None:
+        with _s3_client_lock:
+            if _s3_client is None:
+                _s3_client = boto3.client("s3")
+    return _s3_client
+
+
+def set_upload_observer(observer: Callable[[str, float], None] | None):
+    """Registers a callback receiving the object name and latency of every successful upload.
+
+    Covers upload_file and the BackgroundUploader workers, e.g. MetricsRegistry.observe_upload.
+    """
+    global _upload_observer
+    _upload_observer = observer
+
+
+def _put_object(s3_client: S3Client, bucket: str, object_name: str, body: bytes, content_encoding: str | None):
+    start = time.perf_counter()
+    if content_encoding:
+        s3_client.put_object(Bucket=bucket, Key=object_name, Body=io.BytesIO(body), ContentEncoding=content_encoding)
+    else:
+        s3_client.put_object(Bucket=bucket, Key=object_name, Body=io.BytesIO(body))
+    observer = _upload_observer
+    if observer is not None:
+        observer(object_name, time.perf_counter() - start)
+
+
+def upload_file(
+    data: str | bytes,
+    bucket: str,
+    object_name: str,
+    s3_client: S3Client | None = None,
+    content_encoding: str | None = None,
+) -> bool:
     """Upload data to an S3 bucket
 
-    :param data: Data(Str) to upload
+    :param data: Data(Str or Bytes) to upload
     :param bucket: Bucket to upload to
     :param object_name: S3 object name. If not specified then file_name is used (S3 File Name)
+    :param s3_client: client to upload with, defaults to the shared client from get_s3_client
+    :param content_encoding: Content-Encoding of data, e.g. gzip
     :return: True if file was uploaded, else False
     """
 
     # Upload the file
-    s3_client: S3Client = boto3.client("s3")
+    if s3_client is None:
+        s3_client = get_s3_client()
 
     try:
-        file_obj = io.BytesIO(data.encode("utf-8"))
-        s3_client.put_object(Bucket=bucket, Key=object_name, Body=file_obj)
+        body = data.encode("utf-8") if isinstance(data, str) else data
+        _put_object(s3_client, bucket, object_name, body, content_encoding)
     except ClientError as e:
         logger.error(e)
         return False
     return True
+
+
+class UploadJob(NamedTuple):
+    bucket: str
+    object_name: str
+    body: bytes
+    content_encoding: str | None = None
+    # set when the job was replayed from the failure spool, removed once uploaded
+    spool_path: str | None = None
+
+
+class BackgroundUploader:
+    """Bounded pool of upload workers fed by a queue.
+
+    Producers hand trajectories off with submit and return immediately. When the queue is full, submit blocks for at
+    most submit_timeout seconds (backpressure), or until deadline, and then spools the object to disk instead of
+    dropping it. Failed
+    uploads are retried with exponential backoff and spooled to spool_dir once max_attempts is reached. Spooled
+    objects keep their object name as relative path and are re-queued by replay_spool.
+
+    Args:
+        spool_dir: local directory for objects that could not be uploaded
+        workers: number of upload threads
+        max_queue: maximum number of objects waiting for upload
+        max_attempts: attempts per object before it is spooled
+        backoff: base delay in seconds between attempts, doubled after every failure
+        submit_timeout: seconds submit waits for queue space before spooling
+        s3_client: client used by the workers, defaults to the shared client from get_s3_client
+    """
+
+    def __init__(
+        self,
+        spool_dir: str,
+        workers: int = 4,
+        max_queue: int = 1000,
+        max_attempts: int = 5,
+        backoff: float = 0.5,
+        submit_timeout: float = 5.0,
+        s3_client: S3Client | None = None,
+    ):
+        self.spool_dir: str = spool_dir
+        self.max_attempts: int = max_attempts
+        self.backoff: float = backoff
+        self.submit_timeout: float = submit_timeout
+        # optional time.monotonic() time past which submit spools right away instead of waiting, set by Shutdown.drain
+        self.deadline: float | None = None
+        self.s3_client: S3Client = s3_client if s3_client is not None else get_s3_client()
+        self.uploaded: int = 0
+        self.retries: int = 0
+        self.spooled: int = 0
+
+        self._queue: queue.Queue[UploadJob | None] = queue.Queue(maxsize=max_queue)
+        self._stats_lock = threading.Lock()
+        # jobs the workers are uploading right now, by worker thread
+        self._in_flight: dict[int, UploadJob] = {}
+        self._workers: list[threading.Thread] = [
+            threading.Thread(target=self._work, name=f"s3-upload-{i}", daemon=True) for i in range(workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def submit(self, data: str | bytes, bucket: str, object_name: str, content_encoding: str | None = None) -> bool:
+        """Queues an object for upload.
+
+        Returns:
+            True if the object was queued, False if the queue stayed full and the object was spooled to disk.
+        """
+        body = data.encode("utf-8") if isinstance(data, str) else data
+        job = UploadJob(bucket, object_name, body, content_encoding)
+        timeout = self.submit_timeout
+        if self.deadline is not None:
+            timeout = min(timeout, max(self.deadline - time.monotonic(), 0.0))
+        try:
+            self._queue.put(job, timeout=timeout)
+        except queue.Full:
+            logger.warning(f"Upload queue full, spooling {object_name}")
+            self._spool(job)
+            return False
+        return True
+
+    def flush(self, timeout: float | None = None) -> bool:
+        """Waits until every queued object has been uploaded or spooled.
+
+        Returns:
+            True if the queue drained before the timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def close(self, timeout: float | None = None) -> bool:
+        """Drains the queue and stops the workers.
+
+        Returns:
+            True if the queue drained before the timeout.
+        """
+        drained = self.flush(timeout)
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join(timeout)
+        return drained
+
+    def spill(self) -> int:
+        """Spools every queued object and every object being uploaded, e.g. when a shutdown grace period ends.
+
+        Objects being uploaded may still complete, their spooled copy is uploaded again under the same object name by
+        the next replay_spool. Objects replayed from the spool are already on disk and only dequeued.
+
+        Returns:
+            Number of objects written to the spool.
+        """
+        spilled = 0
+        while True:
+            try:
+                job = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                if job is None:
+                    # a stop request of close, hand it back to the workers
+                    self._queue.put(job)
+                    break
+                if job.spool_path is None:
+                    self._spool(job)
+                    spilled += 1
+            finally:
+                self._queue.task_done()
+        with self._stats_lock:
+            in_flight = list(self._in_flight.values())
+        for job in in_flight:
+            if job.spool_path is None:
+                self._spool(job)
+                spilled += 1
+        return spilled
+
+    def replay_spool(self) -> int:
+        """Queues every object found in the spool directory for another upload attempt.
+
+        The spool is organised as spool_dir/bucket/object_name. Once the queue stays full for submit_timeout seconds
+        the remaining objects are left in the spool for the next replay, so a large spool does not stall startup.
+
+        Returns:
+            Number of objects queued.
+        """
+        queued = 0
+        if not os.path.isdir(self.spool_dir):
+            return queued
+        for bucket in os.listdir(self.spool_dir):
+            bucket_dir = os.path.join(self.spool_dir, bucket)
+            for root, _, files in os.walk(bucket_dir):
+                for name in files:
+                    path = os.path.join(root, name)
+                    with open(path, "rb") as f:
+                        body = f.read()
+                    object_name = os.path.relpath(path, bucket_dir).replace(os.sep, "/")
+                    # spool files keep the encoded body, gzip is recognised by its magic number
+                    content_encoding = "gzip" if body[:2] == b"\x1f\x8b" else None
+                    try:
+                        self._queue.put(
+                            UploadJob(bucket, object_name, body, content_encoding, spool_path=path),
+                            timeout=self.submit_timeout,
+                        )
+                    except queue.Full:
+                        logger.warning("Upload queue full, leaving the rest of the spool for the next replay")
+                        return queued
+                    queued += 1
+        return queued
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                self._queue.task_done()
+                return
+            try:
+                with self._stats_lock:
+                    self._in_flight[threading.get_ident()] = job
+                self._upload(job)
+            except Exception:
+                # e.g. the spool disk is full, the worker must keep serving the queue
+                logger.exception(f"Upload worker failed on {job.object_name}")
+            finally:
+                with self._stats_lock:
+                    self._in_flight.pop(threading.get_ident(), None)
+                self._queue.task_done()
+
+    def _upload(self, job: UploadJob):
+        for attempt in range(self.max_attempts):
+            try:
+                _put_object(self.s3_client, job.bucket, job.object_name, job.body, job.content_encoding)
+            except (BotoCoreError, ClientError) as e:
+                if attempt + 1 == self.max_attempts:
+                    logger.error(f"Upload of {job.object_name} failed after {self.max_attempts} attempts, {e}")
+                    break
+                with self._stats_lock:
+                    self.retries += 1
+                time.sleep(self.backoff * 2**attempt * random.uniform(0.5, 1.5))  # noqa: S311
+            else:
+                with self._stats_lock:
+                    self.uploaded += 1
+                if job.spool_path is not None:
+                    os.remove(job.spool_path)
+                return
+        if job.spool_path is None:
+            self._spool(job)
+
+    def _spool(self, job: UploadJob):
+        path = os.path.join(self.spool_dir, job.bucket, *job.object_name.split("/"))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(job.body)
+        with self._stats_lock:
+            self.spooled += 1
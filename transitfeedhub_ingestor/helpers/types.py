@@ -18,6 +18,7 @@ class TemporalPropsDict(TypedDict, total=False):
     occupancy_status: MeasureDict
     occupancy_percentage: MeasureDict
     congestion_level: MeasureDict
+    stop_name: MeasureDict
     # more carriage-specific keys dynamically added
 
 
@@ -28,14 +29,22 @@ class TemporalGeometryDict(TypedDict):
     interpolation: Literal["Linear"]
 
 
-class PropertiesDict(TypedDict):
+class StaticPropertiesDict(TypedDict, total=False):
+    # added from the static GTFS feed when it is configured, see StaticGTFS.enrich
+    route_short_name: str
+    route_long_name: str
+    trip_headsign: str
+    shape_id: str
+
+
+class PropertiesDict(StaticPropertiesDict):
     trajectory_id: int
     entity_id: str
     direction_id: Union[int, None]
     label: str
     trip_id: str
     route_id: str
-    schedule_relationship: str
+    schedule_relationship: int
     trip_start_date: str
     trip_start_time: str
     vehicle_id: str
@@ -1,20 +1,147 @@
+import asyncio
+import json
 import os
+import signal
+import sys
 import time
 
 from dotenv import load_dotenv
+from helpers.Checkpoint import Checkpointer
+from helpers.DiskSink import DiskSink
+from helpers.FeedArchive import FeedArchiveWriter
+from helpers.FeedDecoder import report_protobuf_backend
+from helpers.FeedScheduler import AdaptivePoll, FeedSchedule, FeedScheduler, load_feed_schedules
+from helpers.Metrics import MetricsRegistry, MetricsServer
+from helpers.MFJSONWriter import MFJSONWriter
+from helpers.Profiling import Profiler
+from helpers.s3Uploader import BackgroundUploader, set_upload_observer
 from helpers.setup_logger import logger
+from helpers.Shutdown import drain, restore_spill, save_until
+from helpers.StaticGTFS import StaticGTFS
+from helpers.Supervisor import Supervisor
 from helpers.VehiclePositionFeed import VehiclePositionFeed
 
+
+def supervise(
+    feeds_config: str,
+    workers: int,
+    metrics: MetricsRegistry | None,
+    metrics_port: str,
+    drain_deadline: float,
+    spill_dir: str,
+):
+    """Runs the feeds of feeds_config sharded over worker processes until SIGTERM or SIGINT, see Supervisor."""
+    with open(feeds_config) as f:
+        config = json.load(f)
+    supervisor = Supervisor(
+        config, workers=workers or None, metrics=metrics, drain_deadline=drain_deadline, spill_dir=spill_dir
+    )
+    signal.signal(signal.SIGTERM, lambda signum, frame: supervisor.stop())
+    metrics_server = None
+    if metrics is not None:
+        metrics_server = MetricsServer(metrics, port=int(metrics_port), health=supervisor.health)
+        metrics_server.start()
+    try:
+        supervisor.run()
+    except KeyboardInterrupt:
+        logger.info("Interrupted, workers stopped")
+    finally:
+        if metrics_server is not None:
+            metrics_server.close()
+
+
 if __name__ == "__main__":  # pragma: no cover
     load_dotenv()
     api_key = os.getenv("API_KEY", "")
     provider = os.getenv("PROVIDER", "")
     feed_url = os.getenv("FEED_URL", "")
     s3_bucket = os.getenv("S3_BUCKET", "")
+    # optional JSON list of feeds to host in this process, see load_feed_schedules
+    feeds_config = os.getenv("FEEDS_CONFIG", "")
+    # optional directory for crash-safe checkpoints of the in-flight entities of the single env feed
+    checkpoint_dir = os.getenv("CHECKPOINT_DIR", "")
+    # optional directory archiving the raw payloads of the single env feed in compressed segments
+    archive_dir = os.getenv("ARCHIVE_DIR", "")
+    # optional directory the single env feed appends its trajectories to instead of uploading them to S3
+    output_dir = os.getenv("OUTPUT_DIR", "")
+    # set to poll the single env feed just after its learned publish cadence instead of every 30 seconds
+    adaptive_poll = os.getenv("ADAPTIVE_POLL", "")
+    # optional static GTFS zip of the single env feed, route names, headsigns and stop names are added to its output
+    static_gtfs = os.getenv("STATIC_GTFS", "")
+    # optional local port serving Prometheus metrics of every feed on /metrics and the /debug profiling endpoints
+    metrics_port = os.getenv("METRICS_PORT", "")
+    # seconds a shutdown may take to save out the open trajectories, keep it below the grace period of the orchestrator
+    drain_deadline = float(os.getenv("DRAIN_DEADLINE", "25"))
+    # directory the trajectories still open when the drain deadline passes are spilled to and restored from
+    spill_dir = os.getenv("SPILL_DIR", "./data/spill")
+    # optional number of worker processes the FEEDS_CONFIG feeds are sharded over, 0 for one per core
+    workers = os.getenv("WORKERS", "")
+
+    report_protobuf_backend()
+    metrics = None
+    if metrics_port:
+        metrics = MetricsRegistry()
+        set_upload_observer(metrics.observe_upload)
+
+    if feeds_config and workers:
+        supervise(feeds_config, int(workers), metrics, metrics_port, drain_deadline, spill_dir)
+        sys.exit()
+
+    # trajectories are uploaded by a shared worker pool, failed uploads are spooled here and retried on start
+    uploader = BackgroundUploader(spool_dir="./data/spool")
+    uploader.replay_spool()
+
+    if feeds_config:
+        schedules = load_feed_schedules(feeds_config, uploader=uploader, metrics=metrics)
+    else:
+        logger.info(type(s3_bucket))
+        # the lookup tables are parsed once into ./data/gtfs and memory-mapped from there on later starts
+        gtfs = StaticGTFS.load(static_gtfs) if static_gtfs else None
+        x = VehiclePositionFeed(
+            feed_url,
+            provider,
+            f"./data/{provider}",
+            s3_bucket=s3_bucket,
+            timeout=30,
+            uploader=uploader,
+            writer=MFJSONWriter(gtfs=gtfs),
+            batch_sink=DiskSink(output_dir, gtfs=gtfs) if output_dir else None,
+            checkpointer=Checkpointer(checkpoint_dir) if checkpoint_dir else None,
+            archive=FeedArchiveWriter(archive_dir, compress=True) if archive_dir else None,
+            metrics=metrics.feed(provider) if metrics is not None else None,
+        )
+        x.restore()
+        schedules = [FeedSchedule(x, adaptive=AdaptivePoll() if adaptive_poll else None)]
+    feeds = [schedule.feed for schedule in schedules]
+    restore_spill(feeds, spill_dir)
+
+    # SIGUSR1 profiles the next cycles, SIGUSR2 traces allocations and dumps the largest entities to ./data/profiles
+    profiler = Profiler(feeds)
+    profiler.install_signal_handlers()
+    metrics_server = None
+    if metrics is not None:
+        metrics_server = MetricsServer(metrics, port=int(metrics_port), controls=profiler.controls())
+        metrics_server.start()
+
+    scheduler = FeedScheduler(schedules)
+    # the drain deadline runs from SIGTERM, cycles stuck in a fetch are abandoned when the time to save out is up
+    stopped: list[float] = []
+
+    def stop():
+        stopped.append(time.monotonic())
+        scheduler.stop(until=save_until(stopped[0], drain_deadline))
+
+    async def run():
+        # SIGTERM stops polling, the open trajectories are drained below
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop)
+        await scheduler.run()
 
-    logger.info(type(s3_bucket))
-    x = VehiclePositionFeed(feed_url, provider, f"./data/{provider}", s3_bucket=s3_bucket, timeout=30)
-    running = True
-    while running:
-        x.consume_pb()
-        time.sleep(x.timeout)
+    try:
+        asyncio.run(run())
+    finally:
+        started = stopped[0] if stopped else time.monotonic()
+        drain(feeds, uploader, drain_deadline, spill_dir, started=started)
+        scheduler.close(timeout=max(started + drain_deadline - time.monotonic(), 0.0))
+        uploader.close(timeout=0)
+        if metrics_server is not None:
+            metrics_server.close()